@@ -0,0 +1,367 @@
+import _thread
+import os
+import struct
+import time
+from collections import OrderedDict
+
+from schema import SCHEMA, Field
+from segment import READ_CHUNK_RECORDS
+
+_TIMESTAMP = Field("timestamp", "I")
+
+
+class _Column:
+    """The file of one field: its values, fixed width, from record number `start` on."""
+
+    def __init__(self, field: Field, start: int, path: str):
+        self.field = field
+        self.start = start
+        self.path = path
+        self.pending = bytearray()
+        try:
+            self.size = os.stat(path)[6]
+        except OSError:
+            with open(path, "wb"):
+                pass
+            self.size = 0
+
+
+class ColumnStore:
+    """Samples stored by column: one file of fixed-width values per schema.Field.
+
+    <path>.ts holds the timestamps and <path>.<field name> the values of each field, encoded as
+    described by the field (see schema.Field). <path>.schema lists the fields with the number of the
+    first record each one has a value for, so a field added later starts a new file at the current
+    record and the existing files are never rewritten; the records written before read as None.
+
+    A query only reads the files of the fields it asks for, so a narrow query such as aqi and eCO2
+    moves 4 bytes per record off the card (plus 4 for the timestamps) instead of the whole record.
+
+    The store is an optional sink next to db.DB (main.py writes to it when config.json enables
+    "columns"), with the same guarantees: records are buffered in memory and written once
+    flush_every are pending or flush_interval seconds after the oldest of them, and the buffer is
+    mirrored to backup (e.g. a db.RTCBackup region) on every insert and recovered when the store is
+    opened. The values are written before the timestamps, so a reset in the middle of a flush leaves
+    the store at the previous record count and the next flush overwrites the partial values; a
+    column file that is shorter than the timestamps (e.g. truncated by a failing card) reads as
+    missing values past its end. The files are not partitioned: they grow by 45 bytes per sample.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        schema: tuple = SCHEMA,
+        flush_every: int = 1,
+        flush_interval: int = None,
+        backup=None,
+    ):
+        """open the store at path, creating it if it does not exist and adding the fields of schema
+        that it does not have yet"""
+        self._path = path
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._pending_since = None
+        self._backup = backup
+        self._lock = _thread.allocate_lock()
+        self.bytes_read = 0
+
+        self._timestamps = _Column(_TIMESTAMP, 0, path + ".ts")
+        self._count = self._timestamps.size // _TIMESTAMP.size
+        self._columns = OrderedDict()
+        try:
+            with open(path + ".schema") as f:
+                for line in f:
+                    if line.count(",") != 3:
+                        # the line of a field being added when the station was reset
+                        continue
+                    _line, start = line.rsplit(",", 1)
+                    field = Field.from_line(_line)
+                    self._columns[field.name] = _Column(
+                        field, int(start), self._column_path(field)
+                    )
+        except OSError:
+            pass
+
+        if backup is not None:
+            _capacity = getattr(backup, "capacity", None)
+            if _capacity:
+                self._flush_every = min(flush_every, _capacity // self._record_length())
+            # before adding fields, as the backup holds the columns stored when it was saved
+            self._recover_pending(backup.load())
+
+        for field in schema:
+            self.add_field(field)
+
+    @property
+    def fields(self) -> list:
+        return list(self._columns)
+
+    def __len__(self) -> int:
+        return self._count + len(self._timestamps.pending) // _TIMESTAMP.size
+
+    def add_field(self, field: Field):
+        """start storing field from the next record on; a field that is already stored is left as is"""
+        with self._lock:
+            column = self._columns.get(field.name)
+            if column is not None:
+                if column.field.code != field.code or column.field.scale != field.scale:
+                    raise ValueError("field %s is stored differently" % field.name)
+                return
+
+            self._flush()
+            column = _Column(field, self._count, self._column_path(field))
+            with open(self._path + ".schema", "a") as f:
+                f.write("%s,%d\n" % (field.to_line(), column.start))
+            self._columns[field.name] = column
+
+    def insert(self, values: dict):
+        """add a record; values holds the timestamp and the value of each field
+
+        Fields without a value are stored as missing; values of fields that are not stored are ignored.
+        """
+        with self._lock:
+            self._timestamps.pending.extend(struct.pack("<I", int(values["timestamp"])))
+            for name, column in self._columns.items():
+                field = column.field
+                column.pending.extend(
+                    struct.pack("<" + field.code, field.encode(values.get(name)))
+                )
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            if self._backup is not None:
+                self._backup.save(self._pending_bytes())
+
+            if len(self) - self._count >= self._flush_every:
+                self._flush()
+            elif self._flush_interval is not None:
+                if time.time() - self._pending_since >= self._flush_interval:
+                    self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._timestamps.pending:
+            return
+        for column in self._columns.values():
+            self._write(column)
+        self._write(self._timestamps)
+        self._count = self._timestamps.size // _TIMESTAMP.size
+        self._pending_since = None
+        if self._backup is not None:
+            self._backup.save(b"")
+
+    def _record_length(self) -> int:
+        return _TIMESTAMP.size + sum(c.field.size for c in self._columns.values())
+
+    def _pending_bytes(self) -> bytes:
+        """the pending timestamps followed by the pending values of each column, for the backup"""
+        data = bytearray(self._timestamps.pending)
+        for column in self._columns.values():
+            data.extend(column.pending)
+        return data
+
+    def _recover_pending(self, data: bytes):
+        """write the records saved in the backup that did not make it to the files"""
+        _record_length = self._record_length()
+        if not data or len(data) % _record_length:
+            return
+        n = len(data) // _record_length
+        _last = None
+        if self._count:
+            with open(self._timestamps.path, "rb") as f:
+                f.seek((self._count - 1) * _TIMESTAMP.size)
+                _last = struct.unpack("<I", f.read(_TIMESTAMP.size))[0]
+
+        # the records older than the tail of the files were flushed before the reset
+        _skip = 0
+        while _skip < n:
+            ts = struct.unpack_from("<I", data, _skip * _TIMESTAMP.size)[0]
+            if _last is None or ts > _last:
+                break
+            _skip += 1
+        if _skip == n:
+            return
+
+        _start = _skip * _TIMESTAMP.size
+        _end = n * _TIMESTAMP.size
+        self._timestamps.pending = bytearray(data[_start:_end])
+        _offset = _end
+        for column in self._columns.values():
+            _size = column.field.size
+            _start = _offset + _skip * _size
+            _offset += n * _size
+            column.pending = bytearray(data[_start:_offset])
+        self._flush()
+
+    def _write(self, column: _Column):
+        """write the pending values of a column after its first self._count - column.start values"""
+        _offset = (self._count - column.start) * column.field.size
+        if column.size < _offset:
+            # the file fell behind (it was lost); pad it with missing values
+            _missing = struct.pack("<" + column.field.code, column.field.missing)
+            _padding = _missing * ((_offset - column.size) // len(_missing))
+            column.pending = bytearray(_padding) + column.pending
+            _offset = column.size
+        with open(column.path, "r+b") as f:
+            f.seek(_offset)
+            f.write(column.pending)
+        column.size = max(column.size, _offset + len(column.pending))
+        column.pending = bytearray()
+
+    def read(self, _from: int = None, _to: int = None, fields: tuple = None) -> list:
+        """return the records with a timestamp in [_from, _to) as dicts of the timestamp and the fields"""
+        records = []
+        for timestamps, columns in self.iter_columns(_from, _to, fields):
+            names = fields if fields is not None else self.fields
+            for i in range(len(timestamps)):
+                record = {"timestamp": timestamps[i]}
+                for k in range(len(names)):
+                    record[names[k]] = columns[k][i]
+                records.append(record)
+        return records
+
+    def iter_csv(self, _from: int = None, _to: int = None, fields: tuple = None):
+        """yield a CSV header and then the records with a timestamp in [_from, _to), a chunk of lines
+        at a time; missing values are left empty"""
+        names = fields if fields is not None else self.fields
+        yield "timestamp," + ",".join(names) + "\n"
+        for timestamps, columns in self.iter_columns(_from, _to, fields):
+            lines = []
+            for i in range(len(timestamps)):
+                values = [str(timestamps[i])]
+                for column in columns:
+                    value = column[i]
+                    if value is None:
+                        values.append("")
+                    elif isinstance(value, float):
+                        values.append("%.2f" % value)
+                    else:
+                        values.append(str(value))
+                lines.append(",".join(values))
+            yield "\n".join(lines) + "\n"
+
+    def iter_columns(
+        self,
+        _from: int = None,
+        _to: int = None,
+        fields: tuple = None,
+        chunk: int = READ_CHUNK_RECORDS,
+    ):
+        """yield (timestamps, columns) for the records with a timestamp in [_from, _to), at most chunk
+        records at a time; columns holds a list of the values of each field, None where missing
+
+        Only the timestamps and the files of the given fields (all of them by default) are read.
+        """
+        names = fields if fields is not None else self.fields
+        for name in names:
+            if name not in self._columns:
+                raise ValueError("unknown field %s" % name)
+
+        with self._lock:
+            # records inserted while the range is being read are left out of it
+            count = self._count
+            pending = [bytes(self._timestamps.pending)]
+            pending.extend(bytes(self._columns[name].pending) for name in names)
+        columns = [self._timestamps]
+        columns.extend(self._columns[name] for name in names)
+        total = count + len(pending[0]) // _TIMESTAMP.size
+
+        files = [None] * len(columns)
+        try:
+            for k in range(len(columns)):
+                if count > columns[k].start:
+                    files[k] = open(columns[k].path, "rb")
+            _start, _end = 0, total
+            if _from is not None:
+                _start = self._find(files[0], pending[0], count, total, _from)
+            if _to is not None:
+                _end = self._find(files[0], pending[0], count, total, _to)
+
+            buf = bytearray(chunk * max(column.field.size for column in columns))
+            for _first in range(_start, _end, chunk):
+                _last = min(_first + chunk, _end)
+                values = []
+                for k in range(len(columns)):
+                    values.append(
+                        self._values(
+                            columns[k], files[k], pending[k], count, _first, _last, buf
+                        )
+                    )
+                yield values[0], values[1:]
+        finally:
+            for f in files:
+                if f is not None:
+                    f.close()
+
+    def _values(
+        self,
+        column: _Column,
+        f,
+        pending: bytes,
+        count: int,
+        _first: int,
+        _last: int,
+        buf: bytearray,
+    ) -> list:
+        """the decoded values of records _first to _last (excluded) of a column"""
+        field = column.field
+        values = [None] * max(0, min(_last, column.start) - _first)
+        _first = max(_first, column.start)
+
+        _stop = min(_last, count)
+        if _first < _stop:
+            n = _stop - _first
+            f.seek((_first - column.start) * field.size)
+            mv = memoryview(buf)[: n * field.size]
+            # a column file can be shorter than the timestamps (see the class); what it lacks is
+            # missing, not whatever the buffer held before
+            _read = (f.readinto(mv) or 0) // field.size
+            self.bytes_read += _read * field.size
+            _end = _read * field.size
+            for value in struct.unpack("<%d%s" % (_read, field.code), mv[:_end]):
+                values.append(field.decode(value))
+            values.extend([None] * (n - _read))
+
+        _first = max(_first, count)
+        if _first < _last:
+            _offset = (_first - count) * field.size
+            n = _last - _first
+            for value in struct.unpack_from(
+                "<%d%s" % (n, field.code), pending, _offset
+            ):
+                values.append(field.decode(value))
+        return values
+
+    def _find(self, f, pending: bytes, count: int, total: int, look_for: int) -> int:
+        """the number of the first record with a timestamp at or after look_for (bisection)"""
+        look_for = int(look_for)
+        ts = bytearray(4)
+        _low, _high = 0, total
+        while _low < _high:
+            _mid = (_low + _high) // 2
+            if _mid < count:
+                f.seek(_mid * 4)
+                f.readinto(ts)
+                self.bytes_read += 4
+                t = struct.unpack("<I", ts)[0]
+            else:
+                t = struct.unpack_from("<I", pending, (_mid - count) * 4)[0]
+            if t < look_for:
+                _low = _mid + 1
+            else:
+                _high = _mid
+        return _low
+
+    def _column_path(self, field: Field) -> str:
+        return "%s.%s" % (self._path, field.name)
+
+
+def convert(db, path: str, schema: tuple = SCHEMA) -> ColumnStore:
+    """copy the records of db (a db.DB) to a new column store at path, a chunk at a time"""
+    store = ColumnStore(path, schema, flush_every=READ_CHUNK_RECORDS)
+    for dp in db.iter_range():
+        store.insert(dp.to_dict())
+    store.flush()
+    return store
@@ -0,0 +1,243 @@
+import os
+import struct
+
+from measurements import Timestamp
+from records import BinaryFormat
+from segment import Segment
+
+_MAGIC = b"AIRDZ\x01\x00\x00"
+_HEADER_LENGTH = len(_MAGIC)
+
+# number of records, records per block, offset of the block index, first and last timestamp
+_TRAILER = "<IIIII"
+_TRAILER_LENGTH = struct.calcsize(_TRAILER)
+
+# offset and first timestamp of a block
+_ENTRY = "<II"
+_ENTRY_LENGTH = struct.calcsize(_ENTRY)
+
+# records encoded together; a read decompresses whole blocks
+BLOCK_RECORDS = 128
+
+_NUM_VALUES = len(struct.unpack(BinaryFormat.RECORD, bytes(BinaryFormat.RECORD_LENGTH)))
+
+
+class CompressedSegment:
+    """A read-only segment holding the records of a sealed partition in compressed blocks.
+
+    Each block stores BLOCK_RECORDS records as zigzag varints: the first record of the block as is
+    and the others as the difference of each value (the timestamp and the fixed-point fields of
+    records.BinaryFormat) from the previous record. Samples change little from one to the next, so most
+    values fit in a single byte and a record takes 7-9 bytes instead of 44. The block index at the end
+    of the file holds the offset and first timestamp of every block, so a range read only decompresses
+    the blocks it touches.
+
+    Records are presented as BinaryFormat records at the offsets they would have in an uncompressed
+    binary file, so DB reads them the same way as a Segment."""
+
+    format = BinaryFormat
+
+    def __init__(self, path: str, cache=None):
+        """open the segment at path; decompressed blocks are kept in cache (a cache.BlockCache) if given"""
+        self.path = path
+        self.cache = cache
+        self.reads = 0
+
+        self._file_size = os.stat(path)[6]
+        with open(path, "rb") as f:
+            f.seek(self._file_size - _TRAILER_LENGTH)
+            (
+                self.count,
+                self._block_records,
+                self._index_offset,
+                self.first_ts,
+                self.last_ts,
+            ) = struct.unpack(_TRAILER, f.read(_TRAILER_LENGTH))
+        self.size = BinaryFormat.HEADER_LENGTH + self.count * BinaryFormat.RECORD_LENGTH
+        self._blocks = (self.count + self._block_records - 1) // self._block_records
+
+        # the last decompressed block, when there is no cache
+        self._block = bytearray(self._block_records * BinaryFormat.RECORD_LENGTH)
+        self._block_number = None
+        self._entries = bytearray(2 * _ENTRY_LENGTH)
+
+    def remove(self):
+        os.remove(self.path)
+        if self.cache is not None:
+            self.cache.invalidate(self.path)
+
+    def iter_chunks(self, _from_offset: int, _to_offset: int, buf):
+        """copy the records between the given offsets into buf, yielding the number of bytes copied"""
+        _record_length = BinaryFormat.RECORD_LENGTH
+        mv = memoryview(buf)
+        _record = (_from_offset - BinaryFormat.HEADER_LENGTH) // _record_length
+        _end = (_to_offset - BinaryFormat.HEADER_LENGTH) // _record_length
+
+        while _record < _end:
+            _block_number, i = divmod(_record, self._block_records)
+            block = memoryview(self._load_block(_block_number))
+            n = min(len(buf) // _record_length, _end - _record, self._block_records - i)
+            _start = i * _record_length
+            _stop = _start + n * _record_length
+            mv[: n * _record_length] = block[_start:_stop]
+            _record += n
+            yield n * _record_length
+
+    def seek(self, look_for: Timestamp) -> int:
+        """find the offset of the record with the given timestamp, with the semantics of Segment.seek
+
+        The block is found by bisecting the first timestamps in the block index, then only that block
+        is decompressed."""
+        look_for = int(look_for)
+        if look_for >= self.last_ts:
+            return self.size
+        if look_for <= self.first_ts:
+            return BinaryFormat.HEADER_LENGTH
+
+        # the last block starting at or before look_for
+        _low, _high = 0, self._blocks - 1
+        with open(self.path, "rb") as f:
+            while _low < _high:
+                _mid = (_low + _high + 1) // 2
+                if self._read_entry(f, _mid)[1] <= look_for:
+                    _low = _mid
+                else:
+                    _high = _mid - 1
+
+        block = self._load_block(_low)
+        _found = 0
+        for i in range(len(block) // BinaryFormat.RECORD_LENGTH):
+            ts = BinaryFormat.timestamp(block, i * BinaryFormat.RECORD_LENGTH)
+            if ts > look_for:
+                break
+            _found = i
+        _record = _low * self._block_records + _found
+        return BinaryFormat.HEADER_LENGTH + _record * BinaryFormat.RECORD_LENGTH
+
+    def _read_entry(self, f, block: int) -> tuple:
+        f.seek(self._index_offset + block * _ENTRY_LENGTH)
+        f.readinto(self._entries)
+        self.reads += 1
+        return struct.unpack_from(_ENTRY, self._entries, 0)
+
+    def _load_block(self, block: int):
+        """return the records of a block, decompressing it unless it is cached"""
+        n = min(self._block_records, self.count - block * self._block_records)
+        if self.cache is not None:
+            records = self.cache.get(self.path, block)
+            if records is not None:
+                return records
+            records = bytearray(n * BinaryFormat.RECORD_LENGTH)
+        elif block == self._block_number:
+            return memoryview(self._block)[: n * BinaryFormat.RECORD_LENGTH]
+        else:
+            records = self._block
+
+        with open(self.path, "rb") as f:
+            # the entry of the next block (or the start of the index) tells where this one ends
+            f.seek(self._index_offset + block * _ENTRY_LENGTH)
+            _entries = f.read(2 * _ENTRY_LENGTH)
+            _start = struct.unpack_from(_ENTRY, _entries, 0)[0]
+            _end = self._index_offset
+            if block + 1 < self._blocks:
+                _end = struct.unpack_from(_ENTRY, _entries, _ENTRY_LENGTH)[0]
+            f.seek(_start)
+            data = f.read(_end - _start)
+            self.reads += 2
+
+        values = [0] * _NUM_VALUES
+        _position = 0
+        for i in range(n):
+            for k in range(_NUM_VALUES):
+                _value = 0
+                _shift = 0
+                while True:
+                    b = data[_position]
+                    _position += 1
+                    _value |= (b & 0x7F) << _shift
+                    if b < 0x80:
+                        break
+                    _shift += 7
+                values[k] += (_value >> 1) ^ -(_value & 1)
+            struct.pack_into(
+                BinaryFormat.RECORD, records, i * BinaryFormat.RECORD_LENGTH, *values
+            )
+
+        if self.cache is not None:
+            self.cache.put(self.path, block, records)
+            return records
+        self._block_number = block
+        return memoryview(self._block)[: n * BinaryFormat.RECORD_LENGTH]
+
+
+def is_compressed(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(_HEADER_LENGTH) == _MAGIC
+    except OSError:
+        return False
+
+
+def compress(src_path: str, dst_path: str, block_records: int = BLOCK_RECORDS):
+    """write the records of the segment at src_path to a new compressed segment at dst_path
+
+    The source is streamed a block at a time; only the block index (8 bytes per block) is kept in
+    memory until the end."""
+    for _ in compress_steps(src_path, dst_path, block_records):
+        pass
+
+
+def compress_steps(src_path: str, dst_path: str, block_records: int = BLOCK_RECORDS):
+    """compress as compress() does, yielding after every block written, so that a long compression
+    can be spread over the idle time of the station (see DB.compact_steps)"""
+    src = Segment(src_path, index=False)
+    _src_length = src.format.RECORD_LENGTH
+    buf = bytearray(block_records * _src_length)
+    mv = memoryview(buf)
+
+    count = 0
+    index = bytearray()
+    with open(dst_path, "wb") as f:
+        f.write(_MAGIC)
+        _offset = _HEADER_LENGTH
+        for n in src.iter_chunks(src.format.HEADER_LENGTH, src.size, buf):
+            block = bytearray()
+            previous = [0] * _NUM_VALUES
+            for i in range(0, n, _src_length):
+                if src.format is BinaryFormat:
+                    values = struct.unpack_from(BinaryFormat.RECORD, mv, i)
+                else:
+                    values = struct.unpack(
+                        BinaryFormat.RECORD,
+                        BinaryFormat.encode(src.format.decode(mv, i)),
+                    )
+                if i == 0:
+                    index.extend(struct.pack(_ENTRY, _offset, values[0]))
+                for k in range(_NUM_VALUES):
+                    _put_varint(block, values[k] - previous[k])
+                previous = values
+            f.write(block)
+            _offset += len(block)
+            count += n // _src_length
+            yield
+
+        f.write(index)
+        f.write(
+            struct.pack(
+                _TRAILER,
+                count,
+                block_records,
+                _offset,
+                src.first_ts or 0,
+                src.last_ts or 0,
+            )
+        )
+
+
+def _put_varint(out: bytearray, value: int):
+    """append value to out as a zigzag varint: 7 bits per byte, small magnitudes first"""
+    value = value << 1 if value >= 0 else ((-value) << 1) - 1
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
@@ -1,90 +1,921 @@
+from compressed import CompressedSegment, compress_steps, is_compressed
+from downsample import lttb
 from measurements import DataPoint, Timestamp
+from records import BinaryFormat, CsvFormat
+from rollup import TIERS, Tier
+from segment import READ_CHUNK_RECORDS, Segment, exists
+import _thread
+import metrics
 import os
+import struct
+import time
+
+# periods a database can be partitioned by
+PERIODS = ("day", "month")
+
+# summaries DB.aggregate can compute
+AGGREGATES = ("min", "max", "mean", "count", "sum", "last")
+# records DB.aggregate decodes at a time
+AGGREGATE_CHUNK_RECORDS = 128
+
+_ALL_FIELDS = list(range(len(DataPoint.FIELDS)))
+
+# seconds a partition replaced by its compressed copy is kept, for the reads that started before
+RETIRE_SECONDS = 3600
+
+_insert_seconds = metrics.REGISTRY.histogram(
+    "airstation_db_insert_seconds",
+    "Time to insert a record, including the flushes it triggers.",
+)
+_written_bytes = metrics.REGISTRY.counter(
+    "airstation_db_written_bytes_total", "Bytes of records flushed to the files."
+)
+_read_seconds = metrics.REGISTRY.histogram(
+    "airstation_db_read_seconds", "Time to read a chunk of records from a file."
+)
+_read_bytes = metrics.REGISTRY.counter(
+    "airstation_db_read_bytes_total", "Bytes of records read from the files."
+)
+
+
+class RTCBackup:
+    """Keeps a copy of the unflushed records in the RTC memory of the ESP32.
+
+    RTC memory survives soft and watchdog resets (but not a power loss), so records buffered by DB
+    (or columns.ColumnStore) are not lost when the device is reset before they are written to the SD
+    card. Several stores can share it, each in its own region of `size` bytes from `offset`; a region
+    starts with the length of the data it holds."""
+
+    # bytes of user RTC memory available on the ESP32 port
+    MEMORY: int = 2048
+
+    def __init__(self, offset: int = 0, size: int = MEMORY):
+        from machine import RTC
+
+        self._rtc = RTC()
+        self._offset = offset
+        # bytes of data the region holds
+        self.capacity = size - 2
+
+    def load(self) -> bytes:
+        memory = self._rtc.memory()
+        _start = self._offset + 2
+        if len(memory) < _start:
+            return b""
+        n = struct.unpack_from("<H", memory, self._offset)[0]
+        _end = _start + n
+        if n > self.capacity or len(memory) < _end:
+            return b""
+        return memory[_start:_end]
+
+    def save(self, data: bytes):
+        memory = bytearray(self._rtc.memory())
+        _end = self._offset + 2 + self.capacity
+        if len(memory) < _end:
+            memory.extend(bytes(_end - len(memory)))
+        struct.pack_into("<H", memory, self._offset, len(data))
+        _start = self._offset + 2
+        _end = _start + len(data)
+        memory[_start:_end] = data
+        self._rtc.memory(memory)
+
+
+class _Partition:
+    """An entry of the manifest: one segment file and the timestamps of its first and last record.
+
+    The segment itself is only opened when a query needs it."""
+
+    def __init__(self, key: str, path: str, first_ts: int = None, last_ts: int = None):
+        self.key = key
+        self.path = path
+        self.first_ts = first_ts
+        self.last_ts = last_ts
+        self.segment = None
 
 
 class DB:
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        binary: bool = False,
+        index: bool = True,
+        cadence: int = 30,
+        flush_every: int = 1,
+        flush_interval: int = None,
+        backup=None,
+        rollups: bool = False,
+        partition: str = None,
+        compress: bool = False,
+        cache=None,
+    ):
+        """open the database at path, creating it if it does not exist
+
+        cadence is the expected number of seconds between records; it is only a hint for the
+        interpolation search used when the database has no index (pass 0 to always bisect).
+
+        Inserted records are buffered in memory and written to the file in one go once flush_every
+        records are pending, or when flush_interval seconds have passed since the oldest of them was
+        inserted. The buffer is mirrored to backup (e.g. RTCBackup) on every insert, and records found
+        there when the database is opened are written to the file straight away.
+
+        With rollups enabled, 1-minute, 10-minute and 1-hour summaries of the data (see rollup.Tier) are
+        kept next to the file and updated on every insert.
+
+        With partition set to "day" or "month", new records go to one file per period (<path>.<period>)
+        listed in <path>.manifest, so queries only open the files they overlap and old data can be
+        dropped a file at a time (see drop_before). Records already in the file at path stay readable
+        as the oldest partition. With compress enabled, compact_steps compresses the partitions that
+        are no longer written to; inserts never do, as that would hold the lock (and the sampling
+        loop) while a whole partition is rewritten.
+
+        With a cache (a cache.BlockCache), blocks read from the files are kept in memory for the next
+        query; appending only invalidates the last block of the file written to.
+
+        A database can be shared between threads: inserts and the start of a range read (which takes
+        a snapshot of the unflushed records) are serialised by a lock.
+        """
         self._path = path
+        self._index = index
+        self._cadence = cadence
+        self._partition = partition
+        self._compress = compress
+        self.cache = cache
+        self._lock = _thread.allocate_lock()
+        self._parts = []
+
+        # (path, time) of the partitions replaced by their compressed copies, to remove later
+        self._retired = []
+
+        if partition is None:
+            self._parts.append(_Partition(None, path))
+            self._format = self._open_segment(self._parts[0], binary).format
+        elif partition in PERIODS:
+            if exists(path) or exists(path + ".z"):
+                part = _Partition(None, _compressed_copy(path))
+                if self._open_segment(part).last_ts is not None:
+                    self._parts.append(part)
+            self._load_manifest()
+            self._format = BinaryFormat if binary else CsvFormat
+        else:
+            raise ValueError("unknown partition period %s" % partition)
+
+        # filled once the records of the backup are in the file, which the tiers catch up with
+        self._rollups = {}
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._backup = backup
+        self._pending = bytearray()
+        self._pending_since = None
+        if backup is not None:
+            _capacity = getattr(backup, "capacity", None)
+            if _capacity:
+                self._flush_every = min(
+                    flush_every, _capacity // self._format.RECORD_LENGTH
+                )
+            self._recover_pending(backup.load())
+
+        if rollups:
+            for name, seconds in TIERS:
+                tier = Tier("%s.%s" % (path, name), seconds)
+                tier.catch_up(self)
+                self._rollups[name] = tier
+
+    @property
+    def binary(self) -> bool:
+        return self._format is BinaryFormat
+
+    def insert(self, data: DataPoint):
+        _start = metrics.ticks_us()
+        self._insert(data)
+        _insert_seconds.observe(metrics.ticks_diff(metrics.ticks_us(), _start))
+
+    def _insert(self, data: DataPoint):
+        # every record has to keep the fixed width the seeks rely on
+        data.clamp()
+
+        for tier in self._rollups.values():
+            tier.add(data)
+
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.time()
+            self._format.encode_into(data, self._pending)
+            if self._backup is not None:
+                self._backup.save(self._pending)
+
+            if len(self._pending) >= self._flush_every * self._format.RECORD_LENGTH:
+                self._flush()
+            elif self._flush_interval is not None:
+                if time.time() - self._pending_since >= self._flush_interval:
+                    self._flush()
+
+    def flush(self):
+        """write the buffered records to the file"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        for tier in self._rollups.values():
+            tier.flush()
+        if not self._pending:
+            return
+
+        _record_length = self._format.RECORD_LENGTH
+        _start = 0
+        while _start < len(self._pending):
+            part = self._target(self._format.timestamp(self._pending, _start))
+            _end = _start + _record_length
+            while _end < len(self._pending):
+                if not self._belongs(part, self._format.timestamp(self._pending, _end)):
+                    break
+                _end += _record_length
+
+            segment = part.segment
+            if segment.format is self._format:
+                segment.append(self._pending[_start:_end])
+            else:
+                segment.append(
+                    b"".join(
+                        segment.format.encode(self._format.decode(self._pending, i))
+                        for i in range(_start, _end, _record_length)
+                    )
+                )
+            part.first_ts, part.last_ts = segment.first_ts, segment.last_ts
+            _start = _end
+
+        _written_bytes.inc(len(self._pending))
+        self._pending = bytearray()
+        self._pending_since = None
+        if self._backup is not None:
+            self._backup.save(b"")
+
+    def drop_before(self, _before: Timestamp) -> int:
+        """delete the partitions holding only records older than _before and return how many were dropped
+
+        Whole files are removed, so this takes the same time however much data they hold. The partition
+        being written to is never dropped."""
+        if self._partition is None:
+            raise ValueError("only a partitioned database can drop data")
+
+        _dropped = 0
+        with self._lock:
+            while len(self._parts) > 1 and self._parts[0].last_ts < int(_before):
+                self._open_segment(self._parts.pop(0)).remove()
+                _dropped += 1
+            if _dropped:
+                self._save_manifest()
+        return _dropped
+
+    def compact(self) -> int:
+        """compress the partitions that are no longer written to and return how many were compressed
+
+        This runs compact_steps to the end and removes the replaced files straight away, so it is for
+        tools and a database without concurrent reads; the station runs compact_steps between its
+        other tasks."""
+        _compacted = 0
+        for done in self.compact_steps(force=True):
+            _compacted += done
+        self._remove_retired(0)
+        return _compacted
+
+    def compact_steps(self, force: bool = False):
+        """compress the partitions that are no longer written to, a block at a time
+
+        A generator yielding after every block, 1 when that completed a partition and 0 otherwise, so
+        a caller can let the sampling loop and the server run in between (see main.compact_forever).
+        Does nothing unless the database was opened with compress (or force is given).
+
+        Each partition is rewritten as a compressed.CompressedSegment, which takes 5-6 times less space
+        than a CSV file and is read a block at a time, to <partition>.z; the partition is switched to
+        it under the lock once it is complete, so a reset in the middle leaves the partition as it was.
+        Reads that started before keep reading the old file, which is removed RETIRE_SECONDS later, and
+        blocks cached from it can never be mistaken for the ones of the copy."""
+        self._remove_retired(RETIRE_SECONDS)
+        if not (self._compress or force):
+            return
+        with self._lock:
+            sealed = self._parts[:-1]
+        for part in sealed:
+            if part.path.endswith(".z") or is_compressed(part.path):
+                continue
+            _path = part.path + ".z"
+            for _ in compress_steps(part.path, _path + ".tmp"):
+                yield 0
+            os.rename(_path + ".tmp", _path)
+            with self._lock:
+                if part not in self._parts:
+                    # dropped meanwhile
+                    os.remove(_path)
+                    continue
+                self._retired.append((part.path, time.time()))
+                part.path = _path
+                part.segment = None
+            yield 1
+
+    def _remove_retired(self, age: int):
+        """remove the replaced partitions retired at least age seconds ago"""
+        _now = time.time()
+        with self._lock:
+            retired = [r for r in self._retired if _now - r[1] >= age]
+            self._retired = [r for r in self._retired if _now - r[1] < age]
+        for path, _ in retired:
+            _remove_partition_file(path)
+            if self.cache is not None:
+                self.cache.invalidate(path)
+
+    def _target(self, timestamp: int) -> _Partition:
+        """the partition a new record with the given timestamp is written to, created if needed"""
+        if self._partition is None:
+            return self._parts[0]
+
+        last = self._parts[-1] if self._parts else None
+        if last is None or not self._belongs(last, timestamp):
+            if last is not None:
+                # only the newest partition keeps its segment open
+                last.segment = None
+            key = _partition_key(self._partition, timestamp)
+            last = _Partition(key, "%s.%s" % (self._path, key))
+            self._parts.append(last)
+            self._open_segment(last, self._format is BinaryFormat)
+            self._save_manifest()
+        elif last.segment is None:
+            self._open_segment(last)
+        return last
+
+    def _belongs(self, part: _Partition, timestamp: int) -> bool:
+        """whether a new record with the given timestamp is written to part"""
+        if self._partition is None:
+            return True
+        if part.key is None:
+            return False
+        # records from a clock that went back stay in the current partition
+        return _partition_key(self._partition, timestamp) <= part.key
+
+    def _open_segment(self, part: _Partition, binary: bool = False) -> Segment:
+        """open the segment of a partition; only the newest partition keeps it open between calls"""
+        if part.segment is not None:
+            return part.segment
+
+        if not exists(part.path) and exists(part.path + ".tmp"):
+            # the device was reset between removing the partition and renaming its compressed copy
+            os.rename(part.path + ".tmp", part.path)
+        if is_compressed(part.path):
+            segment = CompressedSegment(part.path, self.cache)
+        else:
+            segment = Segment(part.path, binary, self._index, self._cadence, self.cache)
+        part.first_ts, part.last_ts = segment.first_ts, segment.last_ts
+        if self._parts and part is self._parts[-1]:
+            part.segment = segment
+        return segment
 
+    def _load_manifest(self):
+        """read the list of partitions, or rebuild it from the partition files if it is missing"""
         try:
-            os.stat(path)
+            with open(self._path + ".manifest") as f:
+                lines = f.read().split("\n")
         except OSError:
-            # create file if it does not exist
-            with open(path, "w") as f:
-                f.write(DataPoint.CSV_HEADER)
+            lines = [key + ",," for key in self._partition_files()]
 
-    def insert(self, data: DataPoint):
-        with open(self._path, "a") as f:
-            f.write(data.to_csv())
+        for line in lines:
+            if not line:
+                continue
+            key, first_ts, last_ts = line.split(",")
+            part = _Partition(key, _compressed_copy("%s.%s" % (self._path, key)))
+            if first_ts:
+                part.first_ts, part.last_ts = int(first_ts), int(last_ts)
+            else:
+                self._open_segment(part)
+            self._parts.append(part)
+
+        if self._parts:
+            # the newest partition may have grown since the manifest was written
+            self._parts[-1].segment = None
+            self._open_segment(self._parts[-1])
+
+    def _save_manifest(self):
+        with open(self._path + ".manifest", "w") as f:
+            for part in self._parts:
+                if part.key is None:
+                    continue
+                f.write(
+                    "%s,%s,%s\n"
+                    % (
+                        part.key,
+                        "" if part.first_ts is None else part.first_ts,
+                        "" if part.last_ts is None else part.last_ts,
+                    )
+                )
+
+    def _partition_files(self) -> list:
+        """keys of the partition files next to path, oldest first"""
+        _dir, _name = _split(self._path)
+        keys = []
+        for name in os.listdir(_dir or "."):
+            if name.startswith(_name + "."):
+                key = name.replace(_name + ".", "", 1)
+                if key.endswith(".z"):
+                    key = key[:-2]
+                if key.isdigit() and key not in keys:
+                    keys.append(key)
+        keys.sort()
+        return keys
+
+    def _recover_pending(self, data: bytes):
+        """write the records saved in the backup that did not make it to the file"""
+        _record_length = self._format.RECORD_LENGTH
+        if not data or len(data) % _record_length:
+            return
+
+        _last_ts = self._parts[-1].last_ts if self._parts else None
+        for i in range(0, len(data), _record_length):
+            # records older than the tail of the file were already flushed before the reset
+            if _last_ts is None or self._format.timestamp(data, i) > _last_ts:
+                _end = i + _record_length
+                self._pending.extend(data[i:_end])
+        self.flush()
+
+    def read(
+        self, _from: Timestamp = None, _to: Timestamp = None, fields: tuple = None
+    ) -> list[DataPoint]:
+        """read data points from the database between the given timestamps
+
+        If fields is given, only those fields are decoded; the others are left as None.
+        """
+        return list(self.iter_range(_from, _to, fields=fields))
+
+    def iter_rollup(
+        self, resolution: str, _from: Timestamp = None, _to: Timestamp = None
+    ):
+        """yield rollup.Bucket summaries at the given resolution ("1m", "10m" or "1h")
+
+        Buckets starting within [_from, _to) are returned; the one still being filled comes last.
+        """
+        if resolution not in self._rollups:
+            raise ValueError("no rollup with resolution %s" % resolution)
+        return self._rollups[resolution].iter_range(_from, _to)
+
+    def iter_range(
+        self,
+        _from: Timestamp = None,
+        _to: Timestamp = None,
+        chunk: int = READ_CHUNK_RECORDS,
+        raw: bool = False,
+        fields: tuple = None,
+        reuse: bool = False,
+    ):
+        """yield data points between the given timestamps straight from the file
+
+        At most `chunk` records are held in memory at a time. With raw=True, CSV-formatted bytes are
+        yielded instead, one chunk of records at a time. A raw chunk may be a view into a buffer that
+        is reused for the next chunk, so it has to be consumed before the generator is resumed.
+
+        With reuse=True, the same DataPoint (and Timestamp) is updated and yielded for every record,
+        so a scan does not allocate an object per record; it has to be consumed (or copied) before the
+        generator is resumed. CSV chunks are still parsed in bulk (see CsvFormat.columns), which is
+        faster than decoding them a record at a time, so reuse mostly helps binary databases.
+
+        Only the partitions overlapping the range are opened.
+        """
+        into = DataPoint(timestamp=Timestamp(0)) if reuse else None
+        for _format, mv, n in self._iter_chunks(_from, _to, chunk):
+            for item in self._decode(_format, mv, n, raw, fields, into):
+                yield item
+
+    def since(self, cursor: int = None, raw: bool = False) -> tuple:
+        """return a new cursor and an iterator of the records appended after the given cursor
+
+        A cursor is the timestamp of the newest record a client has (None for none). The records newer
+        than cursor and not newer than the returned cursor are yielded, as iter_range does (with raw),
+        so passing the returned cursor to the next call continues where this one ended, even if records
+        are inserted meanwhile. The range is found from the newest records back, so a poll with nothing
+        new reads no files.
+        """
+        with self._lock:
+            newest = self._last_timestamp()
+        if newest is None or (cursor is not None and cursor >= newest):
+            return cursor, iter(())
+        return newest, self._since(cursor, newest, raw)
+
+    def _since(self, cursor: int, newest: int, raw: bool):
+        _from = None if cursor is None else Timestamp(cursor)
+        for _format, mv, n in self._iter_chunks(_from, None):
+            _record_length = _format.RECORD_LENGTH
+            # the chunks start at the newest record not after the cursor, and end with any records
+            # inserted after the new cursor was taken
+            _start, _end = 0, n
+            if cursor is not None:
+                while _start < n and _format.timestamp(mv, _start) <= cursor:
+                    _start += _record_length
+            while (
+                _end > _start and _format.timestamp(mv, _end - _record_length) > newest
+            ):
+                _end -= _record_length
+            if _end > _start:
+                for item in self._decode(
+                    _format, mv[_start:], _end - _start, raw, None
+                ):
+                    yield item
+            if _end < n:
+                return
+
+    def _last_timestamp(self) -> int:
+        """the timestamp of the newest record, or None for an empty database"""
+        if self._pending:
+            _offset = len(self._pending) - self._format.RECORD_LENGTH
+            return self._format.timestamp(self._pending, _offset)
+        return self._parts[-1].last_ts if self._parts else None
+
+    def etag(self) -> str:
+        """a validator of the content of the database, for HTTP conditional requests
+
+        It changes whenever a record is added or dropped: records are only appended, so the oldest and
+        newest timestamps and the size of the file being written to (with the unflushed records) tell
+        two states apart. It is computed from memory, without reading the files."""
+        with self._lock:
+            first_ts, _size = None, len(self._pending)
+            if self._parts:
+                first_ts = self._parts[0].first_ts
+                _size += self._open_segment(self._parts[-1]).size
+            last_ts = self._last_timestamp()
+        return '"%x-%x-%x"' % (first_ts or 0, _size, last_ts or 0)
+
+    def files(self) -> list:
+        """the paths of the files holding the records, oldest first; records not flushed yet are in
+        none of them"""
+        with self._lock:
+            return [part.path for part in self._parts]
+
+    def aggregate(
+        self,
+        _from: Timestamp = None,
+        _to: Timestamp = None,
+        bucket_seconds: int = 3600,
+        fields: tuple = DataPoint.FIELDS,
+        fns: tuple = AGGREGATES,
+        pause: bool = False,
+    ):
+        """yield (bucket start, values) summarising the records between the given timestamps
+
+        Records are grouped into buckets of bucket_seconds aligned to multiples of it; values holds
+        fns[j] of fields[i] at index i * len(fns) + j. The records are read in a single pass with only
+        the requested fields parsed, so memory does not depend on the size of the range or the
+        buckets, and no DataPoint is built. With pause=True, None is yielded as well after every chunk
+        read, so a caller on an event loop can let the other tasks run within a large bucket.
+        """
+        if bucket_seconds <= 0:
+            raise ValueError("bucket_seconds has to be positive")
+        for fn in fns:
+            if fn not in AGGREGATES:
+                raise ValueError("unknown aggregate %s" % fn)
+        _indexes = [DataPoint.FIELDS.index(name) for name in fields]
+        # validated before the first record is read
+        return self._aggregate(_from, _to, bucket_seconds, _indexes, fns, pause)
+
+    def _aggregate(
+        self,
+        _from: Timestamp,
+        _to: Timestamp,
+        bucket_seconds: int,
+        _indexes: list,
+        fns: tuple,
+        pause: bool = False,
+    ):
+        _num_fields = len(_indexes)
+        _start = None
+        count, low, high, total, last = 0, None, None, None, None
+        for _format, mv, n in self._iter_chunks(_from, _to, AGGREGATE_CHUNK_RECORDS):
+            timestamps, columns = _format.columns(mv, n, _indexes)
+            i = 0
+            while i < len(timestamps):
+                _bucket = timestamps[i] - timestamps[i] % bucket_seconds
+                # the records of a bucket are usually the rest of the chunk
+                j = len(timestamps)
+                _last_ts = timestamps[-1]
+                if _last_ts < _bucket or _last_ts - _bucket >= bucket_seconds:
+                    j = i + 1
+                    while j < len(timestamps):
+                        if timestamps[j] - timestamps[j] % bucket_seconds != _bucket:
+                            break
+                        j += 1
+
+                if _bucket != _start:
+                    if _start is not None:
+                        yield _start, _summarise(fns, count, low, high, total, last)
+                    _start = _bucket
+                    count = 0
+                    low = [column[i] for column in columns]
+                    high = low[:]
+                    total = [0] * _num_fields
+                    last = [0] * _num_fields
+
+                count += j - i
+                for k in range(_num_fields):
+                    run = (
+                        columns[k]
+                        if i == 0 and j == len(timestamps)
+                        else columns[k][i:j]
+                    )
+                    low[k] = min(low[k], min(run))
+                    high[k] = max(high[k], max(run))
+                    total[k] += sum(run)
+                    last[k] = run[-1]
+                i = j
+            if pause:
+                yield None
 
-    def read(self, _from: Timestamp = None, _to: Timestamp = None) -> list[DataPoint]:
-        """read data points from the database between the given timestamps"""
+        if _start is not None:
+            yield _start, _summarise(fns, count, low, high, total, last)
 
-        if _from is None:
-            _from_offset = DataPoint.HEADER_LENGTH + 1
+    def downsample(
+        self,
+        _from: Timestamp = None,
+        _to: Timestamp = None,
+        max_points: int = 1000,
+        fields: tuple = DataPoint.FIELDS,
+        raw: bool = False,
+        pause: bool = False,
+    ):
+        """yield at most max_points data points representative of the records between the given timestamps
+
+        The records are picked with Largest-Triangle-Three-Buckets (see downsample.lttb) on the given
+        fields: a single field keeps the shape of that series, several fields are weighed jointly.
+        Ranges of up to max_points records are returned as they are. The range is read twice, a chunk
+        at a time, so memory grows with max_points and not with the size of the range. With raw=True,
+        CSV-formatted bytes are yielded, one record at a time. With pause=True, None is yielded as well
+        after every chunk read (see downsample.lttb), for a caller that has to let other tasks run.
+        """
+        if max_points < 3:
+            raise ValueError("max_points has to be at least 3")
+        if not fields:
+            raise ValueError("no fields to downsample on")
+        _indexes = [DataPoint.FIELDS.index(name) for name in fields]
+        # validated before the first record is read
+        return self._downsample(_from, _to, max_points, _indexes, raw, pause)
+
+    def _downsample(
+        self,
+        _from: Timestamp,
+        _to: Timestamp,
+        max_points: int,
+        _indexes: list,
+        raw: bool,
+        pause: bool,
+    ):
+        plan = self._plan(_from, _to)
+
+        def _chunks():
+            return self._iter_chunks(None, None, AGGREGATE_CHUNK_RECORDS, plan)
+
+        records = lttb(_chunks, self._count(plan), max_points, _indexes, pause)
+        for item in records:
+            if item is None:
+                yield None
+                continue
+            _format, record = item
+            if raw and _format is CsvFormat:
+                yield record
+            elif raw:
+                yield _format.decode(record, 0).to_csv().encode()
+            else:
+                yield _format.decode(record, 0)
+
+    def _iter_chunks(
+        self,
+        _from: Timestamp,
+        _to: Timestamp,
+        chunk: int = READ_CHUNK_RECORDS,
+        plan: tuple = None,
+    ):
+        """yield (format, buffer, number of bytes) for the records between the given timestamps
+
+        The buffer is reused for the next chunk. A plan from _plan() can be given instead of the
+        timestamps to read the same records more than once."""
+        ranges, pending = plan if plan is not None else self._plan(_from, _to)
+
+        buf = None
+        for segment, _start, _stop in ranges:
+            _format = segment.format
+            if buf is None or len(buf) != chunk * _format.RECORD_LENGTH:
+                buf = bytearray(chunk * _format.RECORD_LENGTH)
+            mv = memoryview(buf)
+            _read_start = metrics.ticks_us()
+            for n in segment.iter_chunks(_start, _stop, buf):
+                _read_seconds.observe(
+                    metrics.ticks_diff(metrics.ticks_us(), _read_start)
+                )
+                _read_bytes.inc(n)
+                yield _format, mv, n
+                _read_start = metrics.ticks_us()
+
+        # records that have not been flushed yet follow the ones in the files
+        if pending:
+            yield self._format, memoryview(pending), len(pending)
+
+    def _plan(self, _from: Timestamp, _to: Timestamp) -> tuple:
+        """find the records between the given timestamps
+
+        Returns a list of (segment, start offset, stop offset) and a copy of the unflushed records in
+        the range. Records inserted after the plan is made are not part of it."""
+        with self._lock:
+            _from_unit, _from_offset, _from_segment = self._locate(_from)
+            _to_unit, _to_offset, _to_segment = self._locate(_to, end=True)
+
+            parts = self._parts[:]
+            _tail_size = None
+            if _to_unit >= len(parts) > 0:
+                _tail_size = self._open_segment(parts[-1]).size
+            pending = b""
+            if _from_unit <= len(parts) <= _to_unit:
+                _start = 0
+                if _from_unit == len(parts) and _from_offset is not None:
+                    _start = _from_offset
+                _stop = len(self._pending)
+                if _to_unit == len(parts):
+                    _stop = 0 if _to_offset is None else _to_offset
+                pending = self._pending[_start:_stop]
+
+        ranges = []
+        for unit in range(_from_unit, min(_to_unit + 1, len(parts))):
+            if unit == _from_unit and _from_segment is not None:
+                segment = _from_segment
+            elif unit == _to_unit and _to_segment is not None:
+                segment = _to_segment
+            else:
+                segment = self._open_segment(parts[unit])
+            _start = segment.format.HEADER_LENGTH
+            if unit == _from_unit and _from_offset is not None:
+                _start = _from_offset
+            _stop = segment.size
+            if unit == len(parts) - 1 and _tail_size is not None:
+                _stop = _tail_size
+            if unit == _to_unit:
+                _stop = _start if _to_offset is None else _to_offset
+            if _stop > _start:
+                ranges.append((segment, _start, _stop))
+        return ranges, pending
+
+    def _count(self, plan: tuple) -> int:
+        """the number of records in a plan from _plan()"""
+        ranges, pending = plan
+        count = len(pending) // self._format.RECORD_LENGTH
+        for segment, _start, _stop in ranges:
+            count += (_stop - _start) // segment.format.RECORD_LENGTH
+        return count
+
+    @staticmethod
+    def _decode(_format, mv, n: int, raw: bool, fields: tuple, into: DataPoint = None):
+        """yield the records in the first n bytes of mv as iter_range does"""
+        _record_length = _format.RECORD_LENGTH
+        if raw and _format is CsvFormat:
+            yield mv[:n]
+        elif raw:
+            yield b"".join(
+                _format.decode(mv, offset).to_csv().encode()
+                for offset in range(0, n, _record_length)
+            )
+        elif fields is None and into is None:
+            # the whole chunk is parsed in bulk and the records built from its columns
+            timestamps, columns = _format.columns(mv, n, _ALL_FIELDS)
+            for ts, t, p, rh, aqi, tvoc, eCO2 in zip(timestamps, *columns):
+                yield DataPoint(Timestamp(ts), t, p, rh, aqi, tvoc, eCO2)
+        elif fields is None and _format is CsvFormat:
+            # text is parsed faster in bulk than a record at a time, even into a reused data point
+            timestamps, columns = _format.columns(mv, n, _ALL_FIELDS)
+            for ts, t, p, rh, aqi, tvoc, eCO2 in zip(timestamps, *columns):
+                into.set_timestamp(ts)
+                into.temperature = t
+                into.pressure = p
+                into.relative_humidity = rh
+                into.aqi = aqi
+                into.tvoc = tvoc
+                into.eCO2 = eCO2
+                yield into
         else:
-            _from_offset = self._find_timestamp_offset(_from)
+            for offset in range(0, n, _record_length):
+                yield _format.decode(mv, offset, fields, into)
+
+    def _locate(self, look_for: Timestamp, end: bool = False) -> tuple:
+        """find where a range bound falls in the partitions followed by the unflushed records
 
-        if _to is None:
-            _to_offset = self._file_size()
+        Returns a unit (the index of a partition, or len(self._parts) for the pending buffer) and the
+        offset within it, with the semantics of Segment.seek applied to all records as if they were in
+        a single file: the newest record not newer than look_for, the first record if look_for
+        precedes it, or the end if look_for is not older than the last record. An offset of None
+        means the start of the unit and the end of all data is the start of unit len(self._parts) + 1.
+        A bound of None means the start of the data, or its end if end is set. The segment opened to
+        find the offset, if any, is returned as well so the caller does not have to open it again.
+        """
+        _pending_unit = len(self._parts)
+        _record_length = self._format.RECORD_LENGTH
+        if look_for is None:
+            return (_pending_unit + 1, None, None) if end else (0, None, None)
+
+        look_for = int(look_for)
+        if self._pending:
+            _last_ts = self._format.timestamp(
+                self._pending, len(self._pending) - _record_length
+            )
         else:
-            _to_offset = self._find_timestamp_offset(_to)
+            _last_ts = self._parts[-1].last_ts if self._parts else None
+        if _last_ts is None or look_for >= _last_ts:
+            return _pending_unit + 1, None, None
 
-        if _from_offset == -1 or _to_offset == -1:
-            return []
+        if self._pending and look_for >= self._format.timestamp(self._pending, 0):
+            _found = 0
+            for i in range(0, len(self._pending), _record_length):
+                if self._format.timestamp(self._pending, i) > look_for:
+                    break
+                _found = i
+            return _pending_unit, _found, None
 
-        with open(self._path, "r") as f:
-            f.seek(_from_offset)
-            data = []
-            while f.tell() < _to_offset and f.tell() < self._file_size():
-                _line = f.readline()
-                dp = DataPoint.from_csv(_line)
-                data.append(dp)
+        for unit in range(len(self._parts) - 1, -1, -1):
+            part = self._parts[unit]
+            if part.first_ts is not None and part.first_ts <= look_for:
+                break
+        else:
+            return 0, None, None
 
-        return data
+        segment = self._open_segment(part)
+        if look_for >= part.last_ts:
+            # the next partition (or the pending buffer) starts after look_for
+            return unit, segment.size - segment.format.RECORD_LENGTH, segment
+        return unit, segment.seek(look_for), segment
 
-    def _file_size(self) -> int:
-        return os.stat(self._path).st_size
 
-    def _find_timestamp_offset(self, look_for: Timestamp) -> int:
-        """find the offset of the line with the given timestamp using binary search"""
-        _low = DataPoint.HEADER_LENGTH
-        _high = self._file_size()
+def _summarise(
+    fns: tuple, count: int, low: list, high: list, total: list, last: list
+) -> list:
+    values = []
+    for i in range(len(total)):
+        for fn in fns:
+            if fn == "min":
+                values.append(low[i])
+            elif fn == "max":
+                values.append(high[i])
+            elif fn == "mean":
+                values.append(total[i] / count)
+            elif fn == "count":
+                values.append(count)
+            elif fn == "sum":
+                values.append(total[i])
+            else:
+                values.append(last[i])
+    return values
 
-        with open(self._path, "r") as f:
-            _last = self._read_timestamp(f, _high - DataPoint.RECORD_LENGTH)
-            if look_for >= _last:
-                return _high
 
-            _first = self._read_timestamp(f, DataPoint.HEADER_LENGTH)
-            if look_for <= _first:
-                return DataPoint.HEADER_LENGTH
+def _compressed_copy(path: str) -> str:
+    """the compressed copy of a partition if there is one (see DB.compact_steps), else path
 
-            # rewind to first record
-            f.seek(DataPoint.HEADER_LENGTH)
+    The partition itself is left over when the station was reset before removing it, and is removed
+    here, as no read can use it any more."""
+    if not exists(path + ".z"):
+        return path
+    if exists(path):
+        _remove_partition_file(path)
+    return path + ".z"
 
-            while _low < _high:
-                _mid = (_low + _high) // 2
-                _mid = _align_to_record(_mid)
 
-                ts = self._read_timestamp(f, _mid)
-                if ts == look_for or _high - _low < DataPoint.RECORD_LENGTH:
-                    return _mid
-                elif ts < look_for:
-                    _low = _mid + 1
-                else:
-                    _high = _mid - 1
+def _remove_partition_file(path: str):
+    for _path in (path, path + ".idx"):
+        try:
+            os.remove(_path)
+        except OSError:
+            pass
 
-        return -1
 
-    @staticmethod
-    def _read_timestamp(f, offset):
-        f.seek(offset)
-        line = f.readline()
-        return DataPoint.from_csv(line).timestamp
+def _partition_key(period: str, timestamp: int) -> str:
+    t = time.gmtime(timestamp)
+    if period == "day":
+        return "%04d%02d%02d" % (t[0], t[1], t[2])
+    return "%04d%02d" % (t[0], t[1])
+
+
+def _split(path: str) -> tuple:
+    """split path into its directory and file name (there is no os.path on MicroPython)"""
+    if "/" not in path:
+        return "", path
+    _dir, _name = path.rsplit("/", 1)
+    return _dir or "/", _name
+
+
+def convert(src_path: str, dst_path: str, binary: bool = True):
+    """copy all records from src_path into a new database at dst_path stored in the requested format
+
+    The records are streamed in chunks, so the whole file never has to fit in memory."""
+    if exists(dst_path):
+        raise OSError("%s already exists" % dst_path)
+
+    src = Segment(src_path, index=False)
+    dst = Segment(dst_path, binary=binary, index=False)
 
+    _src_length = src.format.RECORD_LENGTH
+    buf = bytearray(READ_CHUNK_RECORDS * _src_length)
+    mv = memoryview(buf)
 
-def _align_to_record(_offset: int) -> int:
-    _from_header = _offset - DataPoint.HEADER_LENGTH
-    _num_records = _from_header // DataPoint.RECORD_LENGTH
-    return DataPoint.HEADER_LENGTH + (_num_records * DataPoint.RECORD_LENGTH)
+    for n in src.iter_chunks(src.format.HEADER_LENGTH, src.size, buf):
+        dst.append(
+            b"".join(
+                dst.format.encode(src.format.decode(mv, offset))
+                for offset in range(0, n, _src_length)
+            )
+        )
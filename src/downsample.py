@@ -0,0 +1,126 @@
+from array import array
+
+
+def lttb(chunks, count: int, max_points: int, indexes: list, pause: bool = False):
+    """Largest-Triangle-Three-Buckets: yield (format, record) for at most max_points of the records
+
+    chunks() returns an iterator of (format, buffer, number of bytes) over the count records, like
+    DB._iter_chunks; it is called twice. The first and the last record are always kept; the others are
+    split into max_points - 2 buckets of consecutive records and the record of each bucket forming the
+    largest triangle with the record picked from the previous bucket and the mean of the next bucket
+    is kept. The triangles are measured on the fields with the given indexes (in DataPoint.FIELDS),
+    each scaled by its range over all the records, so a single field gives the classic per-series
+    LTTB and several fields pick the records that matter the most to all of them.
+
+    The first pass computes the mean of every bucket and the second one picks the records, so memory
+    grows with max_points (4 bytes per bucket and field) and not with the number of records. The first
+    pass reads the whole range before anything is yielded; with pause, None is yielded after every
+    chunk, so a caller on an event loop can let the other tasks run (see webserver.Response.stream).
+    """
+    if count <= max_points or max_points < 3:
+        for _format, mv, n in chunks():
+            for offset in range(0, n, _format.RECORD_LENGTH):
+                _end = offset + _format.RECORD_LENGTH
+                yield _format, bytes(mv[offset:_end])
+            if pause:
+                yield None
+        return
+
+    _num_fields = len(indexes)
+    _buckets = max_points - 2
+    _inner = count - 2
+
+    # bucket means: timestamps relative to the first record (the floats of the ESP32 are 32-bit)
+    _first_ts = None
+    mean_ts = array("l", [0] * _buckets)
+    means = [array("f", [0.0] * _buckets) for _ in range(_num_fields)]
+    low = [None] * _num_fields
+    high = [None] * _num_fields
+    last_ts, last = 0, None
+
+    _index = 0
+    for _format, mv, n in chunks():
+        timestamps, columns = _format.columns(mv, n, indexes)
+        if _first_ts is None:
+            _first_ts = timestamps[0]
+        for k in range(_num_fields):
+            _low, _high = min(columns[k]), max(columns[k])
+            if low[k] is None or _low < low[k]:
+                low[k] = _low
+            if high[k] is None or _high > high[k]:
+                high[k] = _high
+
+        _position = 0
+        while _position < len(timestamps):
+            i = _index + _position
+            if i == 0:
+                _position += 1
+                continue
+            if i == count - 1:
+                last_ts = timestamps[_position] - _first_ts
+                last = [column[_position] for column in columns]
+                _position += 1
+                continue
+
+            b = (i - 1) * _buckets // _inner
+            # the first record of the next bucket, or the last record
+            _next = min(-(-(b + 1) * _inner // _buckets) + 1, count - 1)
+            _end = min(_next - _index, len(timestamps))
+            # records of the bucket are added up as they come; the mean is complete at its last one
+            _size = _next - (-(-b * _inner // _buckets) + 1)
+            mean_ts[b] += (
+                sum(timestamps[_position:_end]) - _first_ts * (_end - _position)
+            ) // _size
+            for k in range(_num_fields):
+                means[k][b] += sum(columns[k][_position:_end]) / _size
+            _position = _end
+        _index += len(timestamps)
+        if pause:
+            yield None
+
+    scales = []
+    for k in range(_num_fields):
+        scales.append(1 / (high[k] - low[k]) if high[k] > low[k] else 0)
+
+    # the record picked from the previous bucket
+    a_ts, a = None, None
+    best_area, best = -1, None
+    _index = 0
+    for _format, mv, n in chunks():
+        timestamps, columns = _format.columns(mv, n, indexes)
+        for _position in range(len(timestamps)):
+            i = _index + _position
+            offset = _position * _format.RECORD_LENGTH
+            _end = offset + _format.RECORD_LENGTH
+            t = timestamps[_position] - _first_ts
+            if i == 0 or i == count - 1:
+                if best is not None:
+                    yield best
+                yield _format, bytes(mv[offset:_end])
+                a_ts, a = t, [column[_position] for column in columns]
+                continue
+
+            b = (i - 1) * _buckets // _inner
+            if b + 1 < _buckets:
+                c_ts = mean_ts[b + 1]
+                c = [means[k][b + 1] for k in range(_num_fields)]
+            else:
+                c_ts, c = last_ts, last
+
+            area = 0
+            for k in range(_num_fields):
+                y = columns[k][_position]
+                _doubled = (a_ts - c_ts) * (y - a[k]) - (a_ts - t) * (c[k] - a[k])
+                area += abs(_doubled) * scales[k]
+            if area > best_area:
+                best_area, best = area, (_format, bytes(mv[offset:_end]))
+                best_ts, best_values = t, [column[_position] for column in columns]
+
+            # the last record of the bucket: keep the best one
+            if i * _buckets // _inner != b:
+                yield best
+                a_ts, a = best_ts, best_values
+                best_area, best = -1, None
+        _index += len(timestamps)
+        if pause:
+            yield None
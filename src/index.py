@@ -0,0 +1,96 @@
+import os
+import struct
+
+_MAGIC = b"AIDX"
+_HEADER = "<4sII"
+_HEADER_LENGTH = struct.calcsize(_HEADER)
+_ENTRY_LENGTH = 4
+
+# entries appended with a single write when the clock jumps over many empty slots
+_MAX_ENTRIES_PER_WRITE = 256
+
+
+class TimestampIndex:
+    """Sidecar file holding the offset of the first record in each fixed time slot (an hour by default).
+
+    Entry i is the offset of the first record with a timestamp >= base + i * stride, so the records of
+    any timestamp are located with a single 8-byte read and at most one slot has to be scanned. Slots
+    without records (outages) point at the next record, which keeps the entries dense and directly
+    addressable."""
+
+    def __init__(self, path: str, stride: int = 3600):
+        self._path = path
+        self.stride = stride
+        self.base = None
+        self.count = 0
+        self._entries = bytearray(2 * _ENTRY_LENGTH)
+        self._load()
+
+    def _load(self):
+        try:
+            size = os.stat(self._path)[6]
+            with open(self._path, "rb") as f:
+                header = f.read(_HEADER_LENGTH)
+        except OSError:
+            return
+
+        if len(header) != _HEADER_LENGTH:
+            return
+
+        magic, base, stride = struct.unpack(_HEADER, header)
+        if magic != _MAGIC or stride != self.stride:
+            return
+        if (size - _HEADER_LENGTH) % _ENTRY_LENGTH:
+            # torn write of the last entry
+            return
+
+        self.base = base
+        self.count = (size - _HEADER_LENGTH) // _ENTRY_LENGTH
+
+    def clear(self):
+        self.base = None
+        self.count = 0
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def slot(self, timestamp: int) -> int:
+        return (timestamp - self.base) // self.stride
+
+    def add(self, timestamp: int, offset: int):
+        """record that a record with the given timestamp was appended at offset"""
+        if self.base is None:
+            self.base = timestamp - timestamp % self.stride
+            with open(self._path, "wb") as f:
+                f.write(struct.pack(_HEADER, _MAGIC, self.base, self.stride))
+
+        _slot = self.slot(timestamp)
+        if _slot < self.count:
+            return
+
+        entry = struct.pack("<I", offset)
+        with open(self._path, "ab") as f:
+            while self.count <= _slot:
+                n = min(_slot - self.count + 1, _MAX_ENTRIES_PER_WRITE)
+                f.write(entry * n)
+                self.count += n
+
+    def entry(self, i: int) -> int:
+        with open(self._path, "rb") as f:
+            f.seek(_HEADER_LENGTH + i * _ENTRY_LENGTH)
+            return struct.unpack("<I", f.read(_ENTRY_LENGTH))[0]
+
+    def bracket(self, timestamp: int, end: int) -> tuple:
+        """return the offsets (low, high) delimiting the records in the slot of the given timestamp
+
+        end is returned as the upper bound for the last slot."""
+        _slot = min(max(self.slot(timestamp), 0), self.count - 1)
+
+        with open(self._path, "rb") as f:
+            f.seek(_HEADER_LENGTH + _slot * _ENTRY_LENGTH)
+            n = f.readinto(self._entries)
+
+        if n < len(self._entries):
+            return struct.unpack_from("<I", self._entries, 0)[0], end
+        return struct.unpack("<II", self._entries)
@@ -0,0 +1,73 @@
+import asyncio
+
+from measurements import DataPoint
+
+
+class Live:
+    """The newest samples, shared by the subscribers of /live (see server.route_live).
+
+    The sampling loop publishes every sample it inserts; it is encoded once into a ring of the last
+    `size` samples, and every subscriber sends them from there, so following the station costs no
+    reads of the database however many dashboards are open. Samples are identified by their timestamp,
+    as the cursors of db.DB.since are.
+    """
+
+    def __init__(self, size: int = 32, max_subscribers: int = 4):
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self._timestamps = [None] * size
+        self._lines = [None] * size
+        self._count = 0
+        self._published = None
+
+    def publish(self, dp: DataPoint):
+        """add a sample and wake the subscribers"""
+        i = self._count % len(self._lines)
+        self._timestamps[i] = int(dp.timestamp)
+        self._lines[i] = dp.to_csv().rstrip("\n")
+        self._count += 1
+        if self._published is not None:
+            self._published.set()
+            self._published = None
+
+    def newest(self) -> int:
+        """the timestamp of the newest sample, or None before the first one"""
+        if not self._count:
+            return None
+        return self._timestamps[(self._count - 1) % len(self._lines)]
+
+    def covers(self, cursor: int) -> bool:
+        """whether every sample newer than cursor is still in the ring"""
+        if self._count <= len(self._lines):
+            # nothing was dropped yet, though samples from before the first one may be in the database
+            return self._count > 0 and self._timestamps[0] <= cursor
+        return self._timestamps[self._count % len(self._lines)] <= cursor
+
+    def after(self, cursor: int) -> list:
+        """the (timestamp, CSV line) of the samples in the ring newer than cursor, oldest first"""
+        size = len(self._lines)
+        samples = []
+        for n in range(max(0, self._count - size), self._count):
+            i = n % size
+            if cursor is None or self._timestamps[i] > cursor:
+                samples.append((self._timestamps[i], self._lines[i]))
+        return samples
+
+    async def wait(self, cursor: int, timeout: float) -> bool:
+        """wait at most timeout seconds for a sample newer than cursor; return whether there is one"""
+        newest = self.newest()
+        if newest is not None and (cursor is None or newest > cursor):
+            return True
+        if self._published is None:
+            # created on the loop of the subscribers
+            self._published = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._published.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+def event(timestamp: int, lines) -> str:
+    """a server-sent event of one or more CSV lines, with the timestamp of the last one as its id"""
+    return "id: %d\ndata: %s\n\n" % (timestamp, "\ndata: ".join(lines))
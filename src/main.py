@@ -1,16 +1,76 @@
+import _thread
+import asyncio
+import gc
+import metrics
+import os
 import time
 import urequests
 import json
 
-from db import DB
+import cache
+from columns import ColumnStore
+from db import DB, RTCBackup
 from devices.ens160 import ENS160_calibrated
 from machine import SoftI2C, Pin
 from lib.BME280 import BME280, BME280_OSAMPLE_2
 from measurements import DataPoint
+from records import CsvFormat
+from schema import COMMUNITY_FIELDS, PMS7003_FIELDS
 
 _pm25norm = 25
 _pm10norm = 50
 
+# seconds between two samples
+SAMPLE_INTERVAL = 30
+
+_loop_period = metrics.REGISTRY.histogram(
+    "airstation_loop_period_seconds",
+    "Time between the starts of two samples.",
+    tuple(int(s * 1000000) for s in (29.5, 30, 30.5, 31, 32, 35, 45, 60, 120)),
+)
+_loop_jitter = metrics.REGISTRY.histogram(
+    "airstation_loop_jitter_seconds",
+    "Difference between the time between two samples and the sample interval.",
+)
+_bme280_read = metrics.REGISTRY.histogram(
+    "airstation_bme280_read_seconds", "Time to read the BME280."
+)
+_ens160_read = metrics.REGISTRY.histogram(
+    "airstation_ens160_read_seconds", "Time to read the ENS160."
+)
+
+
+# stack of the threads running blocking reads; the TLS handshake of urequests needs more than the
+# default one
+THREAD_STACK = 16 * 1024
+
+
+async def in_thread(fn, *args):
+    """call fn(*args) in a thread and wait for it without blocking the event loop; return what it
+    returns or raise what it raises"""
+    result = []
+
+    def _run():
+        try:
+            result.append((fn(*args), None))
+        except Exception as e:
+            result.append((None, e))
+
+    _thread.stack_size(THREAD_STACK)
+    _thread.start_new_thread(_run, ())
+    while not result:
+        await asyncio.sleep(0.05)
+    value, error = result[0]
+    if error is not None:
+        raise error
+    return value
+
+
+def sd_free() -> int:
+    """bytes free on the SD card"""
+    stat = os.statvfs("/sd")
+    return stat[0] * stat[3]
+
 
 class SensorData:
     def __init__(self, **kwargs):
@@ -82,40 +142,31 @@ def get_pms7003_data() -> SensorData:
     return SensorData(pm10=pms_data["PM10_0_ATM"], pm25=pms_data["PM2_5_ATM"], aqi=aqi)
 
 
-if __name__ == "__main__":
-    with open("../config.json") as f:
-        _conf = json.load(f)
-
-    for _entry in _conf["stations"]:
-        station = SensorStation(_entry["name"], _entry["id"], _entry["type"])
-        if station.type == "sensor.community":
-            data = get_sensor_community_data(station)
-            print(data)
-
-    from lib.microWebSrv import MicroWebSrv
-    import server
-
-    # import for routing side effect
-    _ = server
-
-    i2c = SoftI2C(scl=Pin(4), sda=Pin(16))
-
-    # TODO: need to panic if the sensor is not connected
-    ens160 = ENS160_calibrated(i2c)
-    bme280 = BME280(mode=BME280_OSAMPLE_2, i2c=i2c)
-
-    mws = MicroWebSrv(webPath="/www")  # TCP port 80 and files in /www
-    mws.Start(threaded=True)  # Starts server in a new thread
-
-    db = DB("/sd/data.csv")
-
+async def sample_forever(bme280, ens160, db, store, pms, community, live):
+    """take a sample every 30 seconds, store it in db (and store, if there is one) and publish it to
+    live"""
+    # one data point and one dict of values are updated by every iteration, so sampling does not
+    # allocate objects that the next iteration throws away
+    datapoint = DataPoint(timestamp=0)
+    values = {}
+    _optional = PMS7003_FIELDS + COMMUNITY_FIELDS
+    _samples = 0
+    _last = None
     while True:
+        _now = metrics.ticks_us()
+        if _last is not None:
+            _period = metrics.ticks_diff(_now, _last)
+            _loop_period.observe(_period)
+            _loop_jitter.observe(abs(_period - SAMPLE_INTERVAL * 1000000))
+        _last = _now
+
         _temp, _pres, _hum = 0.0, 0.0, 0.0
         try:
             temp, pressure, hum = bme280.temperature, bme280.pressure, bme280.humidity
         except OSError as e:
             print("Failed to read BME280 data: %s" % e)
             temp, pressure, hum = None, None, None
+        _bme280_read.observe(metrics.ticks_diff(metrics.ticks_us(), _now))
 
         if temp and hum:
             _temp: float = float(temp[:-1])
@@ -131,7 +182,9 @@ if __name__ == "__main__":
                 f"BME280RH: {hum}%\n"
             )
 
+        _start = metrics.ticks_us()
         aqi, tvoc, eco2, temp, rh, eco2_rating, tvoc_rating = ens160.read_air_quality()
+        _ens160_read.observe(metrics.ticks_diff(metrics.ticks_us(), _start))
         print(
             f"ENS160Temp: {temp:.1f}\u00b0C\n"
             f"ENS160RH: {rh:.1f}%\n"
@@ -142,16 +195,128 @@ if __name__ == "__main__":
             f"AQI: {aqi}\n\n"
         )
 
-        datapoint = DataPoint(
-            timestamp=int(time.time()),
-            temperature=_temp,
-            pressure=_pres,
-            relative_humidity=_hum,
-            aqi=int(aqi),
-            tvoc=int(tvoc),
-            eCO2=int(eco2),
-        )
+        datapoint.timestamp = int(time.time())
+        datapoint.temperature = _temp
+        datapoint.pressure = _pres
+        datapoint.relative_humidity = _hum
+        datapoint.aqi = int(aqi)
+        datapoint.tvoc = int(tvoc)
+        datapoint.eCO2 = int(eco2)
 
         db.insert(datapoint)
+        # to the dashboards following /live
+        live.publish(datapoint)
+
+        if store is not None:
+            values["timestamp"] = datapoint.timestamp
+            for name in DataPoint.FIELDS:
+                values[name] = getattr(datapoint, name)
+            # readings that fail are stored as missing, not as the previous sample's
+            for field in _optional:
+                values[field.name] = None
+            # both block for a while (a UART read and an HTTPS request), so they run in a thread
+            # while the web server keeps answering
+            if pms is not None:
+                try:
+                    values.update(await in_thread(pms.read))
+                except Exception as e:
+                    print("Failed to read PMS7003 data: %s" % e)
+            if community is not None and _samples % 20 == 0:
+                try:
+                    data = await in_thread(get_sensor_community_data, community)
+                    values["community_pm10"] = data.pm10
+                    values["community_pm25"] = data.pm25
+                except Exception as e:
+                    print("Failed to get sensor community data: %s" % e)
+            store.insert(values)
+        _samples += 1
+
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def compact_forever(db):
+    """compress the partitions db no longer writes to, a block at a time between the other tasks, at
+    startup and then every hour"""
+    while True:
+        for _ in db.compact_steps():
+            await asyncio.sleep(0)
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    with open("../config.json") as f:
+        _conf = json.load(f)
+
+    community = None
+    pms = None
+    for _entry in _conf["stations"]:
+        station = SensorStation(_entry["name"], _entry["id"], _entry["type"])
+        if station.type == "sensor.community":
+            community = station
+            data = get_sensor_community_data(station)
+            print(data)
+        if station.type == "pms7003":
+            from devices.pms7003 import Pms7003
+
+            pms = Pms7003(station.id)
+
+    import server
+
+    i2c = SoftI2C(scl=Pin(4), sda=Pin(16))
+
+    # TODO: need to panic if the sensor is not connected
+    ens160 = ENS160_calibrated(i2c)
+    bme280 = BME280(mode=BME280_OSAMPLE_2, i2c=i2c)
+
+    # the blocks of the last 24 h, which the page and /aggregate read over and over; a smaller cache
+    # is evicted by every scan of the day before it is read again, so go without one if it doesn't fit
+    _budget = cache.budget(24 * 3600, SAMPLE_INTERVAL, CsvFormat.RECORD_LENGTH)
+    _cache = None
+    if _budget <= gc.mem_free() // 2:
+        _cache = cache.BlockCache(_budget)
+    else:
+        print("Not enough memory for a %d byte block cache" % _budget)
+
+    # buffer samples in RAM (mirrored to RTC memory) and write them to the SD card every 5 minutes,
+    # one file per month; past months are compressed by compact_forever
+    db = DB(
+        "/sd/data.csv",
+        flush_every=10,
+        flush_interval=300,
+        backup=RTCBackup(0, RTCBackup.MEMORY // 2),
+        rollups=True,
+        partition="month",
+        compress=True,
+        cache=_cache,
+    )
+    # the web server reads the same instance, so requests are served from its cache
+    server.database = db
+    # every measurement, including the ones DataPoint has no field for (PMS7003, sensor.community),
+    # one file per field; buffered and backed up as db is, so that both are written to the card
+    # together. "columns": false in the configuration turns it off
+    store = None
+    if _conf.get("columns", True):
+        store = ColumnStore(
+            "/sd/columns",
+            flush_every=10,
+            flush_interval=300,
+            backup=RTCBackup(RTCBackup.MEMORY // 2, RTCBackup.MEMORY // 2),
+        )
+    server.store = store
+
+    # read at every scrape of /metrics
+    metrics.REGISTRY.gauge("airstation_mem_free_bytes", "Free heap.", gc.mem_free)
+    metrics.REGISTRY.gauge(
+        "airstation_sd_free_bytes", "Free space on the SD card.", sd_free
+    )
+
+    # static files are served by server.route_static, with ETag and Range support
+    server.static_routes("/www")
+
+    async def _main():
+        # the server answers requests while the sampling loop waits for the next sample
+        await server.app.start(port=80)
+        asyncio.create_task(compact_forever(db))
+        await sample_forever(bme280, ens160, db, store, pms, community, server.live)
 
-        time.sleep(30)
+    asyncio.run(_main())
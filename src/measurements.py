@@ -1,11 +1,15 @@
 import time
 
+from schema import DATAPOINT_FIELDS, TIMESTAMP_WIDTH
+
 # Timestamps returned by esp32 are in Embedded Epoch Time (seconds since 2000-01-01 00:00:00 UTC) as opposed to
 # Unix/POSIX Epoch Time (seconds since 1970-01-01 00:00:00 UTC).
 _epoch_offset = 946684800
 
 
 class Timestamp:
+    __slots__ = ("timestamp",)
+
     @staticmethod
     def from_embedded_epoch(timestamp: int) -> "Timestamp":
         return Timestamp(timestamp + _epoch_offset)
@@ -60,6 +64,31 @@ class Timestamp:
         return hash(self.timestamp)
 
 
+def _limits(fields: tuple) -> dict:
+    """the smallest and largest value of each field that fits both its CSV column and its struct code"""
+    limits = {}
+    for field in fields:
+        _digits = field.width - (field.decimals + 1 if field.decimals else 0)
+        # in units of the scale; a negative value needs a character for its sign
+        low = max(-(10 ** (_digits - 1 + field.decimals) - 1), field.low)
+        high = min(10 ** (_digits + field.decimals) - 1, field.high)
+        if field.scale != 1:
+            low, high = low / field.scale, high / field.scale
+        limits[field.name] = (low, high)
+    return limits
+
+
+def _csv_format(fields: tuple) -> str:
+    """the %-format of a CSV line: the timestamp, then each field right-aligned in its width"""
+    columns = ["%" + str(TIMESTAMP_WIDTH) + "d"]
+    for field in fields:
+        if field.decimals:
+            columns.append("%%%d.%df" % (field.width, field.decimals))
+        else:
+            columns.append("%%%dd" % field.width)
+    return ",".join(columns) + "\n"
+
+
 class DataPoint:
     """DataPoint class represents a data point in a time series.
     Variables described by DataPoint are:
@@ -72,16 +101,36 @@ class DataPoint:
     - eCO2: int # Equivalent CO2 in ppm
 
     The source for temperature, pressure, and relative humidity is BME280.
-    The source for aqi, tvoc, and eCO2 is ENS160."""
-
-    def __init__(self, **kwargs):
-        self.timestamp: Timestamp = kwargs.get("timestamp")
-        self.temperature: float = kwargs.get("temperature")
-        self.pressure: float = kwargs.get("pressure")
-        self.relative_humidity: float = kwargs.get("relative_humidity")
-        self.aqi: int = kwargs.get("aqi")
-        self.tvoc: int = kwargs.get("tvoc")
-        self.eCO2: int = kwargs.get("eCO2")
+    The source for aqi, tvoc, and eCO2 is ENS160.
+
+    The sampling loop and DB.iter_range(reuse=True) update a single instance in place instead of
+    allocating one per sample. __slots__ only saves the per-instance dict on CPython (the tests and the
+    tools in util/); MicroPython ignores it."""
+
+    FIELDS: tuple = tuple(field.name for field in DATAPOINT_FIELDS)
+
+    __slots__ = ("timestamp",) + FIELDS
+
+    def __init__(
+        self,
+        timestamp: Timestamp = None,
+        temperature: float = None,
+        pressure: float = None,
+        relative_humidity: float = None,
+        aqi: int = None,
+        tvoc: int = None,
+        eCO2: int = None,
+    ):
+        # the values can also be passed in the order of FIELDS, which decoders use to build records
+        # without the cost of keyword arguments; the arguments are spelled out rather than derived from
+        # the schema for the same reason, and have to follow DATAPOINT_FIELDS
+        self.timestamp: Timestamp = timestamp
+        self.temperature: float = temperature
+        self.pressure: float = pressure
+        self.relative_humidity: float = relative_humidity
+        self.aqi: int = aqi
+        self.tvoc: int = tvoc
+        self.eCO2: int = eCO2
 
     def __str__(self) -> str:
         return f"{self.timestamp}: T={self.temperature}°C, P={self.pressure}hPa, RH={self.relative_humidity}%, AQI={self.aqi}, TVOC={self.tvoc}ppb, eCO2={self.eCO2}ppm"
@@ -89,48 +138,74 @@ class DataPoint:
     def __repr__(self) -> str:
         return self.__str__()
 
-    CSV_HEADER: str = "timestamp,temperature,pressure,relative_humidity,aqi,tvoc,eCO2\n"
+    # the Python type of each field
+    TYPES: tuple = tuple(float if f.scale != 1 else int for f in DATAPOINT_FIELDS)
+
+    # smallest and largest value of each field that fits its column in to_csv() and in the binary
+    # record (see records.BinaryFormat)
+    LIMITS: dict = _limits(DATAPOINT_FIELDS)
+
+    CSV_HEADER: str = ",".join(("timestamp",) + FIELDS) + "\n"
     HEADER_LENGTH: int = len(CSV_HEADER)
-    RECORD_LENGTH: int = len("1742195260,-12.34,1234.56,12.34,1,1234,1234\n")
+    _CSV_FORMAT: str = _csv_format(DATAPOINT_FIELDS)
+    # the columns, a comma after each but the last and the newline
+    RECORD_LENGTH: int = (
+        TIMESTAMP_WIDTH + sum(f.width for f in DATAPOINT_FIELDS) + len(FIELDS) + 1
+    )
 
     def to_dict(self) -> dict:
-        return {
-            "timestamp": self.timestamp,
-            "temperature": self.temperature,
-            "pressure": self.pressure,
-            "relative_humidity": self.relative_humidity,
-            "aqi": self.aqi,
-            "tvoc": self.tvoc,
-            "eCO2": self.eCO2,
-        }
+        data = {"timestamp": self.timestamp}
+        for name in DataPoint.FIELDS:
+            data[name] = getattr(self, name)
+        return data
 
     @staticmethod
     def from_dict(data: dict) -> "DataPoint":
-        return DataPoint(
-            timestamp=data["timestamp"],
-            temperature=data["temperature"],
-            pressure=data["pressure"],
-            relative_humidity=data["relative_humidity"],
-            aqi=data["aqi"],
-            tvoc=data["tvoc"],
-            eCO2=data["eCO2"],
-        )
+        dp = DataPoint(timestamp=data["timestamp"])
+        for name in DataPoint.FIELDS:
+            setattr(dp, name, data[name])
+        return dp
+
+    def clamp(self) -> bool:
+        """limit the fields to the values that fit their fixed-width CSV column
+
+        A wider value would shift every following record in the file. Returns whether any field was
+        changed."""
+        _clamped = False
+        for name in DataPoint.FIELDS:
+            low, high = DataPoint.LIMITS[name]
+            value = getattr(self, name)
+            if value < low:
+                setattr(self, name, low)
+                _clamped = True
+            elif value > high:
+                setattr(self, name, high)
+                _clamped = True
+        return _clamped
 
     def to_csv(self) -> str:
         # make sure the csv has a constant width in bytes
-        return f"{int(self.timestamp):10d},{self.temperature:-6.2f},{self.pressure:7.2f},{self.relative_humidity:5.2f},{self.aqi:1d},{self.tvoc:4d},{self.eCO2:4d}\n"
+        values = [int(self.timestamp)]
+        for name in DataPoint.FIELDS:
+            values.append(getattr(self, name))
+        return DataPoint._CSV_FORMAT % tuple(values)
 
     @staticmethod
-    def from_csv(data: str) -> "DataPoint":
-        timestamp, temperature, pressure, relative_humidity, aqi, tvoc, eCO2 = (
-            data.split(",")
-        )
-        return DataPoint(
-            timestamp=Timestamp.from_str(timestamp),
-            temperature=float(temperature),
-            pressure=float(pressure),
-            relative_humidity=float(relative_humidity),
-            aqi=int(aqi),
-            tvoc=int(tvoc),
-            eCO2=int(eCO2),
-        )
+    def from_csv(data: str, into: "DataPoint" = None) -> "DataPoint":
+        """parse a line of to_csv(); with into given, that data point (and its timestamp) is updated
+        and returned instead of a new one"""
+        values = data.split(",")
+        if into is None:
+            into = DataPoint(timestamp=Timestamp.from_str(values[0]))
+        else:
+            into.set_timestamp(int(values[0]))
+        for i in range(len(DataPoint.FIELDS)):
+            setattr(into, DataPoint.FIELDS[i], DataPoint.TYPES[i](values[i + 1]))
+        return into
+
+    def set_timestamp(self, timestamp: int):
+        """set the timestamp, reusing the Timestamp object if there is one"""
+        if isinstance(self.timestamp, Timestamp):
+            self.timestamp.timestamp = timestamp
+        else:
+            self.timestamp = Timestamp(timestamp)
@@ -0,0 +1,211 @@
+import time
+
+try:
+    from time import ticks_diff, ticks_us
+except ImportError:
+    # CPython, for the tests and the tools in util/
+
+    def ticks_us() -> int:
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end: int, start: int) -> int:
+        return end - start
+
+
+# the scale of histograms recording microseconds, to expose them in seconds
+MICROSECONDS = 1e-6
+
+# upper bounds in microseconds for the latency of an operation of the station: 1 ms to 5 s
+LATENCY_BUCKETS = (
+    1000,
+    2000,
+    5000,
+    10000,
+    20000,
+    50000,
+    100000,
+    200000,
+    500000,
+    1000000,
+    5000000,
+)
+
+# upper bounds in bytes for the size of a response: 1 KB to 4 MB
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# values are kept as a multiple of _CARRY plus a remainder, so that both stay small integers, which
+# MicroPython does not allocate
+_CARRY = 1 << 29
+
+
+class Counter:
+    """A count that only goes up, e.g. of requests or of bytes read. inc() does not allocate."""
+
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, read=None):
+        self.name = name
+        self.help = help
+        # a function returning the value when it is kept elsewhere, e.g. WebServer.requests
+        self._read = read
+        self._high = 0
+        self._low = 0
+
+    def inc(self, n: int = 1):
+        self._low += n
+        if self._low >= _CARRY:
+            self._high += self._low // _CARRY
+            self._low %= _CARRY
+
+    @property
+    def value(self) -> int:
+        if self._read is not None:
+            return self._read()
+        return self._high * _CARRY + self._low
+
+    def samples(self):
+        value = self.value
+        if value is not None:
+            yield "%s %s\n" % (self.name, _number(value))
+
+
+class Gauge:
+    """A value that goes up and down, e.g. free memory; read at every scrape when given a function."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name: str, help: str, read=None):
+        self.name = name
+        self.help = help
+        self._read = read
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self._read is not None:
+            return self._read()
+        return self._value
+
+    def samples(self):
+        value = self.value
+        if value is not None:
+            yield "%s %s\n" % (self.name, _number(value))
+
+
+class Histogram:
+    """The distribution of integer observations, e.g. latencies in microseconds, in fixed buckets.
+
+    The counts of the buckets are allocated when the histogram is created and observe() only
+    increments small integers, so recording a value never allocates. The buckets, the sum and the
+    values are multiplied by scale when exposed (MICROSECONDS to expose seconds)."""
+
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, scale: float = 1):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.scale = scale
+        # the count of each bucket, then of the values above the last one
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum_high = 0
+        self._sum_low = 0
+
+    def observe(self, value: int):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self._counts[i] += 1
+        self._sum_low += value
+        if self._sum_low >= _CARRY:
+            self._sum_high += self._sum_low // _CARRY
+            self._sum_low %= _CARRY
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    @property
+    def sum(self) -> int:
+        return self._sum_high * _CARRY + self._sum_low
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            yield '%s_bucket{le="%s"} %d\n' % (
+                self.name,
+                _number(bound * self.scale),
+                cumulative,
+            )
+        yield '%s_bucket{le="+Inf"} %d\n' % (self.name, self.count)
+        yield "%s_sum %s\n" % (self.name, _number(self.sum * self.scale))
+        yield "%s_count %d\n" % (self.name, self.count)
+
+
+class Registry:
+    """The metrics of the station, exposed at /metrics (see server.route_metrics).
+
+    Metrics are created once, when the modules measuring them are imported (or by main.py for the
+    ones of the device), and recorded into from then on."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        for existing in self._metrics:
+            if existing.name == metric.name:
+                raise ValueError("metric %s exists already" % metric.name)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, read=None) -> Counter:
+        return self._add(Counter(name, help, read))
+
+    def gauge(self, name: str, help: str, read=None) -> Gauge:
+        return self._add(Gauge(name, help, read))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple = LATENCY_BUCKETS,
+        scale: float = MICROSECONDS,
+    ) -> Histogram:
+        return self._add(Histogram(name, help, buckets, scale))
+
+    def get(self, name: str):
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def expose(self):
+        """yield the metrics in the Prometheus text format, a metric at a time"""
+        for metric in self._metrics:
+            lines = [
+                "# HELP %s %s\n" % (metric.name, metric.help),
+                "# TYPE %s %s\n" % (metric.name, metric.TYPE),
+            ]
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                # e.g. a card that was removed; the other metrics are still worth scraping
+                print("Failed to read metric %s: %r" % (metric.name, e))
+                continue
+            yield "".join(lines)
+
+
+def _number(value) -> str:
+    if isinstance(value, int):
+        return "%d" % value
+    return "%.10g" % value
+
+
+# the registry of the station
+REGISTRY = Registry()
@@ -0,0 +1,178 @@
+import struct
+
+from measurements import DataPoint, Timestamp
+from schema import DATAPOINT_FIELDS, TIMESTAMP_WIDTH
+
+
+def _spans(widths: tuple) -> tuple:
+    """(start, end) of each column of a line with the given widths separated by commas"""
+    spans = []
+    _start = 0
+    for width in widths:
+        spans.append((_start, _start + width))
+        _start += width + 1
+    return tuple(spans)
+
+
+class CsvFormat:
+    """The original text layout: a CSV header followed by fixed-width lines (see DataPoint.to_csv).
+
+    Every value sits at a known offset in its line, so a single record or a timestamp is parsed by
+    slicing out just the characters it needs."""
+
+    HEADER: bytes = DataPoint.CSV_HEADER.encode()
+    HEADER_LENGTH: int = DataPoint.HEADER_LENGTH
+    RECORD_LENGTH: int = DataPoint.RECORD_LENGTH
+
+    # (start, end) in a line of the timestamp and of each field, in the widths of DataPoint.to_csv()
+    _SPANS = _spans((TIMESTAMP_WIDTH,) + tuple(f.width for f in DATAPOINT_FIELDS))
+    _TIMESTAMP_LENGTH = _SPANS[0][1]
+
+    @staticmethod
+    def encode(data: DataPoint) -> bytes:
+        return data.to_csv().encode()
+
+    @staticmethod
+    def encode_into(data: DataPoint, buf: bytearray):
+        """append the record of data to buf"""
+        buf.extend(data.to_csv().encode())
+
+    @staticmethod
+    def decode(
+        buf, offset: int, fields: tuple = None, into: DataPoint = None
+    ) -> DataPoint:
+        """decode the record at offset; with into given, that data point is updated and returned"""
+        end = offset + CsvFormat.RECORD_LENGTH
+        line = bytes(buf[offset:end]).decode()
+        dp = into if into is not None else DataPoint()
+        dp.set_timestamp(int(line[: CsvFormat._TIMESTAMP_LENGTH]))
+        for j in range(len(DataPoint.FIELDS)):
+            name = DataPoint.FIELDS[j]
+            if fields is not None and name not in fields:
+                setattr(dp, name, None)
+                continue
+            _start, _end = CsvFormat._SPANS[j + 1]
+            setattr(dp, name, DataPoint.TYPES[j](line[_start:_end]))
+        return dp
+
+    @staticmethod
+    def columns(buf, n: int, indexes: list) -> tuple:
+        """return the timestamps of the records in the first n bytes of buf and a list of the values of
+        each field with the given indexes (in DataPoint.FIELDS)
+
+        The chunk is decoded and split once and only the requested columns are parsed; no DataPoint is
+        built. (Slicing each value out of the decoded chunk at its offset in _SPANS instead is slower
+        on CPython, even for one column, and close to twice as slow for all of them, as the split runs
+        in C.)"""
+        # the timestamp and the fields of each line, then an empty string after the last newline
+        values = bytes(buf[:n]).decode().replace("\n", ",").split(",")
+        _end = len(values) - 1
+        _step = len(DataPoint.FIELDS) + 1
+        timestamps = list(map(int, values[0:_end:_step]))
+        columns = []
+        for j in indexes:
+            _first = j + 1
+            columns.append(list(map(DataPoint.TYPES[j], values[_first:_end:_step])))
+        return timestamps, columns
+
+    @staticmethod
+    def timestamp(buf, offset: int) -> int:
+        """parse only the timestamp of the record at offset, e.g. for a search probe"""
+        end = offset + CsvFormat._TIMESTAMP_LENGTH
+        return int(bytes(buf[offset:end]))
+
+
+def _layout(fields: tuple) -> tuple:
+    """(name, struct code, offset within the record, fixed-point scale) of each schema.Field, in a
+    record starting with a 4-byte timestamp"""
+    layout = []
+    _offset = 4
+    for field in fields:
+        layout.append((field.name, "<" + field.code, _offset, field.scale))
+        _offset += field.size
+    return tuple(layout)
+
+
+class BinaryFormat:
+    """Fixed-size little-endian records packed with struct.
+
+    Fractional values are stored as fixed-point integers (two decimal places, the same precision as the CSV
+    layout), so a record is 17 bytes instead of 44 and a single field can be decoded without touching the
+    rest of the record."""
+
+    HEADER: bytes = b"AIRDB\x01\x00\x00"
+    HEADER_LENGTH: int = len(HEADER)
+
+    # name, struct code, offset within the record, fixed-point scale
+    _FIELDS = _layout(DATAPOINT_FIELDS)
+    # struct layout of a whole record: the timestamp followed by the fields above
+    RECORD = "<I" + "".join(f.code for f in DATAPOINT_FIELDS)
+    RECORD_LENGTH: int = struct.calcsize(RECORD)
+    _EMPTY = bytes(RECORD_LENGTH)
+
+    @staticmethod
+    def encode(data: DataPoint) -> bytes:
+        values = [int(data.timestamp)]
+        for name, _, _, scale in BinaryFormat._FIELDS:
+            value = getattr(data, name)
+            values.append(round(value * scale) if scale != 1 else value)
+        return struct.pack(BinaryFormat.RECORD, *values)
+
+    @staticmethod
+    def encode_into(data: DataPoint, buf: bytearray):
+        """append the record of data to buf, packing the values in place"""
+        _offset = len(buf)
+        buf.extend(BinaryFormat._EMPTY)
+        struct.pack_into("<I", buf, _offset, int(data.timestamp))
+        for name, code, field_offset, scale in BinaryFormat._FIELDS:
+            value = getattr(data, name)
+            if scale != 1:
+                value = round(value * scale)
+            struct.pack_into(code, buf, _offset + field_offset, value)
+
+    @staticmethod
+    def decode(
+        buf, offset: int, fields: tuple = None, into: DataPoint = None
+    ) -> DataPoint:
+        """decode the record at offset; with into given, that data point is updated and returned"""
+        if into is None:
+            dp = DataPoint(timestamp=Timestamp(BinaryFormat.timestamp(buf, offset)))
+        else:
+            dp = into
+            dp.set_timestamp(BinaryFormat.timestamp(buf, offset))
+        for name, code, field_offset, scale in BinaryFormat._FIELDS:
+            if fields is not None and name not in fields:
+                if into is not None:
+                    setattr(dp, name, None)
+                continue
+            value = struct.unpack_from(code, buf, offset + field_offset)[0]
+            setattr(dp, name, value / scale if scale != 1 else value)
+        return dp
+
+    @staticmethod
+    def columns(buf, n: int, indexes: list) -> tuple:
+        """return the timestamps of the records in the first n bytes of buf and a list of the values of
+        each field with the given indexes (in DataPoint.FIELDS)"""
+        records = [
+            struct.unpack_from(BinaryFormat.RECORD, buf, offset)
+            for offset in range(0, n, BinaryFormat.RECORD_LENGTH)
+        ]
+        columns = []
+        for j in indexes:
+            scale = BinaryFormat._FIELDS[j][3]
+            if scale != 1:
+                columns.append([r[j + 1] / scale for r in records])
+            else:
+                columns.append([r[j + 1] for r in records])
+        return [r[0] for r in records], columns
+
+    @staticmethod
+    def timestamp(buf, offset: int) -> int:
+        return struct.unpack_from("<I", buf, offset)[0]
+
+
+def detect_format(header: bytes):
+    """return the record format of a database file given its first bytes"""
+    if header.startswith(BinaryFormat.HEADER):
+        return BinaryFormat
+    return CsvFormat
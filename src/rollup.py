@@ -0,0 +1,213 @@
+import os
+import struct
+
+from measurements import DataPoint, Timestamp
+
+# resolutions of the rollup tiers kept by DB, in seconds
+TIERS = (
+    ("1m", 60),
+    ("10m", 600),
+    ("1h", 3600),
+)
+
+_MAGIC = b"AIRRU\x01"
+_HEADER = "<6sI"
+_HEADER_LENGTH = struct.calcsize(_HEADER)
+
+# bucket start and number of samples, then the min, max and mean of each field
+_RECORD = "<IH" + "fff" * len(DataPoint.FIELDS)
+_RECORD_LENGTH = struct.calcsize(_RECORD)
+
+_COLUMNS = ["timestamp"]
+_COLUMNS.extend(DataPoint.FIELDS)
+_COLUMNS.extend(f + "_min" for f in DataPoint.FIELDS)
+_COLUMNS.extend(f + "_max" for f in DataPoint.FIELDS)
+_COLUMNS.append("count")
+CSV_HEADER: str = ",".join(_COLUMNS) + "\n"
+
+
+class Bucket:
+    """Minimum, maximum, mean and number of samples of each DataPoint field over a time bucket.
+
+    The mean columns are named after the fields, so a rollup CSV plots like the raw data.
+    """
+
+    def __init__(self, start: int):
+        self.start = start
+        self.count = 0
+        self.min = [None] * len(DataPoint.FIELDS)
+        self.max = [None] * len(DataPoint.FIELDS)
+        self.sum = [0.0] * len(DataPoint.FIELDS)
+
+    def add(self, data: DataPoint):
+        self.count += 1
+        for i in range(len(DataPoint.FIELDS)):
+            value = getattr(data, DataPoint.FIELDS[i])
+            if self.min[i] is None or value < self.min[i]:
+                self.min[i] = value
+            if self.max[i] is None or value > self.max[i]:
+                self.max[i] = value
+            self.sum[i] += value
+
+    def mean(self, i: int) -> float:
+        return self.sum[i] / self.count
+
+    def pack(self) -> bytes:
+        values = []
+        for i in range(len(DataPoint.FIELDS)):
+            values.extend((self.min[i], self.max[i], self.mean(i)))
+        return struct.pack(_RECORD, self.start, self.count, *values)
+
+    @staticmethod
+    def unpack(buf, offset: int = 0) -> "Bucket":
+        values = struct.unpack_from(_RECORD, buf, offset)
+        bucket = Bucket(values[0])
+        bucket.count = values[1]
+        for i in range(len(DataPoint.FIELDS)):
+            j = 2 + 3 * i
+            bucket.min[i] = values[j]
+            bucket.max[i] = values[j + 1]
+            bucket.sum[i] = values[j + 2] * bucket.count
+        return bucket
+
+    def to_csv(self) -> str:
+        columns = [str(self.start)]
+        columns.extend("%.2f" % self.mean(i) for i in range(len(DataPoint.FIELDS)))
+        columns.extend("%.2f" % v for v in self.min)
+        columns.extend("%.2f" % v for v in self.max)
+        columns.append(str(self.count))
+        return ",".join(columns) + "\n"
+
+
+class Tier:
+    """A file of fixed-width rollup records, one per bucket of `seconds` that contains samples.
+
+    Samples are added one at a time; the open bucket is kept in memory and closed when a sample for a
+    later bucket arrives, so the tier never has to be recomputed. Closed buckets are kept in memory as
+    well until flush(), which DB calls when it writes its own buffered records, so the card is written
+    to as rarely as DB is configured to. Buckets lost in a reset are rebuilt by catch_up() from the
+    records, which DB recovers from its backup first."""
+
+    def __init__(self, path: str, seconds: int):
+        self._path = path
+        self.seconds = seconds
+        self._open = None
+        # the packed buckets closed since the last flush()
+        self._closed = bytearray()
+
+        try:
+            self._size = os.stat(path)[6]
+        except OSError:
+            self._size = 0
+
+        if (self._size - _HEADER_LENGTH) % _RECORD_LENGTH:
+            # a torn write; the tier is derived data, so start over and let catch_up() rebuild it
+            self._size = 0
+        if self._size < _HEADER_LENGTH:
+            with open(path, "wb") as f:
+                f.write(struct.pack(_HEADER, _MAGIC, seconds))
+            self._size = _HEADER_LENGTH
+
+        # start of the first bucket that is not in the file yet
+        self._next_start = None
+        if self._size > _HEADER_LENGTH:
+            with open(path, "rb") as f:
+                f.seek(self._size - _RECORD_LENGTH)
+                self._next_start = struct.unpack("<I", f.read(4))[0] + seconds
+
+    def catch_up(self, db):
+        """add the samples of db that are newer than the last bucket in the file
+
+        After a reset this only re-reads the samples of the bucket that was open; for a new tier it
+        reads the whole database once."""
+        _from = None
+        if self._next_start is not None:
+            # range reads start at the newest record not after _from and skip a bound equal to the
+            # last record, so ask for one second earlier; add() drops the samples already summarised
+            _from = Timestamp(self._next_start - 1)
+        for data in db.iter_range(_from=_from):
+            self.add(data)
+
+    def add(self, data: DataPoint):
+        _timestamp = int(data.timestamp)
+        _start = _timestamp - _timestamp % self.seconds
+
+        if self._open is not None and _start != self._open.start:
+            if _start < self._open.start:
+                # the clock went back; the sample cannot be placed in a closed bucket
+                return
+            self._close()
+
+        if self._open is None:
+            if self._next_start is not None and _start < self._next_start:
+                return
+            self._open = Bucket(_start)
+        self._open.add(data)
+
+    def _close(self):
+        self._closed.extend(self._open.pack())
+        self._next_start = self._open.start + self.seconds
+        self._open = None
+
+    def flush(self):
+        """append the closed buckets to the file"""
+        if not self._closed:
+            return
+        with open(self._path, "ab") as f:
+            f.write(self._closed)
+        self._size += len(self._closed)
+        self._closed = bytearray()
+
+    def iter_range(self, _from: Timestamp = None, _to: Timestamp = None):
+        """yield the buckets starting within [_from, _to), including the closed ones that are not in the
+        file yet and the open one"""
+        _from = None if _from is None else int(_from)
+        _to = None if _to is None else int(_to)
+
+        buf = bytearray(_RECORD_LENGTH * 16)
+        mv = memoryview(buf)
+        with open(self._path, "rb") as f:
+            _offset = self._first_offset(f, _from)
+            f.seek(_offset)
+            while _offset < self._size:
+                n = f.readinto(mv[: min(len(buf), self._size - _offset)])
+                if not n:
+                    break
+                _offset += n
+                for i in range(0, n - _RECORD_LENGTH + 1, _RECORD_LENGTH):
+                    bucket = Bucket.unpack(mv, i)
+                    if _to is not None and bucket.start >= _to:
+                        return
+                    yield bucket
+
+        closed = bytes(self._closed)
+        for i in range(0, len(closed), _RECORD_LENGTH):
+            bucket = Bucket.unpack(closed, i)
+            if _from is not None and bucket.start < _from:
+                continue
+            if _to is not None and bucket.start >= _to:
+                return
+            yield bucket
+
+        if self._open is not None:
+            if _from is None or self._open.start >= _from:
+                if _to is None or self._open.start < _to:
+                    yield self._open
+
+    def _first_offset(self, f, _from: int) -> int:
+        """offset of the first bucket starting at or after _from (bisection over the bucket starts)"""
+        _low = 0
+        _high = (self._size - _HEADER_LENGTH) // _RECORD_LENGTH
+        if _from is None:
+            return _HEADER_LENGTH
+
+        ts = bytearray(4)
+        while _low < _high:
+            _mid = (_low + _high) // 2
+            f.seek(_HEADER_LENGTH + _mid * _RECORD_LENGTH)
+            f.readinto(ts)
+            if struct.unpack("<I", ts)[0] < _from:
+                _low = _mid + 1
+            else:
+                _high = _mid
+        return _HEADER_LENGTH + _low * _RECORD_LENGTH
@@ -0,0 +1,87 @@
+import struct
+
+
+class Field:
+    """A measurement: its name, the struct code it is stored as and its fixed-point scale.
+
+    Values are stored as round(value * scale), clamped to the range of the code. The smallest value of
+    a signed code and the largest value of an unsigned one mark a missing value, e.g. a reading from a
+    sensor that was not connected or a sample taken before the field was added.
+
+    The fields of DataPoint also have the width of their column in its fixed-width CSV lines (see
+    DataPoint.to_csv), with as many decimal places as the scale has zeros."""
+
+    def __init__(self, name: str, code: str, scale: int = 1, width: int = None):
+        self.name = name
+        self.code = code
+        self.scale = scale
+        self.width = width
+        self.decimals = len(str(scale)) - 1
+        self.size = struct.calcsize("<" + code)
+        _bits = 8 * self.size
+        if code.islower():
+            self.missing = -(1 << (_bits - 1))
+            self.low, self.high = self.missing + 1, (1 << (_bits - 1)) - 1
+        else:
+            self.missing = (1 << _bits) - 1
+            self.low, self.high = 0, self.missing - 1
+
+    def encode(self, value) -> int:
+        if value is None:
+            return self.missing
+        value = round(value * self.scale) if self.scale != 1 else int(value)
+        return min(max(value, self.low), self.high)
+
+    def decode(self, value: int):
+        if value == self.missing:
+            return None
+        return value / self.scale if self.scale != 1 else value
+
+    def to_line(self) -> str:
+        return "%s,%s,%d" % (self.name, self.code, self.scale)
+
+    @staticmethod
+    def from_line(line: str) -> "Field":
+        name, code, scale = line.strip().split(",")
+        return Field(name, code, int(scale))
+
+
+# the width of the timestamp column of the CSV lines of DataPoint
+TIMESTAMP_WIDTH = 10
+
+# the fields of measurements.DataPoint (BME280 and ENS160), which DataPoint.FIELDS, its CSV layout and
+# the layout of records.BinaryFormat are derived from
+DATAPOINT_FIELDS = (
+    Field("temperature", "h", 100, 6),
+    Field("pressure", "I", 100, 7),
+    Field("relative_humidity", "H", 100, 5),
+    Field("aqi", "B", 1, 1),
+    Field("tvoc", "H", 1, 4),
+    Field("eCO2", "H", 1, 4),
+)
+
+# the readings of a PMS7003 (see devices.pms7003), named after its keys: concentrations in µg/m³ with
+# the CF=1 and atmospheric calibrations, then the number of particles above each size in 0.1 l of air
+PMS7003_FIELDS = (
+    Field("PM1_0", "H"),
+    Field("PM2_5", "H"),
+    Field("PM10_0", "H"),
+    Field("PM1_0_ATM", "H"),
+    Field("PM2_5_ATM", "H"),
+    Field("PM10_0_ATM", "H"),
+    Field("PCNT_0_3", "H"),
+    Field("PCNT_0_5", "H"),
+    Field("PCNT_1_0", "H"),
+    Field("PCNT_2_5", "H"),
+    Field("PCNT_5_0", "H"),
+    Field("PCNT_10_0", "H"),
+)
+
+# PM10 and PM2.5 in µg/m³ from the nearest sensor.community station
+COMMUNITY_FIELDS = (
+    Field("community_pm10", "H", 10),
+    Field("community_pm25", "H", 10),
+)
+
+# everything the station measures; columns.ColumnStore keeps one file per field
+SCHEMA = DATAPOINT_FIELDS + PMS7003_FIELDS + COMMUNITY_FIELDS
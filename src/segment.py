@@ -0,0 +1,423 @@
+from index import TimestampIndex
+from measurements import DataPoint, Timestamp
+from records import BinaryFormat, CsvFormat, detect_format
+import os
+
+# number of records fetched from the file with a single readinto() call
+READ_CHUNK_RECORDS = 32
+
+# records read around each guess of the interpolation search
+PROBE_RECORDS = 16
+# interpolation guesses made before the search falls back to bisection
+MAX_INTERPOLATION_PROBES = 4
+
+
+class Segment:
+    """A single file of fixed-width records in ascending timestamp order, with its index sidecar.
+
+    DB stores its data in one or more segments and takes care of buffering, partitioning and merging
+    them; a segment only knows how to append records and find them again."""
+
+    def __init__(
+        self,
+        path: str,
+        binary: bool = False,
+        index: bool = True,
+        cadence: int = 30,
+        cache=None,
+    ):
+        """open the segment at path, creating it if it does not exist
+
+        cadence is the expected number of seconds between records; it is only a hint for the
+        interpolation search used when the segment has no index (pass 0 to always bisect).
+
+        With a cache (see cache.BlockCache), the file is read in blocks of READ_CHUNK_RECORDS records
+        which are kept there for the next read.
+        """
+        self.path = path
+        self._cadence = cadence
+        self.cache = cache
+        # number of reads issued to the file, for benchmarking seeks
+        self.reads = 0
+
+        try:
+            self.size = os.stat(path)[6]
+        except OSError:
+            self.size = 0
+
+        self.format = BinaryFormat if binary else CsvFormat
+        if self.size:
+            with open(path, "rb") as f:
+                _format = detect_format(f.read(BinaryFormat.HEADER_LENGTH))
+            if self.size >= _format.HEADER_LENGTH:
+                self.format = _format
+        if self.size < self.format.HEADER_LENGTH:
+            # a new file, or the header was torn before any record was written
+            with open(path, "wb") as f:
+                f.write(self.format.HEADER)
+            self.size = self.format.HEADER_LENGTH
+
+        self._record = bytearray(self.format.RECORD_LENGTH)
+        self._block_length = READ_CHUNK_RECORDS * self.format.RECORD_LENGTH
+        _size = self.size
+        _rewritten = self._check_tail()
+        if cache is not None and (_rewritten or self.size != _size):
+            cache.invalidate(path)
+        self.first_ts = None
+        self.last_ts = None
+        if self.size > self.format.HEADER_LENGTH:
+            with open(path, "rb") as f:
+                self.first_ts = self._read_timestamp(f, self.format.HEADER_LENGTH)
+                self.last_ts = self._read_timestamp(
+                    f, self.size - self.format.RECORD_LENGTH
+                )
+
+        self._index = None
+        if index:
+            self._index = TimestampIndex(path + ".idx")
+            if _rewritten:
+                self._index.clear()
+            self._sync_index()
+
+    def _check_tail(self) -> bool:
+        """make sure the file ends with a whole record, repairing it after a torn write
+
+        Only the last record is read, so this takes the same time however large the file is. A partial
+        record left by a reset in the middle of a write is cut off where the file system can truncate
+        files, and overwritten with a copy of the previous record where it cannot (MicroPython). A CSV
+        file whose last line is not where the fixed record width puts it has a wider line somewhere
+        (written before DB clamped the values) and is rewritten once; returns whether that happened.
+        """
+        _header_length = self.format.HEADER_LENGTH
+        _record_length = self.format.RECORD_LENGTH
+        _end = self.size - (self.size - _header_length) % _record_length
+
+        if self.format is CsvFormat and _end > _header_length:
+            # the last whole record has to be a line: preceded by a newline and ending with one
+            with open(self.path, "rb") as f:
+                f.seek(_end - _record_length - 1)
+                tail = f.read(_record_length + 1)
+                self.reads += 1
+            if tail[0] != 0x0A or tail[-1] != 0x0A:
+                self._realign()
+                return True
+
+        if _end < self.size:
+            if _end == _header_length:
+                # not even one whole record to keep
+                with open(self.path, "wb") as f:
+                    f.write(self.format.HEADER)
+            else:
+                with open(self.path, "r+b") as f:
+                    if hasattr(f, "truncate"):
+                        f.truncate(_end)
+                    else:
+                        f.seek(_end - _record_length)
+                        f.readinto(self._record)
+                        f.write(self._record)
+                        _end += _record_length
+            self.size = _end
+        return False
+
+    def _realign(self):
+        """rewrite the records of a CSV file with lines of the wrong width, clamping their values"""
+        _tmp = self.path + ".tmp"
+        with open(self.path, "rb") as src:
+            with open(_tmp, "wb") as dst:
+                dst.write(self.format.HEADER)
+                src.seek(self.format.HEADER_LENGTH)
+                for line in src:
+                    if not line.endswith(b"\n"):
+                        # torn write at the end of the file
+                        break
+                    try:
+                        data = DataPoint.from_csv(line.decode())
+                    except ValueError:
+                        continue
+                    data.clamp()
+                    dst.write(data.to_csv().encode())
+        os.remove(self.path)
+        os.rename(_tmp, self.path)
+        self.size = os.stat(self.path)[6]
+
+    def append(self, data: bytes):
+        """append encoded records to the file and the index"""
+        _offset = self.size
+        if self.cache is not None:
+            # the last block may have been cached before it was full
+            _block = (_offset - self.format.HEADER_LENGTH) // self._block_length
+            self.cache.invalidate(self.path, _block)
+        with open(self.path, "ab") as f:
+            f.write(data)
+
+        for i in range(0, len(data), self.format.RECORD_LENGTH):
+            _timestamp = self.format.timestamp(data, i)
+            if self.first_ts is None:
+                self.first_ts = _timestamp
+            self.last_ts = _timestamp
+            if self._index is not None:
+                self._index.add(_timestamp, _offset + i)
+        self.size += len(data)
+
+    def remove(self):
+        """delete the file and its index"""
+        os.remove(self.path)
+        if self.cache is not None:
+            self.cache.invalidate(self.path)
+        if self._index is not None:
+            self._index.clear()
+
+    def iter_chunks(self, _from_offset: int, _to_offset: int, buf):
+        """read the records between the given offsets into buf, yielding the number of bytes read
+
+        Only whole records are counted; buf is overwritten by each chunk."""
+        with open(self.path, "rb") as f:
+            for n in self._read_chunks(f, _from_offset, _to_offset, buf):
+                yield n
+
+    def seek(self, look_for: Timestamp) -> int:
+        """find the offset of the record with the given timestamp, using the index when there is one
+
+        Like _find_timestamp_offset, this returns the offset of the last record not newer than look_for,
+        the first record if look_for precedes it, or the end of the file if look_for is not older than the
+        last record."""
+        if self._index is None or self._index.count == 0:
+            if self._cadence:
+                return self._interpolation_offset(look_for)
+            return self._find_timestamp_offset(look_for)
+
+        look_for = int(look_for)
+        if look_for >= self.last_ts:
+            return self.size
+        if look_for <= self.first_ts:
+            return self.format.HEADER_LENGTH
+
+        _record_length = self.format.RECORD_LENGTH
+        _low, _high = self._index.bracket(look_for, self.size)
+        # the record preceding the slot is the answer when the slot starts after look_for
+        _low = max(_low - _record_length, self.format.HEADER_LENGTH)
+
+        _found = _low
+        with open(self.path, "rb") as f:
+            for offset, ts in self._iter_timestamps(f, _low, _high):
+                if ts > look_for:
+                    break
+                _found = offset
+        return _found
+
+    def _read_chunks(self, f, _from_offset: int, _to_offset: int, buf):
+        """iter_chunks() on an open file"""
+        _record_length = self.format.RECORD_LENGTH
+        mv = memoryview(buf)
+        if self.cache is None:
+            f.seek(_from_offset)
+
+        _offset = _from_offset
+        while _offset < _to_offset:
+            _wanted = min(len(buf), _to_offset - _offset)
+            if self.cache is None:
+                n = f.readinto(mv[:_wanted])
+                self.reads += 1
+            else:
+                _block, i = divmod(
+                    _offset - self.format.HEADER_LENGTH, self._block_length
+                )
+                data = self._cached_block(f, _block)
+                n = max(min(len(data) - i, _wanted), 0)
+                _end = i + n
+                mv[:n] = memoryview(data)[i:_end]
+            if not n:
+                break
+            n -= n % _record_length
+            if not n:
+                break
+            _offset += n
+            yield n
+
+    def _cached_block(self, f, block: int) -> bytes:
+        """the records of a block, from the cache or read from the file and added to the cache"""
+        data = self.cache.get(self.path, block)
+        if data is None:
+            _start = self.format.HEADER_LENGTH + block * self._block_length
+            _length = min(self._block_length, self.size - _start)
+            f.seek(_start)
+            data = f.read(_length - _length % self.format.RECORD_LENGTH)
+            self.reads += 1
+            self.cache.put(self.path, block, data)
+        return data
+
+    def _iter_timestamps(self, f, _from_offset: int, _to_offset: int):
+        """yield (offset, timestamp) for the records between the given offsets"""
+        buf = bytearray(self._block_length)
+        mv = memoryview(buf)
+
+        _offset = _from_offset
+        for n in self._read_chunks(f, _from_offset, _to_offset, buf):
+            for i in range(0, n, self.format.RECORD_LENGTH):
+                yield _offset + i, self.format.timestamp(mv, i)
+            _offset += n
+
+    def _sync_index(self):
+        """bring the index up to date with the data file
+
+        Records appended after the last indexed slot (e.g. when the device was reset between writing a
+        record and its index entry) are indexed by scanning from that slot, which is at most one slot's
+        worth of records. An index that does not match the data file is rebuilt from scratch.
+        """
+        _index = self._index
+        _header_length = self.format.HEADER_LENGTH
+
+        with open(self.path, "rb") as f:
+            if _index.count and not self._index_matches(f):
+                _index.clear()
+
+            _start = _index.entry(_index.count - 1) if _index.count else _header_length
+            for offset, ts in self._iter_timestamps(f, _start, self.size):
+                _index.add(ts, offset)
+
+    def _index_matches(self, f) -> bool:
+        _index = self._index
+        _header_length = self.format.HEADER_LENGTH
+        _record_length = self.format.RECORD_LENGTH
+
+        _last = _index.entry(_index.count - 1)
+        if _last + _record_length > self.size:
+            return False
+        if (_last - _header_length) % _record_length:
+            return False
+        # the last entry has to point at the first record of the last indexed slot
+        if _index.slot(self._read_timestamp(f, _last)) < _index.count - 1:
+            return False
+        if _last > _header_length:
+            _previous = self._read_timestamp(f, _last - _record_length)
+            if _index.slot(_previous) >= _index.count - 1:
+                return False
+        return True
+
+    def _find_timestamp_offset(self, look_for: Timestamp) -> int:
+        """find the offset of the line with the given timestamp (a Timestamp or an int) using binary
+        search"""
+        look_for = int(look_for)
+        _header_length = self.format.HEADER_LENGTH
+        _record_length = self.format.RECORD_LENGTH
+        _low = _header_length
+        _high = self.size
+
+        with open(self.path, "rb") as f:
+            _last = self._read_timestamp(f, _high - _record_length)
+            if look_for >= _last:
+                return _high
+
+            _first = self._read_timestamp(f, _header_length)
+            if look_for <= _first:
+                return _header_length
+
+            # rewind to first record
+            f.seek(_header_length)
+
+            while _low < _high:
+                _mid = (_low + _high) // 2
+                _mid = self._align_to_record(_mid)
+
+                ts = self._read_timestamp(f, _mid)
+                if ts == look_for or _high - _low < _record_length:
+                    return _mid
+                elif ts < look_for:
+                    _low = _mid + 1
+                else:
+                    _high = _mid - 1
+
+        return -1
+
+    def _interpolation_offset(self, look_for: Timestamp) -> int:
+        """find the offset of the record with the given timestamp, guessing its position from the cadence
+
+        Records are written at a roughly fixed interval, so timestamps are close to linear in the file
+        offset. The first guess interpolates between the first and the last record; PROBE_RECORDS records
+        are read around each guess to absorb the jitter. When a guess misses because of an outage, the
+        next one counts records at the local cadence from the record read last, which jumps over the
+        outage. After MAX_INTERPOLATION_PROBES misses (irregular data) the search falls back to
+        bisection. Returns the same offset as _find_timestamp_offset.
+        """
+        look_for = int(look_for)
+        _header_length = self.format.HEADER_LENGTH
+        _record_length = self.format.RECORD_LENGTH
+        if self.last_ts is None:
+            return -1
+        if look_for >= self.last_ts:
+            return self.size
+        if look_for <= self.first_ts:
+            return _header_length
+
+        # invariant: the record at _low is not newer than look_for, the record at _high is newer
+        _low, _low_ts = 0, self.first_ts
+        _high = (self.size - _header_length) // _record_length - 1
+        _high_ts = self.last_ts
+
+        buf = bytearray(PROBE_RECORDS * _record_length)
+        mv = memoryview(buf)
+        _probes = 0
+        # the local interval between records, as a fraction, refined from every window read
+        _step, _step_records = self._cadence, 1
+        # side of the bracket that moved last; the next guess is counted from there
+        _from_low = True
+
+        with open(self.path, "rb") as f:
+            while _high - _low > 1:
+                if _probes < MAX_INTERPOLATION_PROBES:
+                    _span = _high_ts - _low_ts
+                    _expected = (_high - _low) * _step // _step_records
+                    if _probes == 0 or _span <= _expected * 9 // 8:
+                        # first guess, or no outage between the known records: interpolate
+                        _guess = _low + (look_for - _low_ts) * (_high - _low) // _span
+                    # otherwise count records at the local cadence from the record read last;
+                    # outages only matter if they fall between that record and the target
+                    elif _from_low:
+                        _guess = _low + (look_for - _low_ts) * _step_records // _step
+                    else:
+                        _guess = _high - (_high_ts - look_for) * _step_records // _step
+                else:
+                    _guess = (_low + _high) // 2
+                _probes += 1
+
+                _start = min(max(_guess - PROBE_RECORDS // 2, _low + 1), _high - 1)
+                _count = min(PROBE_RECORDS, _high - _start)
+                f.seek(_header_length + _start * _record_length)
+                f.readinto(mv[: _count * _record_length])
+                self.reads += 1
+
+                _from_low = True
+                for i in range(_count):
+                    ts = self.format.timestamp(mv, i * _record_length)
+                    if ts > look_for:
+                        _high, _high_ts = _start + i, ts
+                        _from_low = i > 0
+                        break
+                    _low, _low_ts = _start + i, ts
+
+                if _count > 1:
+                    _first = self.format.timestamp(mv, 0)
+                    _last = self.format.timestamp(mv, (_count - 1) * _record_length)
+                    if 0 < _last - _first <= (_count - 1) * self._cadence * 2:
+                        _step, _step_records = _last - _first, _count - 1
+
+        return _header_length + _low * _record_length
+
+    def _read_timestamp(self, f, offset) -> int:
+        f.seek(offset)
+        f.readinto(self._record)
+        self.reads += 1
+        return self.format.timestamp(self._record, 0)
+
+    def _align_to_record(self, _offset: int) -> int:
+        _from_header = _offset - self.format.HEADER_LENGTH
+        _num_records = _from_header // self.format.RECORD_LENGTH
+        return self.format.HEADER_LENGTH + (_num_records * self.format.RECORD_LENGTH)
+
+
+def exists(path: str) -> bool:
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
@@ -1,35 +1,661 @@
-from lib.microWebSrv import MicroWebSrv
-from measurements import Timestamp
+from live import Live, event
+from measurements import DataPoint, Timestamp
+from webserver import WebServer
+import asyncio
+import binascii
+import metrics
+import os
+import rollup
+import struct
+import wire
 
+rollup_resolutions = tuple(name for name, _ in rollup.TIERS)
 
-@MicroWebSrv.route("/time")
-def route_time(httpClient, httpResponse):
+# the server of the routes below; main.py starts it on the event loop of the sampling loop. A few
+# connections at a time (half of them may follow /live) and one query of the database, so a slow
+# download cannot run the station out of memory
+app = WebServer(max_connections=8, max_heavy=1)
+
+# the newest samples, for /live; main.py publishes every sample it inserts
+live = Live(max_subscribers=4)
+
+# seconds between the comments /live sends when there are no samples, to tell a client that went away
+# (the write fails) and to keep proxies from closing the stream
+HEARTBEAT = 15
+# seconds a /live subscriber may take to receive an event before it is dropped
+LIVE_WRITE_TIMEOUT = 10
+
+# how long /data takes and how much it sends, and what the server and the database are doing, for
+# /metrics
+_data_seconds = metrics.REGISTRY.histogram(
+    "airstation_http_data_seconds", "Time to answer a request of /data."
+)
+_data_bytes = metrics.REGISTRY.histogram(
+    "airstation_http_data_response_bytes",
+    "Bytes of the bodies of the responses of /data.",
+    metrics.SIZE_BUCKETS,
+    1,
+)
+metrics.REGISTRY.counter(
+    "airstation_http_requests_total", "Requests answered.", lambda: app.requests
+)
+metrics.REGISTRY.counter(
+    "airstation_http_rejected_total",
+    "Connections turned away because the server was full.",
+    lambda: app.rejected,
+)
+metrics.REGISTRY.gauge(
+    "airstation_http_connections", "Open connections.", lambda: app.connections
+)
+metrics.REGISTRY.gauge(
+    "airstation_live_subscribers", "Clients following /live.", lambda: live.subscribers
+)
+metrics.REGISTRY.counter(
+    "airstation_db_cache_hits_total",
+    "Reads of the database served by its block cache.",
+    lambda: _cache_stat("hits"),
+)
+metrics.REGISTRY.counter(
+    "airstation_db_cache_misses_total",
+    "Reads of the database that missed its block cache.",
+    lambda: _cache_stat("misses"),
+)
+
+# the most points /data?max_points= returns; the buckets of the downsampling take 4 bytes per point
+# and field
+MAX_POINTS = 2000
+
+# the longest bucket of /aggregate, in seconds: a month
+MAX_BUCKET = 31 * 86400
+
+# bytes of a file sent per write
+FILE_BLOCK = 1024
+
+# the content types of the files served from /www
+CONTENT_TYPES = {
+    "html": "text/html",
+    "js": "application/javascript",
+    "css": "text/css",
+    "csv": "text/csv",
+    "json": "application/json",
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "ico": "image/x-icon",
+}
+
+# the database written by the sampling loop; main.py shares its instance so that requests see the
+# unflushed records and reuse its block cache
+database = None
+
+
+# every measurement of the station, stored by column (see columns.ColumnStore); shared by main.py
+# when config.json enables "columns", None otherwise
+store = None
+
+
+def _time_range(queryParams: dict) -> tuple:
+    """the timestamps of ?from= and ?to=, None for a missing one; ValueError for a malformed one"""
+    _from = None
+    _to = None
+    if "from" in queryParams:
+        _from = Timestamp.from_str(queryParams["from"])
+    if "to" in queryParams:
+        _to = Timestamp.from_str(queryParams["to"])
+    return _from, _to
+
+
+def _database():
+    global database
+    if database is None:
+        import db
+
+        database = db.DB("/sd/data.csv", rollups=True, partition="month")
+    return database
+
+
+@app.route("/time")
+async def route_time(request, response):
     import utime
 
-    httpResponse.WriteResponseJSONOk(
+    await response.json(
         {
             "time": utime.localtime(),
         }
     )
 
 
-@MicroWebSrv.route("/data")
-def route_data(httpClient, httpResponse):
+def _cache_stat(name: str) -> int:
+    cache = database.cache if database is not None else None
+    return getattr(cache, name) if cache is not None else None
+
+
+@app.route("/data", heavy=True)
+async def route_data(request, response):
+    _start = metrics.ticks_us()
+    try:
+        await _route_data(request, response)
+    finally:
+        _data_seconds.observe(metrics.ticks_diff(metrics.ticks_us(), _start))
+        _data_bytes.observe(response.sent)
+
+
+async def _route_data(request, response):
+    queryParams = request.query
+
+    try:
+        _from, _to = _time_range(queryParams)
+    except ValueError:
+        await response.error(400)
+        return
+
+    resolution = queryParams.get("resolution", "raw")
+    if resolution != "raw" and resolution not in rollup_resolutions:
+        await response.error(400)
+        return
+
+    # format=bin: the records as the columns of wire.encode, for the dashboard; not for rollups
+    _format = queryParams.get("format", "csv")
+    if _format not in ("csv", "bin") or (_format == "bin" and resolution != "raw"):
+        await response.error(400)
+        return
+    binary = _format == "bin"
+
+    _db = _database()
+    # responses only depend on the query and the records, so a client that has the current ones is
+    # answered before anything is read
+    headers = {"ETag": _db.etag(), "Cache-Control": "no-cache"}
+    if await _not_modified(request, response, headers["ETag"]):
+        return
+
+    if "since" in queryParams:
+        # a client following the data: only the records it does not have yet, and the cursor to ask
+        # for the next ones with
+        _raw = resolution == "raw" and "max_points" not in queryParams
+        if _from is not None or _to is not None or not _raw:
+            await response.error(400)
+            return
+        try:
+            # an empty cursor (a client that has nothing yet) gets every record
+            cursor = int(queryParams["since"]) if queryParams["since"] else None
+            cursor, chunks = _db.since(cursor, raw=not binary)
+        except ValueError:
+            await response.error(400)
+            return
+
+        def _since_csv():
+            yield DataPoint.CSV_HEADER
+            for chunk in chunks:
+                yield chunk
+
+        headers["X-Cursor"] = "" if cursor is None else str(cursor)
+        if binary:
+            await _stream_bin(response, chunks, headers)
+        else:
+            await response.stream("text/csv", _since_csv(), headers)
+        return
+
+    points = None
+    if "max_points" in queryParams:
+        fields = DataPoint.FIELDS
+        if "fields" in queryParams:
+            fields = tuple(queryParams["fields"].split(","))
+        try:
+            max_points = int(queryParams["max_points"])
+            if max_points > MAX_POINTS or resolution != "raw":
+                raise ValueError()
+            points = _db.downsample(
+                _from, _to, max_points, fields, raw=not binary, pause=True
+            )
+        except ValueError:
+            await response.error(400)
+            return
+
+    def _csv():
+        yield DataPoint.CSV_HEADER
+        for chunk in _db.iter_range(_from=_from, _to=_to, raw=True):
+            yield chunk
+
+    def _downsampled_csv():
+        yield DataPoint.CSV_HEADER
+        lines = []
+        for line in points:
+            if line is None:
+                # a chunk was read and nothing picked from it yet: let the other tasks run
+                yield None
+                continue
+            lines.append(line)
+            if len(lines) == 16:
+                yield b"".join(lines)
+                lines = []
+        yield b"".join(lines)
+
+    def _rollup_csv():
+        yield rollup.CSV_HEADER
+        lines = []
+        for bucket in _db.iter_rollup(resolution, _from=_from, _to=_to):
+            lines.append(bucket.to_csv())
+            if len(lines) == 16:
+                yield "".join(lines)
+                lines = []
+        yield "".join(lines)
+
+    if binary:
+        if points is None:
+            points = _db.iter_range(_from=_from, _to=_to, reuse=True)
+        await _stream_bin(response, points, headers)
+    elif points is not None:
+        await response.stream("text/csv", _downsampled_csv(), headers)
+    elif resolution == "raw":
+        await response.stream("text/csv", _csv(), headers)
+    else:
+        await response.stream("text/csv", _rollup_csv(), headers)
+
+
+async def _stream_bin(response, records, headers: dict):
+    headers["X-Fields"] = wire.describe()
+    await response.stream("application/octet-stream", wire.encode(records), headers)
+
+
+@app.route("/live")
+async def route_live(request, response):
+    """stream every new sample as a server-sent event (text/event-stream)
+
+    Each event holds CSV lines as /data sends them and has the timestamp of the last one as its id.
+    The stream starts after ?since= (or the Last-Event-ID an EventSource sends when it reconnects), or
+    at the next sample; samples that are no longer in the ring of live.Live are read from the
+    database first. Subscribers that stop receiving are dropped."""
+    cursor = request.headers.get("last-event-id") or request.query.get("since")
+    try:
+        cursor = int(cursor) if cursor else live.newest()
+    except ValueError:
+        await response.error(400)
+        return
+    if live.subscribers >= live.max_subscribers:
+        await response.error(503, {"Retry-After": "%d" % HEARTBEAT})
+        return
+
+    live.subscribers += 1
+    response.keep_alive = False
+    try:
+        response.start(200, {"Cache-Control": "no-store"}, "text/event-stream")
+        if cursor is not None and not live.covers(cursor):
+            cursor = await _replay(response, cursor)
+        while True:
+            for timestamp, line in live.after(cursor):
+                await _send_event(response, event(timestamp, (line,)))
+                cursor = timestamp
+            if not await live.wait(cursor, HEARTBEAT):
+                await _send_event(response, ":\n\n")
+    except asyncio.TimeoutError:
+        # the client does not read what it is sent
+        pass
+    finally:
+        live.subscribers -= 1
+
+
+async def _replay(response, cursor: int) -> int:
+    """send the records of the database newer than cursor, 16 per event; return the new cursor
+
+    The records are read from the files as they are sent, so it takes its turn with the heavy routes.
+    """
+    await app.acquire_heavy()
+    try:
+        newest, records = _database().since(cursor)
+        lines = []
+        for dp in records:
+            lines.append(dp.to_csv().rstrip("\n"))
+            if len(lines) == 16:
+                await _send_event(response, event(int(dp.timestamp), lines))
+                lines = []
+        if lines:
+            await _send_event(response, event(newest, lines))
+    finally:
+        app.release_heavy()
+    return cursor if newest is None else newest
+
+
+async def _send_event(response, data: str):
+    await asyncio.wait_for(response.write(data), LIVE_WRITE_TIMEOUT)
+
+
+@app.route("/aggregate", heavy=True)
+async def route_aggregate(request, response):
     import db
 
-    queryParams = httpClient.GetRequestQueryParams()
+    queryParams = request.query
 
-    _from = None
-    _to = None
+    try:
+        _from, _to = _time_range(queryParams)
+    except ValueError:
+        await response.error(400)
+        return
 
-    if "from" in queryParams:
-        _from = Timestamp.from_str(queryParams["from"])
+    fields = DataPoint.FIELDS
+    if "fields" in queryParams:
+        fields = tuple(queryParams["fields"].split(","))
+    fns = db.AGGREGATES
+    if "fns" in queryParams:
+        fns = tuple(queryParams["fns"].split(","))
 
-    if "to" in queryParams:
-        _to = Timestamp.from_str(queryParams["to"])
+    _db = _database()
+    headers = {"ETag": _db.etag(), "Cache-Control": "no-cache"}
+    if await _not_modified(request, response, headers["ETag"]):
+        return
+
+    try:
+        bucket = int(queryParams.get("bucket", 3600))
+        if bucket > MAX_BUCKET:
+            raise ValueError()
+        buckets = _db.aggregate(_from, _to, bucket, fields, fns, pause=True)
+    except ValueError:
+        await response.error(400)
+        return
+
+    def _csv():
+        columns = ["timestamp"]
+        for name in fields:
+            columns.extend("%s_%s" % (name, fn) for fn in fns)
+        yield ",".join(columns) + "\n"
+
+        lines = []
+        for item in buckets:
+            if item is None:
+                # a chunk was read within a bucket: let the other tasks run
+                yield None
+                continue
+            start, values = item
+            columns = [str(start)]
+            columns.extend(
+                "%.2f" % v if isinstance(v, float) else str(v) for v in values
+            )
+            lines.append(",".join(columns) + "\n")
+            if len(lines) == 16:
+                yield "".join(lines)
+                lines = []
+        yield "".join(lines)
+
+    await response.stream("text/csv", _csv(), headers)
+
+
+@app.route("/columns", heavy=True)
+async def route_columns(request, response):
+    queryParams = request.query
+
+    try:
+        _from, _to = _time_range(queryParams)
+    except ValueError:
+        await response.error(400)
+        return
+
+    _columns = store
+    if _columns is None:
+        await response.error(404)
+        return
+    fields = None
+    if "fields" in queryParams:
+        fields = tuple(queryParams["fields"].split(","))
+        for name in fields:
+            if name not in _columns.fields:
+                await response.error(400)
+                return
+
+    await response.stream("text/csv", _columns.iter_csv(_from, _to, fields))
+
+
+@app.route("/stats")
+async def route_stats(request, response):
+    cache = _database().cache
+    await response.json(
+        {
+            "cache": cache.stats() if cache is not None else None,
+            "connections": app.connections,
+            "requests": app.requests,
+            "rejected": app.rejected,
+        }
+    )
+
+
+@app.route("/metrics")
+async def route_metrics(request, response):
+    """the metrics of metrics.REGISTRY in the Prometheus text format"""
+    await response.stream(
+        "text/plain; version=0.0.4",
+        metrics.REGISTRY.expose(),
+        {"Cache-Control": "no-store"},
+    )
+
+
+@app.route("/db", heavy=True)
+async def route_db(request, response):
+    """list the files of the database (name and size), or send the one named by ?file=
+
+    Files are sent as they are on the card, with Range support, so a mirror can resume an interrupted
+    download; records that are not flushed yet are in none of them."""
+    queryParams = request.query
+    _db = _database()
+    paths = _db.files()
+
+    if "file" not in queryParams:
+        headers = {"ETag": _db.etag(), "Cache-Control": "no-cache"}
+        if await _not_modified(request, response, headers["ETag"]):
+            return
+
+        def _csv():
+            yield "file,size\n"
+            for path in paths:
+                try:
+                    _size = os.stat(path)[6]
+                except OSError:
+                    continue
+                yield "%s,%d\n" % (path.rsplit("/", 1)[-1], _size)
+
+        await response.stream("text/csv", _csv(), headers)
+        return
+
+    path = _db_file(paths, queryParams["file"])
+    if path is None:
+        await response.error(404)
+        return
+    await _write_file(request, response, path, "application/octet-stream")
+
+
+@app.route("/raw", heavy=True)
+async def route_raw(request, response):
+    """stream a file of the database (?file=, the one being written to by default) from ?offset= on,
+    for keeping a copy up to date (see util/sync_db.py)
+
+    The bytes are sent as they are on the card, FILE_BLOCK at a time, each block preceded by its length
+    and CRC-32 (two little-endian 32-bit integers) and the last one followed by a block of length 0.
+    X-File-Size has the size the stream stops at. With ?check=, the CRC-32 of the FILE_BLOCK bytes
+    before the offset (fewer at the start of the file) as the client has them, a file that was rewritten
+    since (e.g. compressed, see db.DB.compact) is answered with 409 Conflict instead."""
+    queryParams = request.query
+    paths = _database().files()
+    if not paths:
+        await response.error(404)
+        return
+    path = paths[-1]
+    if "file" in queryParams:
+        path = _db_file(paths, queryParams["file"])
+        if path is None:
+            await response.error(404)
+            return
+
+    try:
+        _offset = int(queryParams.get("offset", 0))
+        check = int(queryParams["check"]) if "check" in queryParams else None
+        size = os.stat(path)[6]
+        if _offset < 0 or _offset > size:
+            raise ValueError()
+    except ValueError:
+        await response.error(400)
+        return
+
+    mv = memoryview(bytearray(FILE_BLOCK))
+    with open(path, "rb") as f:
+        if check is not None:
+            _first = max(0, _offset - FILE_BLOCK)
+            f.seek(_first)
+            n = f.readinto(mv[: _offset - _first])
+            if binascii.crc32(mv[:n]) != check:
+                await response.error(409)
+                return
+
+        def _blocks():
+            f.seek(_offset)
+            _left = size - _offset
+            while _left > 0:
+                n = f.readinto(mv[: min(_left, FILE_BLOCK)])
+                if not n:
+                    break
+                yield struct.pack("<II", n, binascii.crc32(mv[:n]))
+                yield mv[:n]
+                _left -= n
+            yield struct.pack("<II", 0, 0)
+
+        await response.stream(
+            "application/octet-stream",
+            _blocks(),
+            {"X-File-Size": "%d" % size, "Cache-Control": "no-store"},
+        )
+
+
+def _db_file(paths: list, name: str) -> str:
+    """the path of the database file named name, or None if the database has no such file"""
+    for path in paths:
+        if path.rsplit("/", 1)[-1] == name:
+            return path
+    return None
+
+
+# the files of the web directory, by URL path: the path of the file and the headers it is sent with
+_static_files = {}
+
+# the files under /assets/ are named after their content (see util/build_www.py), so browsers may keep
+# them for good
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def static_routes(web_path: str, url: str = ""):
+    """route the files in web_path (recursively) to route_static, so they are served with validators
+    and Range support
+
+    A file ending in .gz is served gzipped (Content-Encoding) at the URL without the extension.
+    """
+    for name in os.listdir(web_path):
+        path = web_path + "/" + name
+        if os.stat(path)[0] & 0x4000:
+            static_routes(path, url + "/" + name)
+            continue
+        headers = {}
+        if name.endswith(".gz"):
+            name = name[:-3]
+            headers["Content-Encoding"] = "gzip"
+        if url.startswith("/assets"):
+            headers["Cache-Control"] = IMMUTABLE
+        _static_files[url + "/" + name] = (path, headers)
+        app.route(url + "/" + name)(route_static)
+        if name == "index.html":
+            _static_files[url + "/"] = (path, headers)
+            app.route(url + "/")(route_static)
+
+
+async def route_static(request, response):
+    url = request.path
+    path, headers = _static_files[url]
+    contentType = CONTENT_TYPES.get(url.rsplit(".", 1)[-1], "text/html")
+    await _write_file(request, response, path, contentType, headers)
+
+
+async def _not_modified(request, response, etag: str) -> bool:
+    """answer 304 Not Modified if the client has the response tagged etag already, and return whether
+    it was answered"""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            await response.send(304, headers={"ETag": etag})
+            return True
+    return False
+
+
+def _range(request, etag: str, size: int) -> tuple:
+    """the bytes [start, end) of a file of the given size the client asks for, or None for the whole
+    file; raise ValueError if the range starts past the end of the file
+
+    Only a single range is supported; a request for several, or with an If-Range that does not match
+    etag (the file changed since the client started downloading it), gets the whole file.
+    """
+    headers = request.headers
+    value = headers.get("range")
+    if value is None or not value.startswith("bytes=") or "," in value:
+        return None
+    if headers.get("if-range", etag) != etag:
+        return None
+    first, last = (value[6:].split("-", 1) + [""])[:2]
+    try:
+        if first:
+            _start = int(first)
+            _end = int(last) + 1 if last else size
+        else:
+            _start, _end = size - int(last), size
+    except ValueError:
+        return None
+    if first and last and _end <= _start:
+        # not a valid range, which is ignored
+        return None
+    _start, _end = max(_start, 0), min(_end, size)
+    if _start >= _end:
+        raise ValueError("range past the end of the file")
+    return _start, _end
+
+
+async def _write_file(
+    request, response, path: str, contentType: str, headers: dict = None
+):
+    """send a file, or the part of it the Range header asks for, tagged with its size and time of
+    modification; the file is read FILE_BLOCK bytes at a time
+
+    headers are added to the response; Cache-Control defaults to revalidating every time.
+    """
+    try:
+        _stat = os.stat(path)
+    except OSError:
+        await response.error(404)
+        return
+    # a file that is appended to may grow while it is sent; the response stops at this size
+    size = _stat[6]
+    etag = '"%x-%x"' % (size, _stat[8])
+    if await _not_modified(request, response, etag):
+        return
+
+    try:
+        _bounds = _range(request, etag, size)
+    except ValueError:
+        await response.error(416, {"Content-Range": "bytes */%d" % size})
+        return
 
-    _db = db.DB("/sd/data.csv")
-    data = _db.read(_from=_from, _to=_to)
-    print(data)
+    _start, _end = _bounds or (0, size)
+    _headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if headers:
+        _headers.update(headers)
+    _headers["Accept-Ranges"] = "bytes"
+    if _bounds is not None:
+        _headers["Content-Range"] = "bytes %d-%d/%d" % (_start, _end - 1, size)
+    _headers["Content-Length"] = "%d" % (_end - _start)
+    response.start(200 if _bounds is None else 206, _headers, contentType)
 
-    httpResponse.WriteResponseOk(contentType="text/csv", content=data)
+    mv = memoryview(bytearray(FILE_BLOCK))
+    with open(path, "rb") as f:
+        f.seek(_start)
+        _left = _end - _start
+        while _left > 0:
+            n = f.readinto(mv[: min(_left, FILE_BLOCK)])
+            if not n:
+                break
+            await response.write(mv[:n])
+            _left -= n
@@ -1,9 +1,17 @@
 import os
+import tracemalloc
 import unittest
 from tempfile import mktemp
 from measurements import Timestamp
 from measurements import DataPoint
-from db import DB
+from cache import BlockCache, budget
+from columns import ColumnStore
+from columns import convert as convert_to_columns
+from compressed import CompressedSegment, compress, is_compressed
+from db import DB, convert
+from records import CsvFormat
+from schema import DATAPOINT_FIELDS, PMS7003_FIELDS, SCHEMA, Field
+from segment import Segment
 
 
 class MyTestCase(unittest.TestCase):
@@ -96,5 +104,1334 @@ class MyTestCase(unittest.TestCase):
         )
 
 
+class BinaryTestCase(MyTestCase):
+    db_file = mktemp(".bin")
+    db = DB(db_file, binary=True)
+
+    def test_read_fields(self):
+        data = self.db.read(None, self._start_timestamp + 100, fields=("aqi",))
+        self.assertEqual(len(data), 10)
+        self.assertEqual(data[5].aqi, 1)
+        self.assertIsNone(data[5].temperature)
+        self.assertIsNone(data[5].eCO2)
+
+
+class ConvertTestCase(unittest.TestCase):
+    def test_convert_csv_to_binary(self):
+        src = DB(mktemp(".csv"))
+        for t in range(1000, 2000, 10):
+            src.insert(
+                DataPoint(
+                    timestamp=Timestamp(t),
+                    temperature=-12.34,
+                    pressure=1013.25,
+                    relative_humidity=45.67,
+                    aqi=2,
+                    tvoc=t % 1000,
+                    eCO2=400,
+                )
+            )
+
+        dst_file = mktemp(".bin")
+        convert(src._path, dst_file)
+        dst = DB(dst_file)
+
+        self.assertTrue(dst.binary)
+        self.assertLess(os.path.getsize(dst_file), os.path.getsize(src._path))
+        for a, b in zip(src.read(), dst.read()):
+            self.assertEqual(a.to_csv(), b.to_csv())
+        self.assertEqual(len(dst.read(Timestamp(1500), Timestamp(1600))), 10)
+
+
+class StreamingTestCase(unittest.TestCase):
+    @staticmethod
+    def _write_records(path, num_records):
+        """write a CSV database of num_records 30 s apart without going through DB.insert"""
+        line = DataPoint(
+            timestamp=Timestamp(0),
+            temperature=21.5,
+            pressure=1013.25,
+            relative_humidity=40.0,
+            aqi=1,
+            tvoc=100,
+            eCO2=400,
+        ).to_csv()[10:]
+        with open(path, "w") as f:
+            f.write(DataPoint.CSV_HEADER)
+            for start in range(0, num_records, 10000):
+                stop = min(start + 10000, num_records)
+                f.write("".join("%10d%s" % (i * 30, line) for i in range(start, stop)))
+
+    def _peak_memory_while_streaming(self, num_records):
+        path = mktemp(".csv")
+        self._write_records(path, num_records)
+        try:
+            db = DB(path, index=False)
+            tracemalloc.start()
+            streamed = 0
+            for chunk in db.iter_range(raw=True):
+                streamed += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            os.remove(path)
+
+        self.assertEqual(streamed, num_records * DataPoint.RECORD_LENGTH)
+        return peak
+
+    def test_iter_range_matches_read(self):
+        path = mktemp(".csv")
+        self._write_records(path, 1000)
+        db = DB(path)
+        _from, _to = Timestamp(3000), Timestamp(6000)
+
+        records = list(db.iter_range(_from, _to, chunk=7))
+        self.assertEqual(
+            [int(r.timestamp) for r in records], list(range(3000, 6000, 30))
+        )
+
+        raw = b"".join(bytes(c) for c in db.iter_range(_from, _to, chunk=7, raw=True))
+        self.assertEqual(raw.decode(), "".join(r.to_csv() for r in records))
+
+    def test_streaming_memory_is_flat(self):
+        small = self._peak_memory_while_streaming(10_000)
+        large = self._peak_memory_while_streaming(1_000_000)
+        self.assertLess(large, 64 * 1024)
+        self.assertLess(large, small * 2)
+
+
+class IndexTestCase(unittest.TestCase):
+    # 30 s cadence with a few outages, spanning several index slots
+    _timestamps = [
+        t
+        for start, stop in ((10_000, 20_000), (25_000, 26_000), (40_000, 45_000))
+        for t in range(start, stop, 30)
+    ]
+
+    def _make_db(self):
+        path = mktemp(".csv")
+        db = DB(path, index=False)
+        for t in self._timestamps:
+            db.insert(
+                DataPoint(
+                    timestamp=Timestamp(t),
+                    temperature=20.0,
+                    pressure=1000.0,
+                    relative_humidity=50.0,
+                    aqi=1,
+                    tvoc=0,
+                    eCO2=400,
+                )
+            )
+        return path
+
+    def _assert_seeks_match(self, segment):
+        for t in range(9_000, 46_000, 17):
+            self.assertEqual(
+                segment.seek(Timestamp(t)),
+                segment._find_timestamp_offset(Timestamp(t)),
+                "seek mismatch for %d" % t,
+            )
+
+    def test_indexed_seek_matches_binary_search(self):
+        path = self._make_db()
+        segment = Segment(path)
+        self.assertGreater(segment._index.count, 1)
+        self._assert_seeks_match(segment)
+
+    def test_interpolation_seek_matches_binary_search(self):
+        path = self._make_db()
+        self._assert_seeks_match(Segment(path, index=False))
+
+    def test_interpolation_seek_on_irregular_data(self):
+        import random
+
+        rng = random.Random(1)
+        path = mktemp(".csv")
+        db = DB(path, index=False)
+        t = 10_000
+        while t < 46_000:
+            db.insert(DataPoint.from_csv("%10d,0,0,0,0,0,0" % t))
+            t += rng.choice((1, 5, 30, 31, 600, 3000))
+        self._assert_seeks_match(Segment(path, index=False))
+
+    def test_bisection_only(self):
+        # no index and no cadence: every seek bisects the file, the pending records follow it
+        reference = DB(mktemp(".csv"))
+        for binary in (False, True):
+            db = DB(
+                mktemp(".csv"), binary=binary, index=False, cadence=0, flush_every=7
+            )
+            for t in self._timestamps[:50]:
+                dp = DataPoint.from_csv("%10d,  1.00,1000.00,50.00,1,   0, 400\n" % t)
+                db.insert(dp)
+                if not binary:
+                    reference.insert(dp)
+            self.assertTrue(db._pending)
+
+            bounds = [None] + [Timestamp(t) for t in range(9_990, 11_600, 45)]
+            for _from in bounds:
+                for _to in bounds:
+                    self.assertEqual(
+                        [dp.to_csv() for dp in db.read(_from, _to)],
+                        [dp.to_csv() for dp in reference.read(_from, _to)],
+                    )
+
+    def test_index_maintained_by_insert(self):
+        db = DB(mktemp(".csv"))
+        for t in self._timestamps:
+            db.insert(DataPoint.from_csv("%10d,  1.00,1000.00,50.00,1,   0, 400\n" % t))
+        self._assert_seeks_match(db._parts[0].segment)
+        self.assertEqual(len(db.read(Timestamp(25_000), Timestamp(40_000))), 34)
+
+    def test_index_catches_up_after_crash(self):
+        path = self._make_db()
+        DB(path)
+        # simulate records written after the index was last updated
+        with open(path, "a") as f:
+            for t in range(45_000, 50_000, 30):
+                f.write(DataPoint.from_csv("%10d,0,0,0,0,0,0" % t).to_csv())
+        segment = Segment(path)
+        self.assertEqual(segment._index.slot(49_980), segment._index.count - 1)
+        self.assertEqual(
+            segment.seek(Timestamp(47_000)),
+            segment._find_timestamp_offset(Timestamp(47_000)),
+        )
+
+    def test_index_rebuilt_when_corrupt(self):
+        path = self._make_db()
+        DB(path)
+        with open(path + ".idx", "ab") as f:
+            f.write(b"\x01\x02")
+        self._assert_seeks_match(Segment(path))
+
+        with open(path + ".idx", "r+b") as f:
+            f.seek(-4, 2)
+            f.write(b"\x00\x00\x00\x00")
+        self._assert_seeks_match(Segment(path))
+
+
+class _MemoryBackup:
+    """stands in for RTCBackup on the host"""
+
+    capacity = 2048
+
+    def __init__(self):
+        self.data = b""
+
+    def load(self) -> bytes:
+        return self.data
+
+    def save(self, data: bytes):
+        self.data = bytes(data)
+
+
+class BufferTestCase(unittest.TestCase):
+    @staticmethod
+    def _data_point(t):
+        return DataPoint.from_csv(
+            "%10d, 20.00,1000.00,50.00,1,   0, %3d\n" % (t, t % 1000)
+        )
+
+    def test_reads_see_pending_records(self):
+        unbuffered = DB(mktemp(".csv"))
+        buffered = DB(mktemp(".csv"), flush_every=5, backup=_MemoryBackup())
+        for t in range(1000, 1230, 10):
+            unbuffered.insert(self._data_point(t))
+            buffered.insert(self._data_point(t))
+
+        self.assertEqual(len(buffered._pending), 3 * DataPoint.RECORD_LENGTH)
+        self.assertEqual(
+            os.path.getsize(buffered._path),
+            os.path.getsize(unbuffered._path) - len(buffered._pending),
+        )
+
+        bounds = [None] + [Timestamp(t) for t in range(990, 1240, 15)]
+        for _from in bounds:
+            for _to in bounds:
+                self.assertEqual(
+                    [dp.to_csv() for dp in buffered.read(_from, _to)],
+                    [dp.to_csv() for dp in unbuffered.read(_from, _to)],
+                    "mismatch for %s..%s" % (_from and int(_from), _to and int(_to)),
+                )
+
+    def test_flush_writes_everything_once(self):
+        backup = _MemoryBackup()
+        db = DB(mktemp(".csv"), flush_every=100, backup=backup)
+        self.assertEqual(db._flush_every, 2048 // DataPoint.RECORD_LENGTH)
+
+        for t in range(1000, 1100, 10):
+            db.insert(self._data_point(t))
+        self.assertEqual(len(db.read()), 10)
+        self.assertEqual(len(backup.data), 10 * DataPoint.RECORD_LENGTH)
+
+        db.flush()
+        self.assertEqual(backup.data, b"")
+        self.assertEqual(len(DB(db._path).read()), 10)
+
+    def test_pending_records_recovered_after_reset(self):
+        backup = _MemoryBackup()
+        db = DB(mktemp(".csv"), flush_every=4, backup=backup)
+        for t in range(1000, 1060, 10):
+            db.insert(self._data_point(t))
+        self.assertEqual(len(backup.data), 2 * DataPoint.RECORD_LENGTH)
+        # as if the device was also reset after writing the first batch, before clearing the backup
+        flushed = b"".join(
+            self._data_point(t).to_csv().encode() for t in range(1000, 1040, 10)
+        )
+        backup.data = flushed + backup.data
+
+        recovered = DB(db._path, flush_every=4, backup=backup)
+        self.assertEqual(backup.data, b"")
+        self.assertEqual(
+            [int(dp.timestamp) for dp in recovered.read()], list(range(1000, 1060, 10))
+        )
+
+    def test_flush_interval(self):
+        db = DB(mktemp(".csv"), flush_every=100, flush_interval=0)
+        db.insert(self._data_point(1000))
+        self.assertEqual(len(db._pending), 0)
+        self.assertEqual(len(DB(db._path).read()), 1)
+
+
+class RollupTestCase(unittest.TestCase):
+    _timestamps = range(7200, 7200 + 3 * 3600, 30)
+
+    @staticmethod
+    def _data_point(t):
+        return DataPoint(
+            timestamp=Timestamp(t),
+            temperature=(t // 30) % 40 - 10,
+            pressure=1000.0,
+            relative_humidity=50.0,
+            aqi=1 + t % 5,
+            tvoc=t % 997,
+            eCO2=400,
+        )
+
+    def _summaries(self, db, resolution, _from=None, _to=None):
+        return [b.to_csv() for b in db.iter_rollup(resolution, _from, _to)]
+
+    def test_buckets(self):
+        db = DB(mktemp(".csv"), rollups=True)
+        for t in self._timestamps:
+            db.insert(self._data_point(t))
+
+        hours = list(db.iter_rollup("1h"))
+        self.assertEqual([b.start for b in hours], [7200, 10800, 14400])
+        self.assertEqual([b.count for b in hours], [120, 120, 120])
+
+        samples = [self._data_point(t) for t in range(10800, 14400, 30)]
+        tvoc = DataPoint.FIELDS.index("tvoc")
+        self.assertEqual(hours[1].min[tvoc], min(s.tvoc for s in samples))
+        self.assertEqual(hours[1].max[tvoc], max(s.tvoc for s in samples))
+        self.assertAlmostEqual(
+            hours[1].mean(tvoc), sum(s.tvoc for s in samples) / len(samples), places=2
+        )
+
+        self.assertEqual(len(list(db.iter_rollup("1m"))), 180)
+        self.assertEqual(
+            len(list(db.iter_rollup("10m", Timestamp(9000), Timestamp(12000)))), 5
+        )
+
+    def test_reopen_resumes_open_buckets(self):
+        reference = DB(mktemp(".csv"), rollups=True)
+        path = mktemp(".csv")
+        db = DB(path, rollups=True)
+        for i, t in enumerate(self._timestamps):
+            reference.insert(self._data_point(t))
+            if i % 97 == 0:
+                # reset the device every now and then
+                db = DB(path, rollups=True)
+            db.insert(self._data_point(t))
+
+        for resolution in ("1m", "10m", "1h"):
+            self.assertEqual(
+                self._summaries(db, resolution), self._summaries(reference, resolution)
+            )
+
+    def test_buckets_written_with_the_records(self):
+        path = mktemp(".csv")
+        db = DB(path, rollups=True, flush_every=10)
+        _empty = os.stat(path + ".1m")[6]
+        for t in self._timestamps[:9]:
+            db.insert(self._data_point(t))
+        # four minutes closed, none written
+        self.assertEqual(os.stat(path + ".1m")[6], _empty)
+        self.assertEqual(len(list(db.iter_rollup("1m"))), 5)
+        self.assertEqual(len(list(db.iter_rollup("1m", Timestamp(7260)))), 4)
+
+        db.insert(self._data_point(self._timestamps[9]))
+        self.assertGreater(os.stat(path + ".1m")[6], _empty)
+        self.assertEqual(len(list(db.iter_rollup("1m"))), 5)
+
+    def test_reset_rebuilds_buffered_buckets(self):
+        reference = DB(mktemp(".csv"), rollups=True)
+        path = mktemp(".csv")
+        backup = _MemoryBackup()
+        db = DB(path, rollups=True, flush_every=10, backup=backup)
+        for i, t in enumerate(self._timestamps):
+            reference.insert(self._data_point(t))
+            if i % 97 == 0:
+                # reset the device every now and then, with records and buckets not written yet
+                db = DB(path, rollups=True, flush_every=10, backup=backup)
+            db.insert(self._data_point(t))
+
+        for resolution in ("1m", "10m", "1h"):
+            self.assertEqual(
+                self._summaries(db, resolution), self._summaries(reference, resolution)
+            )
+
+    def test_rollups_built_for_existing_data(self):
+        path = mktemp(".csv")
+        db = DB(path)
+        for t in self._timestamps:
+            db.insert(self._data_point(t))
+
+        db = DB(path, rollups=True)
+        self.assertEqual([b.count for b in db.iter_rollup("1h")], [120, 120, 120])
+
+
+class PartitionTestCase(unittest.TestCase):
+    # five days of samples, ten minutes apart
+    _timestamps = range(86400 - 3000, 6 * 86400 - 3000, 600)
+
+    def setUp(self):
+        self._dir = mktemp()
+        os.mkdir(self._dir)
+        self._path = self._dir + "/data.csv"
+
+    @staticmethod
+    def _data_point(t):
+        return DataPoint.from_csv(
+            "%10d, 20.00,1000.00,50.00,1,   0, %3d\n" % (t, t % 1000)
+        )
+
+    def _fill(self, db):
+        for t in self._timestamps:
+            db.insert(self._data_point(t))
+        return db
+
+    def _assert_reads_match(self, db, reference):
+        bounds = [None] + [Timestamp(t) for t in range(80000, 6 * 86400, 19997)]
+        for _from in bounds:
+            for _to in bounds:
+                self.assertEqual(
+                    [dp.to_csv() for dp in db.read(_from, _to)],
+                    [dp.to_csv() for dp in reference.read(_from, _to)],
+                    "mismatch for %s..%s" % (_from and int(_from), _to and int(_to)),
+                )
+
+    def test_reads_match_single_file(self):
+        single = self._fill(DB(mktemp(".csv")))
+        partitioned = self._fill(
+            DB(self._path, partition="day", flush_every=7, backup=_MemoryBackup())
+        )
+        self.assertEqual(len(partitioned._parts), 6)
+        self._assert_reads_match(partitioned, single)
+
+        partitioned.flush()
+        self._assert_reads_match(DB(self._path, partition="day"), single)
+
+    def test_reads_open_only_overlapping_partitions(self):
+        import db as db_module
+        from unittest import mock
+
+        db = self._fill(DB(self._path, partition="day"))
+        with mock.patch.object(
+            db_module, "Segment", wraps=db_module.Segment
+        ) as segment:
+            db.read(Timestamp(2 * 86400 + 100), Timestamp(3 * 86400 + 100))
+        self.assertEqual(
+            [c.args[0] for c in segment.call_args_list],
+            [db._parts[2].path, db._parts[3].path],
+        )
+
+    def test_drop_before(self):
+        db = self._fill(DB(self._path, partition="day"))
+        dropped = self._path + "." + db._parts[0].key
+        self.assertEqual(db.drop_before(Timestamp(3 * 86400)), 3)
+        self.assertFalse(os.path.exists(dropped))
+        self.assertFalse(os.path.exists(dropped + ".idx"))
+
+        reopened = DB(self._path, partition="day")
+        self.assertEqual(len(reopened._parts), 3)
+        self.assertEqual(int(reopened.read()[0].timestamp), 3 * 86400)
+        # the partition being written to is kept
+        self.assertEqual(reopened.drop_before(Timestamp(10 * 86400)), 2)
+        self.assertEqual(len(reopened.read()), 144 - 3000 // 600)
+
+    def test_existing_file_and_lost_manifest(self):
+        legacy = DB(self._path)
+        for t in range(3000, 86400, 600):
+            legacy.insert(self._data_point(t))
+
+        db = self._fill(DB(self._path, partition="month"))
+        self.assertEqual(len(db._parts), 2)
+        self.assertIsNone(db._parts[0].key)
+        expected = [dp.to_csv() for dp in db.read()]
+        self.assertEqual(len(expected), 139 + len(self._timestamps))
+
+        os.remove(self._path + ".manifest")
+        self.assertEqual(
+            [dp.to_csv() for dp in DB(self._path, partition="month").read()], expected
+        )
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self._dir = mktemp()
+        os.mkdir(self._dir)
+        self._path = self._dir + "/data.csv"
+
+    @staticmethod
+    def _samples(num_records, seed=0):
+        """a slow random walk, like the readings of a station in a room"""
+        import random
+
+        rng = random.Random(seed)
+        t, temperature, pressure, humidity, tvoc, eCO2 = (
+            86400,
+            21.0,
+            1013.0,
+            45.0,
+            100,
+            400,
+        )
+        for _ in range(num_records):
+            t += 30 + rng.choice((0, 0, 0, 1, -1))
+            temperature += rng.randint(-3, 3) / 100
+            pressure += rng.randint(-5, 5) / 100
+            humidity += rng.randint(-10, 10) / 100
+            tvoc = max(0, tvoc + rng.randint(-5, 5))
+            eCO2 = max(400, eCO2 + rng.randint(-8, 8))
+            yield DataPoint(
+                timestamp=Timestamp(t),
+                temperature=round(temperature, 2),
+                pressure=round(pressure, 2),
+                relative_humidity=round(humidity, 2),
+                aqi=1 + tvoc // 500,
+                tvoc=tvoc,
+                eCO2=eCO2,
+            )
+
+    def test_sealed_partitions_compressed(self):
+        single = DB(mktemp(".csv"))
+        db = DB(self._path, partition="day", compress=True)
+        for dp in self._samples(3 * 2880):
+            single.insert(dp)
+            db.insert(dp)
+
+        self.assertEqual(len(db._parts), 3)
+        # inserts leave the compression to compact_steps
+        self.assertFalse(any(is_compressed(part.path) for part in db._parts))
+        self.assertEqual(db.compact(), 2)
+        for part in db._parts[:2]:
+            self.assertTrue(is_compressed(part.path))
+            self.assertFalse(os.path.exists(part.path + ".idx"))
+            self.assertLess(
+                os.path.getsize(part.path) * 5, 2880 * DataPoint.RECORD_LENGTH
+            )
+        self.assertFalse(is_compressed(db._parts[2].path))
+
+        bounds = [None] + [Timestamp(t) for t in range(80000, 4 * 86400, 37013)]
+        for _db in (db, DB(self._path, partition="day")):
+            for _from in bounds:
+                for _to in bounds:
+                    self.assertEqual(
+                        [dp.to_csv() for dp in _db.read(_from, _to)],
+                        [dp.to_csv() for dp in single.read(_from, _to)],
+                    )
+
+    def test_reads_decompress_only_touched_blocks(self):
+        path = mktemp(".csv")
+        db = DB(path)
+        for dp in self._samples(10_000):
+            db.insert(dp)
+        compress(path, path + ".z")
+
+        segment = CompressedSegment(path + ".z")
+        _from = segment.seek(Timestamp(86400 + 5000 * 30))
+        _to = segment.seek(Timestamp(86400 + 5100 * 30))
+        buf = bytearray(32 * segment.format.RECORD_LENGTH)
+        n = sum(segment.iter_chunks(_from, _to, buf))
+        expected = db.read(Timestamp(86400 + 5000 * 30), Timestamp(86400 + 5100 * 30))
+        self.assertEqual(n, len(expected) * segment.format.RECORD_LENGTH)
+        # a bisection of the block index, then at most two blocks
+        self.assertLessEqual(segment.reads, 2 * 7 + 3 * 2)
+
+    def test_read_during_compaction(self):
+        single = DB(mktemp(".csv"))
+        db = DB(self._path, partition="day", compress=True, cache=BlockCache())
+        for dp in self._samples(2 * 2880 + 100):
+            single.insert(dp)
+            db.insert(dp)
+        expected = [dp.to_csv() for dp in single.read()]
+        old_path = db._parts[0].path
+
+        # a read across the day rollover, started before the partition is replaced
+        reader = db.iter_range()
+        received = [next(reader).to_csv() for _ in range(100)]
+        steps = db.compact_steps()
+        self.assertEqual(next(steps), 0)
+        received.extend(next(reader).to_csv() for _ in range(100))
+        self.assertEqual(sum(steps), 2)
+        self.assertTrue(db._parts[0].path.endswith(".z"))
+        received.extend(dp.to_csv() for dp in reader)
+        self.assertEqual(received, expected)
+
+        # new reads use the compressed copy; the replaced file stays for the reads in flight
+        self.assertEqual([dp.to_csv() for dp in db.read()], expected)
+        self.assertTrue(os.path.exists(old_path))
+        self.assertEqual(sum(db.compact_steps()), 0)
+        self.assertTrue(os.path.exists(old_path))
+        db._remove_retired(0)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual([dp.to_csv() for dp in db.read()], expected)
+
+        reopened = DB(self._path, partition="day")
+        self.assertTrue(reopened._parts[0].path.endswith(".z"))
+        self.assertEqual([dp.to_csv() for dp in reopened.read()], expected)
+
+    def test_compaction_reset_before_removing_the_partition(self):
+        db = DB(self._path, partition="day")
+        for dp in self._samples(2 * 2880):
+            db.insert(dp)
+        expected = [dp.to_csv() for dp in db.read()]
+        path = db._parts[0].path
+        compress(path, path + ".z")
+
+        reopened = DB(self._path, partition="day")
+        self.assertEqual(reopened._parts[0].path, path + ".z")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([dp.to_csv() for dp in reopened.read()], expected)
+
+    def test_interrupted_compaction(self):
+        db = DB(self._path, partition="day")
+        for dp in self._samples(2 * 2880):
+            db.insert(dp)
+        expected = [dp.to_csv() for dp in db.read()]
+
+        # as if the device was reset after removing the partition, before renaming its copy
+        path = db._parts[0].path
+        compress(path, path + ".tmp")
+        os.remove(path)
+        self.assertEqual(
+            [dp.to_csv() for dp in DB(self._path, partition="day").read()], expected
+        )
+
+        db = DB(self._path, partition="day")
+        self.assertEqual(db.compact(), 0)
+        self.assertEqual([dp.to_csv() for dp in db.read()], expected)
+
+
+class _NoTruncate:
+    """a file without truncate(), like the ones of MicroPython"""
+
+    def __init__(self, f):
+        self._f = f
+
+    def __getattr__(self, name):
+        if name == "truncate":
+            raise AttributeError(name)
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._f.close()
+
+
+class RecoveryTestCase(unittest.TestCase):
+    @staticmethod
+    def _data_point(t, tvoc=0):
+        return DataPoint.from_csv("%10d, 20.00,1000.00,50.00,1,%4d, 400\n" % (t, tvoc))
+
+    def _make_db(self, binary=False):
+        db = DB(mktemp(".csv"), binary=binary)
+        for t in range(1000, 2000, 10):
+            db.insert(self._data_point(t))
+        return db
+
+    def _assert_repaired(self, path, num_records):
+        db = DB(path)
+        segment = db._parts[0].segment
+        self.assertEqual(
+            (segment.size - segment.format.HEADER_LENGTH)
+            % segment.format.RECORD_LENGTH,
+            0,
+        )
+        self.assertEqual(len(db.read()), num_records)
+        db.insert(self._data_point(5000))
+        self.assertEqual(int(DB(path).read()[-1].timestamp), 5000)
+        self.assertEqual(len(DB(path).read(Timestamp(1500), Timestamp(1600))), 10)
+
+    def test_torn_record_truncated(self):
+        for binary in (False, True):
+            db = self._make_db(binary)
+            with open(db._path, "ab") as f:
+                f.write(db._format.encode(self._data_point(2000))[:9])
+            self._assert_repaired(db._path, 100)
+
+    def test_torn_record_overwritten_without_truncate(self):
+        import builtins
+        import segment
+        from unittest import mock
+
+        db = self._make_db()
+        with open(db._path, "ab") as f:
+            f.write(b"      2000, 2")
+        with mock.patch.object(
+            segment,
+            "open",
+            lambda *args: _NoTruncate(builtins.open(*args)),
+            create=True,
+        ):
+            DB(db._path)
+        # the partial record is replaced by a copy of the last one
+        timestamps = [int(dp.timestamp) for dp in DB(db._path).read()]
+        self.assertEqual(timestamps[-2:], [1990, 1990])
+        self._assert_repaired(db._path, 101)
+
+    def test_wide_values_clamped(self):
+        db = DB(mktemp(".csv"))
+        db.insert(self._data_point(1000, tvoc=12000))
+        wide = self._data_point(1010)
+        wide.relative_humidity = 100.0
+        wide.pressure = 10000.0
+        db.insert(wide)
+
+        self.assertEqual(
+            os.path.getsize(db._path),
+            DataPoint.HEADER_LENGTH + 2 * DataPoint.RECORD_LENGTH,
+        )
+        first, second = db.read()
+        self.assertEqual(first.tvoc, 9999)
+        self.assertEqual(second.relative_humidity, 99.99)
+        self.assertEqual(second.pressure, 9999.99)
+
+    def test_misaligned_file_rewritten(self):
+        path = mktemp(".csv")
+        with open(path, "w") as f:
+            f.write(DataPoint.CSV_HEADER)
+            for t in range(1000, 2000, 10):
+                line = self._data_point(t).to_csv()
+                if t == 1500:
+                    # written before values were clamped
+                    line = line.replace("   0, 400", "12345, 400")
+                f.write(line)
+        self.assertEqual(
+            (os.path.getsize(path) - DataPoint.HEADER_LENGTH) % DataPoint.RECORD_LENGTH,
+            1,
+        )
+
+        data = DB(path).read()
+        self.assertEqual(
+            [int(dp.timestamp) for dp in data], list(range(1000, 2000, 10))
+        )
+        self.assertEqual(data[50].tvoc, 9999)
+        self._assert_repaired(path, 100)
+
+    def test_open_reads_only_the_ends(self):
+        path = mktemp(".csv")
+        StreamingTestCase._write_records(path, 100_000)
+        self.assertLessEqual(Segment(path, index=False).reads, 3)
+
+
+class CacheTestCase(unittest.TestCase):
+    @staticmethod
+    def _data_point(t):
+        return DataPoint.from_csv(
+            "%10d, 20.00,1000.00,50.00,1,%4d, 400\n" % (t, t % 1000)
+        )
+
+    def _make_db(self, **kwargs):
+        path = mktemp(".csv")
+        StreamingTestCase._write_records(path, 10_000)
+        return DB(path, **kwargs)
+
+    def test_repeated_query_served_from_cache(self):
+        reference = self._make_db()
+        db = self._make_db(cache=BlockCache(64 * 1024))
+        _from, _to = Timestamp(250_000), Timestamp(280_000)
+
+        expected = [dp.to_csv() for dp in reference.read(_from, _to)]
+        self.assertEqual([dp.to_csv() for dp in db.read(_from, _to)], expected)
+        misses = db.cache.misses
+        self.assertEqual([dp.to_csv() for dp in db.read(_from, _to)], expected)
+        self.assertEqual(db.cache.misses, misses)
+        self.assertGreater(db.cache.hits, 1000 // 32)
+
+    def test_insert_invalidates_only_the_tail_block(self):
+        db = self._make_db(cache=BlockCache(64 * 1024))
+        _from = Timestamp(280_000)
+        self.assertEqual(len(db.read(_from)), 667)
+
+        for t in range(300_000, 300_300, 30):
+            db.insert(self._data_point(t))
+        misses = db.cache.misses
+        data = db.read(_from)
+        self.assertEqual(len(data), 677)
+        self.assertEqual(data[-1].to_csv(), self._data_point(300_270).to_csv())
+        # only the block the records were appended to is read again
+        self.assertEqual(db.cache.misses - misses, 1)
+
+    def test_budget(self):
+        cache = BlockCache(1000)
+        for block in range(10):
+            cache.put("data.csv", block, bytes(300))
+        self.assertEqual(cache.size, 900)
+        self.assertIsNone(cache.get("data.csv", 6))
+        self.assertIsNotNone(cache.get("data.csv", 7))
+        cache.put("data.csv", 10, bytes(300))
+        # block 7 was used more recently than block 8
+        self.assertIsNone(cache.get("data.csv", 8))
+        self.assertIsNotNone(cache.get("data.csv", 7))
+
+        cache.invalidate("data.csv")
+        self.assertEqual((cache.size, cache.stats()["blocks"]), (0, 0))
+
+    def _hit_rate(self, cache) -> float:
+        """the share of the reads of the last day served by the cache, while samples are written"""
+        db = DB(mktemp(".csv"), flush_every=2, partition="month", cache=cache)
+        t = 1_700_000_000
+        for t in range(t, t + 3 * 86400, 30):
+            db.insert(self._data_point(t))
+        db.flush()
+        list(db.read(Timestamp(t - 86400)))
+        hits, misses = cache.hits, cache.misses
+        for _ in range(10):
+            for _ in range(2):
+                t += 30
+                db.insert(self._data_point(t))
+            list(db.read(Timestamp(t - 86400)))
+        return (cache.hits - hits) / (cache.hits - hits + cache.misses - misses)
+
+    def test_budget_for_the_last_day(self):
+        size = budget(86400, 30, CsvFormat.RECORD_LENGTH)
+        self.assertGreater(self._hit_rate(BlockCache(size)), 0.95)
+        # a cache smaller than the day is evicted by every scan of it
+        self.assertLess(self._hit_rate(BlockCache(32 * 1024)), 0.05)
+
+    def test_compressed_partitions_cached(self):
+        directory = mktemp()
+        os.mkdir(directory)
+        db = DB(
+            directory + "/data.csv",
+            partition="day",
+            compress=True,
+            cache=BlockCache(64 * 1024),
+        )
+        for t in range(3000, 3 * 86400, 300):
+            db.insert(self._data_point(t))
+        db.compact()
+        expected = [dp.to_csv() for dp in db.read()]
+
+        misses = db.cache.misses
+        self.assertEqual([dp.to_csv() for dp in db.read()], expected)
+        self.assertEqual(db.cache.misses, misses)
+
+
+class AggregateTestCase(unittest.TestCase):
+    def _make_db(self, binary):
+        db = DB(mktemp(".csv"), binary=binary, flush_every=7)
+        for dp in CompressionTestCase._samples(3000):
+            db.insert(dp)
+        return db
+
+    @staticmethod
+    def _expected(data, bucket_seconds, fields, fns):
+        buckets = {}
+        for dp in data:
+            t = int(dp.timestamp)
+            buckets.setdefault(t - t % bucket_seconds, []).append(dp)
+
+        result = []
+        for start in sorted(buckets):
+            values = []
+            for name in fields:
+                column = [getattr(dp, name) for dp in buckets[start]]
+                summaries = {
+                    "min": min(column),
+                    "max": max(column),
+                    "mean": sum(column) / len(column),
+                    "count": len(column),
+                    "sum": sum(column),
+                    "last": column[-1],
+                }
+                values.extend(summaries[fn] for fn in fns)
+            result.append((start, values))
+        return result
+
+    def _assert_aggregates_match(self, actual, expected):
+        self.assertEqual(
+            [start for start, _ in actual], [start for start, _ in expected]
+        )
+        for (_, values), (_, expected_values) in zip(actual, expected):
+            for value, expected_value in zip(values, expected_values):
+                self.assertAlmostEqual(value, expected_value, places=6)
+
+    def test_matches_read(self):
+        fns = ("min", "max", "mean", "count", "sum", "last")
+        for binary in (False, True):
+            db = self._make_db(binary)
+            for _from, _to, bucket in (
+                (None, None, 3600),
+                (Timestamp(100_000), Timestamp(150_000), 600),
+                (Timestamp(90_000), None, 86400),
+            ):
+                self._assert_aggregates_match(
+                    list(db.aggregate(_from, _to, bucket)),
+                    self._expected(db.read(_from, _to), bucket, DataPoint.FIELDS, fns),
+                )
+
+    def test_selected_fields_and_summaries(self):
+        db = self._make_db(False)
+        fields, fns = ("eCO2", "temperature"), ("last", "max")
+        self._assert_aggregates_match(
+            list(db.aggregate(bucket_seconds=7 * 86400, fields=fields, fns=fns)),
+            self._expected(db.read(), 7 * 86400, fields, fns),
+        )
+        self.assertEqual(list(db.aggregate(Timestamp(10**9))), [])
+
+    def test_invalid_arguments(self):
+        db = self._make_db(False)
+        with self.assertRaises(ValueError):
+            db.aggregate(fields=("pm25",))
+        with self.assertRaises(ValueError):
+            db.aggregate(fns=("median",))
+        with self.assertRaises(ValueError):
+            db.aggregate(bucket_seconds=0)
+
+
+class CsvFormatTestCase(unittest.TestCase):
+    def test_fixed_offsets(self):
+        lines = [
+            "1742195260,-12.34,1234.56,12.34,1,1234,1234\n",
+            "       300,  0.05,   0.00, 0.00,0,   0,   0\n",
+            "4000000000,327.67,9999.99,99.99,9,9999,9999\n",
+        ]
+        buf = memoryview("".join(lines).encode())
+        for i, line in enumerate(lines):
+            offset = i * CsvFormat.RECORD_LENGTH
+            expected = DataPoint.from_csv(line)
+            self.assertEqual(CsvFormat.timestamp(buf, offset), int(expected.timestamp))
+            self.assertEqual(
+                CsvFormat.decode(buf, offset).to_dict(), expected.to_dict()
+            )
+            self.assertEqual(
+                CsvFormat.decode(buf, offset, ("tvoc",)).to_dict(),
+                DataPoint(timestamp=expected.timestamp, tvoc=expected.tvoc).to_dict(),
+            )
+
+        timestamps, columns = CsvFormat.columns(buf, len(buf), [0, 5])
+        self.assertEqual(timestamps, [1742195260, 300, 4000000000])
+        self.assertEqual(columns, [[-12.34, 0.05, 327.67], [1234, 0, 9999]])
+
+    def test_layout_from_schema(self):
+        self.assertEqual(DataPoint.FIELDS, tuple(f.name for f in DATAPOINT_FIELDS))
+        self.assertEqual(DataPoint.RECORD_LENGTH, 44)
+        self.assertEqual(DataPoint.LIMITS["temperature"], (-99.99, 327.67))
+        self.assertEqual(DataPoint.LIMITS["aqi"], (0, 9))
+        # the positional arguments of the constructor follow the schema
+        dp = DataPoint(0, *range(1, len(DataPoint.FIELDS) + 1))
+        self.assertEqual(
+            [getattr(dp, name) for name in DataPoint.FIELDS],
+            list(range(1, len(DataPoint.FIELDS) + 1)),
+        )
+        # every value at its limits fits its column
+        for low in (True, False):
+            dp = DataPoint(timestamp=Timestamp(4000000000))
+            for name in DataPoint.FIELDS:
+                setattr(dp, name, DataPoint.LIMITS[name][0 if low else 1])
+            self.assertEqual(len(dp.to_csv()), DataPoint.RECORD_LENGTH)
+            self.assertEqual(DataPoint.from_csv(dp.to_csv()).to_dict(), dp.to_dict())
+
+
+class AllocationTestCase(unittest.TestCase):
+    def test_no_instance_dict(self):
+        # on CPython only; MicroPython ignores __slots__
+        dp = DataPoint(timestamp=Timestamp(0))
+        self.assertFalse(hasattr(dp, "__dict__"))
+        self.assertFalse(hasattr(dp.timestamp, "__dict__"))
+
+    def test_reused_data_point(self):
+        for binary in (False, True):
+            db = DB(mktemp(".csv"), binary=binary, flush_every=7)
+            for dp in CompressionTestCase._samples(500):
+                db.insert(dp)
+
+            expected = [dp.to_csv() for dp in db.read()]
+            records = []
+            for dp in db.iter_range(reuse=True):
+                records.append(dp)
+            self.assertEqual(len(records), len(expected))
+            self.assertTrue(all(dp is records[0] for dp in records))
+            self.assertEqual(
+                [dp.to_csv() for dp in db.iter_range(reuse=True)], expected
+            )
+
+            fields = ("eCO2",)
+            for dp, other in zip(
+                db.iter_range(fields=fields, reuse=True), db.read(fields=fields)
+            ):
+                self.assertEqual(dp.to_dict(), other.to_dict())
+
+    def test_insert_retains_nothing(self):
+        db = DB(mktemp(".csv"), binary=True, flush_every=10)
+        dp = next(CompressionTestCase._samples(1))
+        for i in range(20):
+            dp.timestamp = Timestamp(1000 + 30 * i)
+            db.insert(dp)
+
+        tracemalloc.start()
+        for i in range(20, 1020):
+            dp.timestamp.timestamp = 1000 + 30 * i
+            db.insert(dp)
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # only the buffer of the unflushed records may grow
+        self.assertLess(retained, 1024)
+
+
+class DownsampleTestCase(unittest.TestCase):
+    def _make_db(self, binary, spike_at=None):
+        db = DB(mktemp(".csv"), binary=binary, flush_every=7)
+        for i, dp in enumerate(CompressionTestCase._samples(3000)):
+            if i == spike_at:
+                dp.temperature = 80.0
+            db.insert(dp)
+        return db
+
+    def test_subset_of_read(self):
+        for binary in (False, True):
+            db = self._make_db(binary)
+            data = db.read()
+            for max_points in (3, 10, 100, 1000):
+                points = list(db.downsample(max_points=max_points))
+                self.assertEqual(len(points), max_points)
+                self.assertEqual(points[0].to_csv(), data[0].to_csv())
+                self.assertEqual(points[-1].to_csv(), data[-1].to_csv())
+
+                # in order, one record per bucket of consecutive records
+                lines = [dp.to_csv() for dp in data]
+                positions = [lines.index(dp.to_csv()) for dp in points]
+                self.assertEqual(positions, sorted(set(positions)))
+
+    def test_keeps_peaks(self):
+        db = self._make_db(True, spike_at=1234)
+        for fields in (("temperature",), DataPoint.FIELDS):
+            points = list(db.downsample(max_points=50, fields=fields))
+            self.assertIn(80.0, [dp.temperature for dp in points])
+
+    def test_small_ranges_unchanged(self):
+        db = self._make_db(False)
+        _from, _to = Timestamp(100_000), Timestamp(105_000)
+        self.assertEqual(
+            [dp.to_csv() for dp in db.downsample(_from, _to, max_points=500)],
+            [dp.to_csv() for dp in db.read(_from, _to)],
+        )
+        self.assertEqual(list(db.downsample(Timestamp(10**9))), [])
+
+    def test_raw(self):
+        for binary in (False, True):
+            db = self._make_db(binary)
+            self.assertEqual(
+                b"".join(db.downsample(max_points=200, raw=True)).decode(),
+                "".join(dp.to_csv() for dp in db.downsample(max_points=200)),
+            )
+
+    def test_invalid_arguments(self):
+        db = self._make_db(False)
+        with self.assertRaises(ValueError):
+            db.downsample(max_points=2)
+        with self.assertRaises(ValueError):
+            db.downsample(fields=())
+        with self.assertRaises(ValueError):
+            db.downsample(fields=("pm25",))
+
+
+class SinceTestCase(unittest.TestCase):
+    _timestamps = PartitionTestCase._timestamps
+
+    def _databases(self):
+        for binary in (False, True):
+            for partition in (None, "day"):
+                _dir = mktemp()
+                os.mkdir(_dir)
+                yield DB(
+                    _dir + "/data.csv",
+                    binary=binary,
+                    partition=partition,
+                    flush_every=7,
+                )
+
+    def test_follows_inserts(self):
+        for db in self._databases():
+            cursor, records = db.since()
+            self.assertIsNone(cursor)
+            self.assertEqual(list(records), [])
+
+            received = []
+            for k in range(0, len(self._timestamps), 97):
+                _batch = self._timestamps[k:][:97]
+                for t in _batch:
+                    db.insert(PartitionTestCase._data_point(t))
+                cursor, records = db.since(cursor)
+                received.extend(dp.to_csv() for dp in records)
+                self.assertEqual(cursor, _batch[-1])
+            self.assertEqual(received, [dp.to_csv() for dp in db.read()])
+
+            # nothing new
+            self.assertEqual(db.since(cursor)[0], cursor)
+            self.assertEqual(list(db.since(cursor)[1]), [])
+
+    def test_ignores_records_inserted_while_reading(self):
+        for db in self._databases():
+            for t in self._timestamps[:100]:
+                db.insert(PartitionTestCase._data_point(t))
+            cursor, records = db.since(self._timestamps[49])
+            for t in self._timestamps[100:110]:
+                db.insert(PartitionTestCase._data_point(t))
+            self.assertEqual(
+                [int(dp.timestamp) for dp in records], list(self._timestamps[50:100])
+            )
+            self.assertEqual(cursor, self._timestamps[99])
+
+    def test_raw(self):
+        for db in self._databases():
+            for t in self._timestamps:
+                db.insert(PartitionTestCase._data_point(t))
+            _from = self._timestamps[200]
+            cursor, records = db.since(_from, raw=True)
+            self.assertEqual(cursor, self._timestamps[-1])
+            self.assertEqual(
+                b"".join(bytes(c) for c in records).decode(),
+                "".join(dp.to_csv() for dp in db.since(_from)[1]),
+            )
+
+
+class EtagTestCase(unittest.TestCase):
+    def test_changes_with_the_records(self):
+        for partition in (None, "day"):
+            _dir = mktemp()
+            os.mkdir(_dir)
+            db = DB(_dir + "/data.csv", partition=partition, flush_every=7)
+            seen = {db.etag()}
+            for t in PartitionTestCase._timestamps[:300]:
+                db.insert(PartitionTestCase._data_point(t))
+                etag = db.etag()
+                self.assertNotIn(etag, seen)
+                seen.add(etag)
+
+            # the same records give the same tag, however they were written
+            db.flush()
+            self.assertEqual(db.etag(), etag)
+            if partition is not None:
+                files = db.files()
+                self.assertEqual(db.drop_before(Timestamp(2 * 86400)), 2)
+                self.assertNotIn(db.etag(), seen)
+                self.assertEqual(db.files(), files[2:])
+                self.assertEqual(
+                    DB(_dir + "/data.csv", partition=partition).etag(), db.etag()
+                )
+
+
+class ColumnStoreTestCase(unittest.TestCase):
+    @staticmethod
+    def _records(n, start=0):
+        records = []
+        for i, dp in enumerate(CompressionTestCase._samples(start + n)):
+            if i < start:
+                continue
+            values = dp.to_dict()
+            values["timestamp"] = int(dp.timestamp)
+            if i % 3:
+                values["PM2_5_ATM"] = i % 50
+                values["PCNT_0_3"] = 1000 + i
+            values["community_pm10"] = 12.3
+            records.append(values)
+        return records
+
+    def _assert_records_match(self, actual, expected, fields):
+        self.assertEqual(len(actual), len(expected))
+        for record, values in zip(actual, expected):
+            self.assertEqual(record["timestamp"], values["timestamp"])
+            for name in fields:
+                if values.get(name) is None:
+                    self.assertIsNone(record[name])
+                else:
+                    self.assertAlmostEqual(record[name], values[name], places=6)
+
+    def test_round_trip(self):
+        path = mktemp()
+        records = self._records(500)
+        store = ColumnStore(path, flush_every=7)
+        for values in records:
+            store.insert(values)
+        names = [field.name for field in SCHEMA]
+        self.assertEqual(store.fields, names)
+        # the last records are still pending
+        self._assert_records_match(store.read(), records, names)
+
+        store.flush()
+        store = ColumnStore(path)
+        self.assertEqual(len(store), 500)
+        self._assert_records_match(store.read(), records, names)
+
+        _from, _to = records[100]["timestamp"], records[200]["timestamp"]
+        self._assert_records_match(
+            store.read(_from, _to, ("eCO2",)), records[100:200], ("eCO2",)
+        )
+        self._assert_records_match(
+            store.read(_from - 1, _to + 1, ("eCO2",)), records[100:201], ("eCO2",)
+        )
+        self.assertEqual(store.read(10**9), [])
+
+        lines = list(store.iter_csv(_from, _to, ("aqi", "PM2_5_ATM")))
+        self.assertEqual(lines[0], "timestamp,aqi,PM2_5_ATM\n")
+        rows = "".join(lines[1:]).splitlines()
+        self.assertEqual(len(rows), 100)
+        # the PMS7003 readings missing from every third record are left empty
+        self.assertEqual(
+            [row.endswith(",") for row in rows],
+            [i % 3 == 0 for i in range(100, 200)],
+        )
+
+    def test_narrow_queries_read_only_their_columns(self):
+        store = ColumnStore(mktemp(), flush_every=100)
+        for values in self._records(1000):
+            store.insert(values)
+        store.flush()
+
+        store.bytes_read = 0
+        store.read(fields=("aqi", "eCO2"))
+        # a timestamp, a 1-byte aqi and a 2-byte eCO2 per record
+        self.assertEqual(store.bytes_read, 1000 * 7)
+
+        store.bytes_read = 0
+        store.read()
+        self.assertGreater(store.bytes_read, 1000 * 40)
+
+    def test_add_field(self):
+        path = mktemp()
+        records = self._records(300)
+        store = ColumnStore(path, DATAPOINT_FIELDS)
+        for values in records[:200]:
+            store.insert(values)
+        with open(path + ".eCO2", "rb") as f:
+            eCO2 = f.read()
+
+        store = ColumnStore(path, DATAPOINT_FIELDS + PMS7003_FIELDS)
+        for values in records[200:]:
+            store.insert(values)
+        with open(path + ".eCO2", "rb") as f:
+            self.assertTrue(f.read().startswith(eCO2))
+
+        result = store.read(fields=("eCO2", "PCNT_0_3"))
+        self._assert_records_match(result, records, ("eCO2",))
+        self.assertEqual([r["PCNT_0_3"] for r in result[:200]], [None] * 200)
+        self._assert_records_match(result[200:], records[200:], ("PCNT_0_3",))
+
+        # the schema is kept by the store; a field has to be stored the same way
+        self.assertIn("PCNT_0_3", ColumnStore(path, ()).fields)
+        with self.assertRaises(ValueError):
+            ColumnStore(path, (Field("eCO2", "I"),))
+        with self.assertRaises(ValueError):
+            store.read(fields=("pm25",))
+
+    def test_interrupted_flush(self):
+        path = mktemp()
+        records = self._records(100)
+        store = ColumnStore(path)
+        for values in records[:50]:
+            store.insert(values)
+        # the values of the next record were written but not its timestamp
+        with open(path + ".temperature", "ab") as f:
+            f.write(b"\x00\x01")
+
+        store = ColumnStore(path, flush_every=10)
+        for values in records[50:]:
+            store.insert(values)
+        self._assert_records_match(
+            ColumnStore(path).read(), records, [field.name for field in SCHEMA]
+        )
+
+    def test_pending_records_recovered_after_reset(self):
+        path = mktemp()
+        records = self._records(95)
+        backup = _MemoryBackup()
+        store = ColumnStore(path, flush_every=10, backup=backup)
+        for i, values in enumerate(records):
+            store.insert(values)
+            if i == 92:
+                stale = backup.data
+        self.assertEqual(store._count, 90)
+        self.assertTrue(backup.data)
+
+        # the station is reset before the last records are flushed
+        store = ColumnStore(path, flush_every=10, backup=backup)
+        self.assertEqual(store._count, 95)
+        self.assertEqual(backup.data, b"")
+        names = [field.name for field in SCHEMA]
+        self._assert_records_match(ColumnStore(path).read(), records, names)
+
+        # a backup of records that were flushed after all is not written twice
+        backup.data = stale
+        ColumnStore(path, backup=backup)
+        self.assertEqual(len(ColumnStore(path)), 95)
+
+    def test_flush_interval(self):
+        import time
+
+        store = ColumnStore(mktemp(), flush_every=100, flush_interval=60)
+        for values in self._records(3):
+            store.insert(values)
+        self.assertEqual(store._count, 0)
+        store._pending_since = time.time() - 61
+        store.insert(self._records(4)[3])
+        self.assertEqual(store._count, 4)
+
+    def test_short_column_file(self):
+        path = mktemp()
+        records = self._records(200)
+        store = ColumnStore(path, flush_every=200)
+        for values in records:
+            store.insert(values)
+        # a card that lost the end of a column
+        with open(path + ".eCO2", "r+b") as f:
+            f.truncate(150 * 2 + 1)
+
+        result = ColumnStore(path).read(fields=("eCO2", "aqi"))
+        self._assert_records_match(result, records, ("aqi",))
+        self._assert_records_match(result[:150], records[:150], ("eCO2",))
+        self.assertEqual([r["eCO2"] for r in result[150:]], [None] * 50)
+
+    def test_schema(self):
+        self.assertEqual(
+            tuple(field.name for field in DATAPOINT_FIELDS), DataPoint.FIELDS
+        )
+        field = Field("temperature", "h", 100)
+        self.assertEqual(field.decode(field.encode(-12.34)), -12.34)
+        self.assertEqual(field.decode(field.encode(1000)), 327.67)
+        self.assertIsNone(field.decode(field.encode(None)))
+
+    def test_convert(self):
+        db = DB(mktemp(".csv"), binary=True)
+        for dp in CompressionTestCase._samples(300):
+            db.insert(dp)
+        store = convert_to_columns(db, mktemp())
+        expected = []
+        for dp in db.read():
+            values = dp.to_dict()
+            values["timestamp"] = int(dp.timestamp)
+            expected.append(values)
+        self._assert_records_match(
+            store.read(fields=DataPoint.FIELDS), expected, DataPoint.FIELDS
+        )
+        self.assertEqual(store.read(fields=("PM10_0",))[0]["PM10_0"], None)
+
+
 if __name__ == "__main__":
     unittest.main()
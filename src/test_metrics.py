@@ -0,0 +1,65 @@
+import unittest
+
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = registry.counter("c_total", "A counter.")
+        counter.inc()
+        counter.inc(3 << 29)
+        counter.inc(1 << 29)
+        self.assertEqual(counter.value, 1 + (4 << 29))
+        # the parts of the value stay small integers
+        self.assertLess(counter._low, 1 << 29)
+
+        registry.counter("d_total", "Read elsewhere.", lambda: 7)
+        registry.counter("e_total", "Not available.", lambda: None)
+        self.assertEqual(
+            "".join(registry.expose()),
+            "# HELP c_total A counter.\n# TYPE c_total counter\nc_total %d\n"
+            "# HELP d_total Read elsewhere.\n# TYPE d_total counter\nd_total 7\n"
+            "# HELP e_total Not available.\n# TYPE e_total counter\n" % counter.value,
+        )
+        with self.assertRaises(ValueError):
+            registry.counter("c_total", "Again.")
+
+    def test_gauge(self):
+        registry = metrics.Registry()
+        gauge = registry.gauge("g", "A gauge.")
+        gauge.set(2.5)
+        registry.gauge("broken", "Fails.", lambda: 1 // 0)
+        registry.gauge("h", "Read.", lambda: 3)
+        self.assertEqual(
+            "".join(registry.expose()),
+            "# HELP g A gauge.\n# TYPE g gauge\ng 2.5\n"
+            "# HELP h Read.\n# TYPE h gauge\nh 3\n",
+        )
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram("latency_seconds", "A latency.", (1000, 5000))
+        for value in (500, 1000, 3000, 1000000):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 1004500)
+        self.assertEqual(
+            "".join(registry.expose()),
+            "# HELP latency_seconds A latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.001"} 2\n'
+            'latency_seconds_bucket{le="0.005"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 1.0045\n"
+            "latency_seconds_count 4\n",
+        )
+
+        sizes = registry.histogram("size_bytes", "A size.", (1024,), 1)
+        sizes.observe(2048)
+        self.assertIn('size_bytes_bucket{le="1024"} 0\n', "".join(registry.expose()))
+        self.assertIn("size_bytes_sum 2048\n", "".join(registry.expose()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+import asyncio
+import gzip
+import os
+import sys
+import unittest
+from tempfile import mkdtemp, mktemp
+
+import server
+from db import DB
+from live import Live
+from measurements import DataPoint, Timestamp
+from test_webserver import _serve
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "util")
+)
+
+import build_www  # noqa: E402
+import load_db  # noqa: E402
+import sync_db  # noqa: E402
+
+
+def _dp(t: int) -> DataPoint:
+    return DataPoint(
+        timestamp=t,
+        temperature=(t % 5000) / 100 - 20,
+        pressure=950 + (t % 10000) / 100,
+        relative_humidity=(t % 9000) / 100,
+        aqi=t % 5 + 1,
+        tvoc=t % 1000,
+        eCO2=400 + t % 2000,
+    )
+
+
+class LoadDbTestCase(unittest.TestCase):
+    """util/load_db.py reads the files DB writes as DB.read does"""
+
+    def _assert_loads(self, db, path: str):
+        # bounds on records, as DB finds the nearest record to a bound between two of them
+        for _from, _to in ((None, None), (99600, 199800), (86400, None), (None, 600)):
+            expected = list(
+                db.read(
+                    Timestamp(_from) if _from is not None else None,
+                    Timestamp(_to) if _to is not None else None,
+                )
+            )
+            columns = load_db.load(path, _from, _to)
+            self.assertEqual(
+                list(columns["timestamp"]), [int(dp.timestamp) for dp in expected]
+            )
+            for name in DataPoint.FIELDS:
+                for value, dp in zip(columns[name], expected):
+                    self.assertAlmostEqual(float(value), getattr(dp, name), 2, name)
+
+    def _check(self, **kwargs):
+        path = mktemp(".csv")
+        db = DB(path, **kwargs)
+        for t in range(0, 3 * 86400, 600):
+            db.insert(_dp(t))
+        db.flush()
+        self._assert_loads(db, path)
+
+        if kwargs.get("partition"):
+            db.compact()
+            self.assertTrue(any(f.endswith(".z") for f in db.files()))
+            self._assert_loads(db, path)
+
+    def test_csv(self):
+        self._check()
+
+    def test_binary(self):
+        self._check(binary=True)
+
+    def test_csv_partitioned_and_compressed(self):
+        self._check(partition="day", compress=True)
+
+    def test_binary_partitioned_and_compressed(self):
+        self._check(binary=True, partition="day", compress=True)
+
+
+class SyncDbTestCase(unittest.TestCase):
+    """util/sync_db.py against the /db and /raw routes of the server"""
+
+    def setUp(self):
+        server.database = DB(mktemp(".csv"), flush_every=1)
+        for t in range(100_000, 130_000, 30):
+            server.database.insert(_dp(t))
+        server.live = Live(size=4, max_subscribers=1)
+        self._dir = mkdtemp()
+
+    def _sync(self) -> int:
+        result = []
+
+        async def test(port):
+            loop = asyncio.get_running_loop()
+            host = "127.0.0.1:%d" % port
+            result.append(
+                await loop.run_in_executor(None, sync_db.sync, host, self._dir)
+            )
+
+        _serve(server.app, test)
+        return result[0]
+
+    def _assert_mirrored(self):
+        for path in server.database.files():
+            with open(path, "rb") as f:
+                expected = f.read()
+            with open(os.path.join(self._dir, os.path.basename(path)), "rb") as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_resume(self):
+        self.assertGreater(self._sync(), 0)
+        self._assert_mirrored()
+        (path,) = server.database.files()
+        size = os.path.getsize(path)
+
+        for t in range(130_000, 131_000, 30):
+            server.database.insert(_dp(t))
+        received = self._sync()
+        self._assert_mirrored()
+        # only what was appended since, in blocks of FILE_BLOCK bytes with their 8-byte headers
+        appended = os.path.getsize(path) - size
+        blocks = (appended + server.FILE_BLOCK - 1) // server.FILE_BLOCK
+        self.assertEqual(received, appended + 8 * blocks)
+
+        # nothing new
+        self.assertEqual(self._sync(), 0)
+
+    def test_resume_after_crc_mismatch(self):
+        self._sync()
+        (path,) = server.database.files()
+        local = os.path.join(self._dir, os.path.basename(path))
+
+        # the end of the local copy no longer matches the station's (e.g. a compressed partition);
+        # the CRC sent with the offset tells the station, and the file is downloaded again
+        with open(local, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 100)
+            f.seek(-10, os.SEEK_END)
+            f.write(b"x" * 10)
+        received = self._sync()
+        self._assert_mirrored()
+        self.assertGreater(received, os.path.getsize(path))
+
+    def test_compacted_partitions_deleted(self):
+        directory = mkdtemp()
+        server.database = DB(
+            directory + "/data.csv", flush_every=1, partition="day", compress=True
+        )
+        for t in range(0, 3 * 86400, 600):
+            server.database.insert(_dp(t))
+        with open(os.path.join(self._dir, "notes.txt"), "w") as f:
+            f.write("not the station's")
+        self._sync()
+
+        self.assertGreater(server.database.compact(), 0)
+        self._sync()
+        self._assert_mirrored()
+        names = [os.path.basename(path) for path in server.database.files()]
+        # the uncompressed partitions were replaced on the station, and are gone from the copy
+        self.assertEqual(
+            sorted(os.listdir(self._dir)),
+            sorted(names + [sync_db.MANIFEST, "notes.txt"]),
+        )
+
+
+class BuildWwwTestCase(unittest.TestCase):
+    """util/build_www.py on a page linking local files only, so that nothing is downloaded"""
+
+    def setUp(self):
+        self._src = mkdtemp()
+        self._out = os.path.join(mkdtemp(), "www")
+        files = {
+            "index.html": (
+                "<html><head>\n"
+                '<link rel="stylesheet" href="base.css" />\n'
+                '<link rel="stylesheet" href="theme.css" />\n'
+                '<!-- <script src="unused.js"></script> -->\n'
+                "</head><body>\n"
+                '<div id="graph"></div>\n'
+                '<script src="lib.min.js"></script>\n'
+                '<script src="dygraph.js"></script>\n'
+                "</body></html>\n"
+            ),
+            "base.css": "body {\n    margin: 0;\n}\n",
+            "theme.css": "/* colours */\n#graph {\n    color: red;\n}\n",
+            "lib.min.js": "var lib=1;",
+            "dygraph.js": "// draw\nfunction draw() {\n    return lib + 1;\n}\n",
+        }
+        for name, content in files.items():
+            with open(os.path.join(self._src, name), "w") as f:
+                f.write(content)
+
+    def _read(self, url: str) -> str:
+        with gzip.open(os.path.join(self._out, url + ".gz")) as f:
+            return f.read().decode()
+
+    def test_bundles(self):
+        written = build_www.build(self._src, self._out, mkdtemp())
+        self.assertEqual(len(written), 3)
+        self.assertTrue(all(path.endswith(".gz") for path in written))
+
+        page = self._read("index.html")
+        (css_url,) = build_www._STYLESHEET.findall(page)
+        (js_url,) = build_www._SCRIPT.findall(page)
+        self.assertRegex(css_url, r"^assets/app\.[0-9a-f]{10}\.css$")
+        self.assertRegex(js_url, r"^assets/app\.[0-9a-f]{10}\.js$")
+        self.assertNotIn("<!--", page)
+        # the script is loaded after the element it draws into
+        self.assertLess(page.index('id="graph"'), page.index(js_url))
+
+        # every asset, minified unless it was already, in the order of the page
+        self.assertEqual(self._read(css_url), "body{margin:0}\n#graph{color:red}")
+        self.assertEqual(
+            self._read(js_url), "var lib=1;\nfunction draw(){return lib+1;}"
+        )
+
+        # the same content gives the same files
+        with open(written[0], "rb") as f:
+            first = f.read()
+        build_www.build(self._src, self._out, mkdtemp())
+        with open(written[0], "rb") as f:
+            self.assertEqual(f.read(), first)
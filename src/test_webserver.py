@@ -0,0 +1,578 @@
+import asyncio
+import gzip
+import os
+import struct
+import unittest
+import zlib
+from tempfile import mktemp
+
+import metrics
+import db
+import server
+import webserver
+from db import DB
+from live import Live, event
+from measurements import DataPoint
+from webserver import WebServer
+import wire
+
+
+async def _request(reader, writer, path: str, headers: dict = None) -> tuple:
+    """send a request on a kept-alive connection and return the status, headers and body"""
+    lines = ["GET %s HTTP/1.1\r\n" % path, "Host: test\r\n"]
+    for name, value in (headers or {}).items():
+        lines.append("%s: %s\r\n" % (name, value))
+    writer.write(("".join(lines) + "\r\n").encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode()
+        if line == "\r\n":
+            break
+        name, _, value = line.partition(":")
+        response_headers[name.lower()] = value.strip()
+
+    body = b""
+    if response_headers.get("transfer-encoding") == "chunked":
+        while True:
+            n = int(await reader.readline(), 16)
+            body += await reader.readexactly(n + 2)
+            body = body[:-2]
+            if not n:
+                break
+    elif "content-length" in response_headers:
+        body = await reader.readexactly(int(response_headers["content-length"]))
+    return status, response_headers, body
+
+
+async def _read_event(reader) -> tuple:
+    """read a server-sent event and return its id and data lines"""
+    _id, data = None, []
+    while True:
+        line = (await reader.readline()).decode().rstrip("\n")
+        if not line:
+            if _id is not None or data:
+                return _id, data
+            continue
+        field, _, value = line.partition(": ")
+        if field == "id":
+            _id = int(value)
+        elif field == "data":
+            data.append(value)
+
+
+def _serve(app: WebServer, test):
+    """run test(port) against app on a free port"""
+
+    async def _run():
+        srv = await app.start("127.0.0.1", 0)
+        try:
+            await test(srv.sockets[0].getsockname()[1])
+            # the clients closed their connections; let the server see it
+            for _ in range(100):
+                if not app.connections:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            srv.close()
+
+    asyncio.run(_run())
+
+
+class WebServerTestCase(unittest.TestCase):
+    def _app(self, **kwargs) -> WebServer:
+        app = WebServer(**kwargs)
+
+        @app.route("/hello")
+        async def hello(request, response):
+            await response.send(200, "hello %s" % request.query.get("name", ""))
+
+        @app.route("/chunks")
+        async def chunks(request, response):
+            await response.stream("text/plain", (b"%d," % i for i in range(1000)))
+
+        @app.route("/fail")
+        async def fail(request, response):
+            raise RuntimeError("broken route")
+
+        return app
+
+    def test_keep_alive(self):
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            for name in ("a", "b%20c", "d"):
+                status, _, body = await _request(reader, writer, "/hello?name=" + name)
+                self.assertEqual(status, 200)
+                self.assertEqual(body, b"hello " + name.replace("%20", " ").encode())
+            status, _, body = await _request(reader, writer, "/chunks")
+            self.assertEqual(body, "".join("%d," % i for i in range(1000)).encode())
+            status, headers, _ = await _request(
+                reader, writer, "/hello", {"Connection": "close"}
+            )
+            self.assertEqual(headers["connection"], "close")
+            self.assertEqual(await reader.read(), b"")
+            writer.close()
+
+            # requests sent together are answered in turn
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /hello?name=a HTTP/1.1\r\n\r\n" * 2)
+            for _ in range(2):
+                self.assertIn(b" 200 ", await reader.readline())
+                while await reader.readline() != b"\r\n":
+                    pass
+                self.assertEqual(await reader.readexactly(7), b"hello a")
+            writer.close()
+
+        _serve(self._app(), test)
+
+    def test_errors(self):
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            self.assertEqual((await _request(reader, writer, "/nowhere"))[0], 404)
+            self.assertEqual((await _request(reader, writer, "/fail"))[0], 500)
+            writer.close()
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"nonsense\r\n\r\n")
+            self.assertIn(b" 400 ", await reader.readline())
+            writer.close()
+
+            # lines are cut off at MAX_LINE bytes, and the number of headers at MAX_HEADERS
+            too_long = b"x" * webserver.MAX_LINE
+            heads = (
+                (b"GET /" + too_long + b" HTTP/1.1\r\n\r\n", b" 400 "),
+                (b"GET / HTTP/1.1\r\nX-Long: " + too_long + b"\r\n\r\n", b" 431 "),
+                (b"GET / HTTP/1.1\r\n" + too_long, b" 431 "),
+                (b"GET / HTTP/1.1\r\n" + b"X: y\r\n" * 33 + b"\r\n", b" 431 "),
+            )
+            for head, status in heads:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(head)
+                self.assertIn(status, await reader.readline())
+                writer.close()
+
+        _serve(self._app(), test)
+
+    def test_connection_cap(self):
+        app = self._app(max_connections=2)
+
+        async def test(port):
+            clients = [
+                await asyncio.open_connection("127.0.0.1", port) for _ in range(2)
+            ]
+            for reader, writer in clients:
+                self.assertEqual((await _request(reader, writer, "/hello"))[0], 200)
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            self.assertIn(b" 503 ", await reader.readline())
+            writer.close()
+            self.assertEqual(app.rejected, 1)
+
+            # a connection that is closed frees its place
+            clients[0][1].close()
+            await asyncio.sleep(0.05)
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            self.assertEqual((await _request(reader, writer, "/hello"))[0], 200)
+            writer.close()
+            clients[1][1].close()
+
+        _serve(app, test)
+
+    def test_idle_timeout(self):
+        app = self._app(timeout=0.1)
+
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            self.assertEqual((await _request(reader, writer, "/hello"))[0], 200)
+            self.assertEqual(await asyncio.wait_for(reader.read(), 1), b"")
+            writer.close()
+            self.assertEqual(app.connections, 0)
+
+        _serve(app, test)
+
+    def test_heavy_cap(self):
+        app = WebServer(max_connections=8, max_heavy=2)
+        running = []
+        most = []
+
+        @app.route("/heavy", heavy=True)
+        async def heavy(request, response):
+            running.append(1)
+            most.append(len(running))
+            await asyncio.sleep(0.02)
+            running.pop()
+            await response.send(200, "done")
+
+        async def client(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status, _, body = await _request(reader, writer, "/heavy")
+            writer.close()
+            return status
+
+        async def test(port):
+            statuses = await asyncio.gather(*(client(port) for _ in range(6)))
+            self.assertEqual(statuses, [200] * 6)
+            self.assertEqual(max(most), 2)
+
+        _serve(app, test)
+
+    def test_backpressure(self):
+        app = WebServer()
+        block = b"x" * 65536
+        sent = [0]
+
+        @app.route("/big")
+        async def big(request, response):
+            response.start(200, {"Content-Length": "%d" % (1000 * len(block))})
+            for _ in range(1000):
+                await response.write(block)
+                sent[0] += len(block)
+
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /big HTTP/1.1\r\n\r\n")
+            await asyncio.sleep(0.2)
+            # the route waits for a client that does not read
+            self.assertLess(sent[0], 1000 * len(block) // 2)
+            while await reader.read(1 << 20):
+                if sent[0] == 1000 * len(block):
+                    break
+            writer.close()
+
+        _serve(app, test)
+
+
+def _dp(timestamp: int) -> DataPoint:
+    return DataPoint.from_csv(
+        "%10d, 20.00,1000.00,50.00,1,   0, %3d\n" % (timestamp, timestamp % 1000)
+    )
+
+
+class LiveTestCase(unittest.TestCase):
+    def test_ring(self):
+        live = Live(size=4)
+        self.assertIsNone(live.newest())
+        self.assertEqual(live.after(None), [])
+        self.assertFalse(live.covers(0))
+
+        for t in (30, 60, 90):
+            live.publish(_dp(t))
+        self.assertEqual(live.newest(), 90)
+        self.assertEqual([t for t, _ in live.after(30)], [60, 90])
+        self.assertEqual(live.after(30)[0][1], _dp(60).to_csv().rstrip("\n"))
+        self.assertTrue(live.covers(30))
+        # the samples before the first one are not in the ring
+        self.assertFalse(live.covers(0))
+
+        for t in (120, 150, 180):
+            live.publish(_dp(t))
+        self.assertEqual([t for t, _ in live.after(None)], [90, 120, 150, 180])
+        self.assertEqual([t for t, _ in live.after(150)], [180])
+        self.assertTrue(live.covers(90))
+        self.assertFalse(live.covers(60))
+
+    def test_wait(self):
+        live = Live()
+
+        async def test():
+            self.assertFalse(await live.wait(None, 0.01))
+            waiters = asyncio.gather(live.wait(None, 1), live.wait(None, 1))
+            await asyncio.sleep(0.01)
+            live.publish(_dp(30))
+            self.assertEqual(await waiters, [True, True])
+            self.assertTrue(await live.wait(0, 0.01))
+            self.assertFalse(await live.wait(30, 0.01))
+
+        asyncio.run(test())
+
+    def test_event(self):
+        self.assertEqual(event(30, ("a,b",)), "id: 30\ndata: a,b\n\n")
+        self.assertEqual(event(60, ("a", "b")), "id: 60\ndata: a\ndata: b\n\n")
+
+
+class WireTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        records = [_dp(t) for t in range(100_000, 100_030 * 30, 30)]
+        records[3].temperature = -12.34
+        records[4].pressure = None
+        records[5].eCO2 = 60000
+        for block_records in (1, 7, 1000):
+            payload = b"".join(
+                bytes(block) for block in wire.encode(records, block_records)
+            )
+            self.assertEqual(len(payload) % 4, 0)
+            decoded = wire.decode(payload)
+            self.assertEqual(
+                [t for t, _ in decoded], [int(dp.timestamp) for dp in records]
+            )
+            for (_, values), dp in zip(decoded, records):
+                for field, value in zip(wire.FIELDS, values):
+                    expected = getattr(dp, field.name)
+                    if expected is None:
+                        self.assertIsNone(value)
+                    else:
+                        self.assertAlmostEqual(value, expected, delta=0.5 / field.scale)
+
+        self.assertEqual(b"".join(wire.encode([])), b"")
+
+    def test_size(self):
+        records = [_dp(t) for t in range(100_000, 100_000 + 1000 * 30, 30)]
+        payload = b"".join(bytes(block) for block in wire.encode(records))
+        csv = "".join(dp.to_csv() for dp in records).encode()
+        self.assertLess(len(payload) * 2.5, len(csv))
+
+
+class RoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        server.database = DB(mktemp(".csv"), flush_every=5)
+        for t in range(100_000, 130_000, 30):
+            server.database.insert(_dp(t))
+        server.live = Live(size=4, max_subscribers=1)
+
+        self._www = mktemp()
+        os.makedirs(self._www + "/assets")
+        with open(self._www + "/index.html.gz", "wb") as f:
+            f.write(gzip.compress(b"<html></html>"))
+        with open(self._www + "/assets/app.js", "wb") as f:
+            f.write(bytes(range(256)) * 10)
+        server.static_routes(self._www)
+
+    def _get(self, path: str, headers: dict = None) -> tuple:
+        result = []
+
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            result.append(await _request(reader, writer, path, headers))
+            writer.close()
+
+        _serve(server.app, test)
+        return result[0]
+
+    def test_data(self):
+        status, headers, body = self._get("/data")
+        self.assertEqual(status, 200)
+        expected = DataPoint.CSV_HEADER + "".join(
+            dp.to_csv() for dp in server.database.read()
+        )
+        self.assertEqual(body.decode(), expected)
+
+        status, _, body = self._get("/data", {"If-None-Match": headers["etag"]})
+        self.assertEqual((status, body), (304, b""))
+
+        status, headers, body = self._get("/data?since=129000")
+        self.assertEqual(headers["x-cursor"], "129970")
+        self.assertEqual(len(body.decode().splitlines()), 34)
+
+        self.assertEqual(self._get("/data?since=x")[0], 400)
+        for path in ("/data", "/aggregate", "/columns"):
+            self.assertEqual(self._get(path + "?from=abc")[0], 400)
+            self.assertEqual(self._get(path + "?from=0&to=1.5")[0], 400)
+
+    def test_data_bin(self):
+        status, headers, body = self._get("/data?format=bin")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "application/octet-stream")
+        self.assertEqual(headers["x-fields"], wire.describe())
+        records = server.database.read()
+        self.assertEqual(
+            wire.decode(body),
+            wire.decode(b"".join(bytes(b) for b in wire.encode(records))),
+        )
+        self.assertEqual(len(wire.decode(body)), len(records))
+
+        status, headers, body = self._get("/data?since=129000&format=bin")
+        self.assertEqual(headers["x-cursor"], "129970")
+        self.assertEqual(
+            [t for t, _ in wire.decode(body)], list(range(129010, 130000, 30))
+        )
+
+        status, _, body = self._get("/data?max_points=100&format=bin")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(wire.decode(body)), 100)
+
+        self.assertEqual(self._get("/data?format=xml")[0], 400)
+        self.assertEqual(self._get("/data?resolution=1h&format=bin")[0], 400)
+
+    def _count_ticks(self, path: str) -> tuple:
+        """get path while another task counts how often the loop runs it; return the response and the
+        count"""
+        result = []
+
+        async def test(port):
+            ticks = [0]
+
+            async def tick():
+                while True:
+                    ticks[0] += 1
+                    await asyncio.sleep(0)
+
+            task = asyncio.create_task(tick())
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            response = await _request(reader, writer, path)
+            task.cancel()
+            writer.close()
+            result.append((response, ticks[0]))
+
+        _serve(server.app, test)
+        return result[0]
+
+    def test_downsample_lets_other_tasks_run(self):
+        server.database = DB(mktemp(".csv"), flush_every=1000)
+        for t in range(0, 20000 * 30, 30):
+            server.database.insert(_dp(t))
+        server.database.flush()
+
+        for path in ("/data?max_points=10", "/data?max_points=10&format=bin"):
+            (status, _, _), ticks = self._count_ticks(path)
+            self.assertEqual(status, 200)
+            # at least once per chunk of each of the two passes over the records
+            self.assertGreater(ticks, 2 * 20000 // db.AGGREGATE_CHUNK_RECORDS)
+
+    def test_aggregate_lets_other_tasks_run(self):
+        server.database = DB(mktemp(".csv"), flush_every=1000)
+        for t in range(0, 20000 * 30, 30):
+            server.database.insert(_dp(t))
+        server.database.flush()
+
+        (status, _, body), ticks = self._count_ticks("/aggregate?bucket=2678400")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body.decode().splitlines()), 2)
+        # a single bucket, read a chunk at a time
+        self.assertGreater(ticks, 20000 // db.AGGREGATE_CHUNK_RECORDS)
+
+        self.assertEqual(self._get("/aggregate?bucket=2678401")[0], 400)
+
+    def test_metrics(self):
+        data = metrics.REGISTRY.get("airstation_http_data_seconds")
+        count = data.count
+        _, _, body = self._get("/data")
+        self.assertEqual(data.count, count + 1)
+        _size = metrics.REGISTRY.get("airstation_http_data_response_bytes")
+        self.assertGreaterEqual(_size.sum, len(body))
+
+        status, headers, body = self._get("/metrics")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["content-type"].startswith("text/plain"))
+        text = body.decode()
+        for name in (
+            "airstation_http_data_seconds_count",
+            "airstation_http_requests_total",
+            "airstation_db_insert_seconds_bucket",
+            "airstation_db_read_bytes_total",
+        ):
+            self.assertIn("\n" + name, text)
+        for line in text.splitlines():
+            if not line.startswith("#"):
+                float(line.rsplit(" ", 1)[1])
+
+    def test_static(self):
+        status, headers, body = self._get("/")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body), b"<html></html>")
+
+        status, headers, body = self._get("/assets/app.js", {"Range": "bytes=250-261"})
+        self.assertEqual(status, 206)
+        self.assertEqual(headers["content-range"], "bytes 250-261/2560")
+        self.assertEqual(body, bytes(range(250, 256)) + bytes(range(6)))
+        self.assertIn("immutable", headers["cache-control"])
+
+        status, _, _ = self._get("/assets/app.js", {"Range": "bytes=3000-"})
+        self.assertEqual(status, 416)
+
+    def test_raw(self):
+        server.database.flush()
+        path = server.database.files()[-1]
+        with open(path, "rb") as f:
+            content = f.read()
+
+        status, headers, body = self._get("/raw?offset=1000")
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers["x-file-size"]), len(content))
+        received = b""
+        while True:
+            n, crc = struct.unpack_from("<II", body)
+            if not n:
+                break
+            _end = 8 + n
+            block = body[8:_end]
+            self.assertEqual(zlib.crc32(block), crc)
+            received += block
+            body = body[_end:]
+        self.assertEqual(received, content[1000:])
+
+        check = zlib.crc32(b"not what the station has")
+        self.assertEqual(self._get("/raw?offset=1000&check=%d" % check)[0], 409)
+
+    def test_live(self):
+        heartbeat = server.HEARTBEAT
+        server.HEARTBEAT = 0.05
+        self.addCleanup(setattr, server, "HEARTBEAT", heartbeat)
+
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status, headers, _ = await _request(reader, writer, "/live?since=129000")
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["content-type"], "text/event-stream")
+
+            # what the ring does not hold is read from the database, 16 samples per event
+            expected = [
+                dp.to_csv().rstrip("\n") for dp in server.database.since(129000)[1]
+            ]
+            received = []
+            while len(received) < len(expected):
+                _id, lines = await _read_event(reader)
+                received.extend(lines)
+            self.assertEqual(received, expected)
+            self.assertEqual(_id, 129970)
+
+            # then the samples as they are published
+            server.live.publish(_dp(130000))
+            self.assertEqual(
+                await _read_event(reader), (130000, [_dp(130000).to_csv().rstrip("\n")])
+            )
+
+            # the one subscriber allowed is taken
+            reader2, writer2 = await asyncio.open_connection("127.0.0.1", port)
+            status, headers, _ = await _request(reader2, writer2, "/live")
+            self.assertEqual(status, 503)
+            self.assertIn("retry-after", headers)
+            writer2.close()
+
+            # a subscriber that went away is dropped at the next heartbeat
+            writer.close()
+            for _ in range(100):
+                if not server.live.subscribers:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(server.live.subscribers, 0)
+
+        _serve(server.app, test)
+        self.assertEqual(self._get("/live?since=x")[0], 400)
+
+    def test_live_replay_waits_for_heavy_routes(self):
+        async def first_event(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await _request(reader, writer, "/live?since=129000")
+            event = await _read_event(reader)
+            writer.close()
+            return event
+
+        async def test(port):
+            # a heavy route is running
+            await server.app.acquire_heavy()
+            replay = asyncio.ensure_future(first_event(port))
+            await asyncio.sleep(0.1)
+            self.assertFalse(replay.done())
+
+            server.app.release_heavy()
+            _id, lines = await asyncio.wait_for(replay, 1)
+            self.assertEqual(len(lines), 16)
+
+        _serve(server.app, test)
+
+
+if __name__ == "__main__":
+    unittest.main()
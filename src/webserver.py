@@ -0,0 +1,343 @@
+import asyncio
+import json
+
+# the reason phrases of the status codes the routes answer with
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# the most header lines a request may have
+MAX_HEADERS = 32
+# the longest request line or header line, in bytes
+MAX_LINE = 1024
+
+
+class Request:
+    """The request line and headers of a request; header names are lower case."""
+
+    def __init__(
+        self, method: str, path: str, query: dict, headers: dict, version: str
+    ):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.version = version
+
+
+class Response:
+    """The response to a request, written to the connection as it is produced.
+
+    Every write waits for the connection to take the data (StreamWriter.drain), so a slow client
+    holds back the route that answers it instead of filling the memory of the station.
+    """
+
+    def __init__(self, writer, keep_alive: bool):
+        self._writer = writer
+        self.keep_alive = keep_alive
+        self.status = None
+        # bytes of the body written so far
+        self.sent = 0
+
+    def start(self, status: int, headers: dict = None, contentType: str = None):
+        """write the status line and the headers; the body must then have the length given in
+        Content-Length, or be chunked (see stream)"""
+        self.status = status
+        lines = ["HTTP/1.1 %d %s\r\n" % (status, REASONS.get(status, ""))]
+        if contentType is not None:
+            lines.append("Content-Type: %s\r\n" % contentType)
+        if headers:
+            for name, value in headers.items():
+                lines.append("%s: %s\r\n" % (name, value))
+        lines.append("Server: airstation\r\n")
+        lines.append(
+            "Connection: %s\r\n\r\n" % ("keep-alive" if self.keep_alive else "close")
+        )
+        self._writer.write("".join(lines).encode())
+
+    async def write(self, data):
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.encode()
+        elif not isinstance(data, bytes):
+            # CPython may keep a view of what the socket did not take yet, and routes reuse their
+            # buffers for the next block
+            data = bytes(data)
+        self.sent += len(data)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def send(
+        self, status: int, body=b"", contentType: str = None, headers: dict = None
+    ):
+        """write a whole response with a body held in memory"""
+        if isinstance(body, str):
+            body = body.encode()
+        headers = dict(headers) if headers else {}
+        if status != 304:
+            headers["Content-Length"] = "%d" % len(body)
+        self.start(status, headers, contentType)
+        await self.write(body)
+        await self._writer.drain()
+
+    async def json(self, value, status: int = 200):
+        await self.send(status, json.dumps(value), "application/json")
+
+    async def error(self, status: int, headers: dict = None):
+        await self.send(status, REASONS.get(status, "") + "\n", "text/plain", headers)
+
+    async def stream(self, contentType: str, chunks, headers: dict = None):
+        """write a 200 response using chunked transfer encoding
+
+        The body is sent as the chunks are produced, so its size does not need to be known (or held in
+        memory) up front. An empty chunk or None sends nothing but lets the other tasks run, for
+        producers that read a lot before they have something to send (e.g. DB.downsample).
+        """
+        headers = dict(headers) if headers else {}
+        headers["Transfer-Encoding"] = "chunked"
+        self.start(200, headers, contentType)
+        for chunk in chunks:
+            if chunk:
+                self._writer.write(("%x\r\n" % len(chunk)).encode())
+                await self.write(chunk)
+                self._writer.write(b"\r\n")
+            else:
+                await asyncio.sleep(0)
+        self._writer.write(b"0\r\n\r\n")
+        await self._writer.drain()
+
+
+class WebServer:
+    """An HTTP/1.1 server for the routes of server.py, run by asyncio next to the sampling loop.
+
+    Connections are kept alive between requests until they are idle for `timeout` seconds. At most
+    max_connections are open at a time; more are answered with 503 and closed, so the memory the
+    server takes is bounded whatever the number of clients. Routes declared heavy (the ones that read
+    the database) run max_heavy at a time and the others wait for their turn.
+    """
+
+    def __init__(self, max_connections: int = 4, max_heavy: int = 1, timeout: int = 10):
+        self.max_connections = max_connections
+        self.max_heavy = max_heavy
+        self.timeout = timeout
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+        self._routes = {}
+        self._heavy = 0
+        self._heavy_done = None
+
+    def route(self, path: str, heavy: bool = False):
+        """a decorator of the coroutine answering GET requests of path: handler(request, response)"""
+
+        def _route(handler):
+            self._routes[path] = (handler, heavy)
+            return handler
+
+        return _route
+
+    async def start(self, host: str = "0.0.0.0", port: int = 80, backlog: int = 4):
+        """start accepting connections and return the asyncio server"""
+        # created on the loop it is used by
+        self._heavy_done = asyncio.Event()
+        return await asyncio.start_server(self._serve, host, port, backlog=backlog)
+
+    async def _serve(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.rejected += 1
+            await self._close(writer, 503, {"Retry-After": "1"})
+            return
+
+        self.connections += 1
+        lines = _LineReader(reader)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(lines), self.timeout)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    await self._close(writer, 400)
+                    return
+                except OverflowError:
+                    await self._close(writer, 431)
+                    return
+                if request is None:
+                    break
+
+                response = Response(writer, _keep_alive(request))
+                await self._handle(request, response)
+                if not response.keep_alive:
+                    break
+        except OSError:
+            # the client went away
+            pass
+        finally:
+            self.connections -= 1
+            await _close_writer(writer)
+
+    async def _handle(self, request: Request, response: Response):
+        self.requests += 1
+        if request.method != "GET":
+            response.keep_alive = False
+            await response.error(405, {"Allow": "GET"})
+            return
+        route = self._routes.get(request.path)
+        if route is None:
+            await response.error(404)
+            return
+
+        handler, heavy = route
+        if heavy:
+            await self.acquire_heavy()
+        try:
+            await handler(request, response)
+        except Exception as e:
+            if not isinstance(e, OSError):
+                print("Failed to answer %s: %r" % (request.path, e))
+            if response.status is None and not isinstance(e, OSError):
+                response.keep_alive = False
+                await response.error(500)
+            else:
+                # the response is incomplete, the client can only tell by the connection closing
+                response.keep_alive = False
+        finally:
+            if heavy:
+                self.release_heavy()
+
+    async def acquire_heavy(self):
+        """wait for a heavy route to finish if max_heavy are running, for work as heavy as theirs
+        done by a route that isn't (release_heavy() when done)"""
+        while self._heavy >= self.max_heavy:
+            self._heavy_done.clear()
+            await self._heavy_done.wait()
+        self._heavy += 1
+
+    def release_heavy(self):
+        self._heavy -= 1
+        self._heavy_done.set()
+
+    @staticmethod
+    async def _close(writer, status: int, headers: dict = None):
+        try:
+            await Response(writer, False).error(status, headers)
+        except OSError:
+            pass
+        await _close_writer(writer)
+
+
+async def _close_writer(writer):
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+class _LineReader:
+    """Reads the lines of request heads from a stream, at most MAX_LINE bytes each.
+
+    The readline() of MicroPython's streams has no limit, so a client sending a line that never ends
+    would take all the memory. What is read after a line is kept for the next one."""
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._buf = b""
+
+    async def readline(self) -> bytes:
+        """the next line, with its newline; what is left (b"" at first) if the client closed the
+        connection, and OverflowError for a line longer than MAX_LINE"""
+        while True:
+            _end = self._buf.find(b"\n") + 1
+            if _end > MAX_LINE or (not _end and len(self._buf) >= MAX_LINE):
+                raise OverflowError("line too long")
+            if _end:
+                line = self._buf[:_end]
+                self._buf = self._buf[_end:]
+                return line
+            data = await self._reader.read(MAX_LINE)
+            if not data:
+                line = self._buf
+                self._buf = b""
+                return line
+            self._buf += data
+
+
+async def _read_request(lines: _LineReader) -> Request:
+    """read a request line and its headers; None if the client closed the connection
+
+    Raise ValueError for a malformed request (or a request line longer than MAX_LINE) and
+    OverflowError for one with too many headers or a header line longer than MAX_LINE.
+    """
+    try:
+        line = await lines.readline()
+    except OverflowError:
+        raise ValueError("request line too long")
+    if not line:
+        return None
+    parts = line.decode().split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise ValueError("bad request line")
+    method, target, version = parts
+
+    headers = {}
+    # header lines, as a repeated header does not add to headers
+    count = 0
+    while True:
+        line = await lines.readline()
+        if not line:
+            return None
+        if line in (b"\r\n", b"\n"):
+            break
+        count += 1
+        if count > MAX_HEADERS:
+            raise OverflowError("too many headers")
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    path, _, query = target.partition("?")
+    return Request(method, unquote(path), parse_query(query), headers, version)
+
+
+def _keep_alive(request: Request) -> bool:
+    connection = request.headers.get("connection", "").lower()
+    if request.version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+def parse_query(query: str) -> dict:
+    params = {}
+    for param in query.split("&"):
+        if not param:
+            continue
+        name, _, value = param.partition("=")
+        params[unquote(name)] = unquote(value)
+    return params
+
+
+def unquote(s: str) -> str:
+    """decode the %XX escapes and the + of a URL component"""
+    s = s.replace("+", " ")
+    if "%" not in s:
+        return s
+    parts = s.split("%")
+    decoded = bytearray(parts[0].encode())
+    for part in parts[1:]:
+        try:
+            decoded.append(int(part[:2], 16))
+            decoded.extend(part[2:].encode())
+        except ValueError:
+            decoded.extend(b"%" + part.encode())
+    return decoded.decode()
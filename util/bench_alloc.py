@@ -0,0 +1,126 @@
+"""Measure the memory allocated per sample by the sampling and reading paths of db.DB.
+
+Usage: python util/bench_alloc.py [number of samples]
+       micropython util/bench_alloc.py [number of samples]
+
+Under MicroPython (e.g. the unix port) the garbage collector is disabled while the samples are processed,
+so the gc.mem_alloc() delta is every byte allocated, divided by the number of samples. CPython frees
+most objects as soon as they are dropped, so tracemalloc reports the bytes still held after the run
+(retained, including the open file and buffers of a read) and the most allocated at once while handling a sample (transient), typically and at worst
+(a flush, or reading the next chunk of the file)."""
+
+import gc
+import sys
+from array import array
+
+try:
+    import os.path as _os_path
+
+    _src = _os_path.join(_os_path.dirname(_os_path.abspath(__file__)), "..", "src")
+except ImportError:
+    # MicroPython has no os.path
+    _src = __file__.rsplit("/", 1)[0] + "/../src" if "/" in __file__ else "../src"
+sys.path.insert(0, _src)
+
+from db import DB  # noqa: E402
+from measurements import DataPoint, Timestamp  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _remove(path: str):
+    import os
+
+    for p in (path, path + ".idx"):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def measure(steps, num_samples: int) -> dict:
+    """run steps (an iterator doing the work of one sample per item) and return the allocations"""
+    if tracemalloc is None:
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.mem_alloc()
+            for _ in steps:
+                pass
+            return {"bytes_per_sample": (gc.mem_alloc() - before) / num_samples}
+        finally:
+            gc.enable()
+
+    # allocated up front, so that recording a sample does not allocate
+    transient = array("l", [0]) * num_samples
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        current = before
+        for i in range(num_samples):
+            tracemalloc.reset_peak()
+            next(steps)
+            transient[i] = tracemalloc.get_traced_memory()[1] - current
+            current = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    transient = sorted(transient)
+    return {
+        "retained_bytes_per_sample": (current - before) / num_samples,
+        "median_transient_bytes": transient[num_samples // 2],
+        "max_transient_bytes": transient[-1],
+    }
+
+
+def _insert(db: DB, num_samples: int):
+    dp = DataPoint(
+        timestamp=0,
+        temperature=21.5,
+        pressure=1013.25,
+        relative_humidity=40.0,
+        aqi=1,
+        tvoc=100,
+        eCO2=400,
+    )
+    for i in range(num_samples):
+        dp.timestamp = 1000 + 30 * i
+        dp.temperature = 20 + (i % 100) / 10
+        db.insert(dp)
+        yield
+
+
+def run(num_samples: int) -> dict:
+    results = {}
+    for name, binary in (("csv", False), ("binary", True)):
+        path = "/tmp/airstation-alloc-%s.db" % name
+        _remove(path)
+        try:
+            db = DB(path, binary=binary, flush_every=10)
+            # warm up: the first flush opens the file and the index
+            for _ in _insert(db, 20):
+                pass
+            results[name + " insert"] = measure(_insert(db, num_samples), num_samples)
+            db.flush()
+
+            _count = num_samples + 20
+            _from = Timestamp(0)
+            results[name + " iter_range"] = measure(db.iter_range(_from), _count)
+            results[name + " iter_range(reuse=True)"] = measure(
+                db.iter_range(_from, reuse=True), _count
+            )
+        finally:
+            _remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print("%d samples, %s" % (num_samples, sys.implementation.name))
+    for path, result in run(num_samples).items():
+        print(
+            "%-30s %s"
+            % (path, ", ".join("%s=%.1f" % (k, v) for k, v in result.items()))
+        )
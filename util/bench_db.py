@@ -0,0 +1,261 @@
+"""Benchmark db.DB on data files of production sizes.
+
+Usage: python util/bench_db.py [--sizes day,month,year,5years] [--lookups N] [--inserts N] [--seed N]
+                               [--data-dir DIR] [--output FILE]
+
+Generates /sd/data.csv-format databases of 1 day, 1 month, 1 year and 5 years of samples at a 30 s
+cadence, with outages and clock jumps, and measures for each of them:
+- the time to open the database (building the index of a new file),
+- DB.insert throughput (with the buffering of main.py),
+- the latency and number of file reads of Segment._find_timestamp_offset and of the indexed seek,
+- DB.read throughput over a day and a month of data,
+- the peak memory (tracemalloc) of opening the database and of the reads.
+
+The generated files are kept in the data directory and reused by the next run with the same seed, so
+runs on different commits measure the same data. Results are printed, or written to the output file, as
+JSON along with the commit they were measured on."""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from db import DB  # noqa: E402
+from measurements import DataPoint, Timestamp  # noqa: E402
+from segment import Segment  # noqa: E402
+
+CADENCE = 30
+DAY = 86400
+
+# name and number of records of each database size
+SIZES = (
+    ("day", DAY // CADENCE),
+    ("month", 30 * DAY // CADENCE),
+    ("year", 365 * DAY // CADENCE),
+    ("5years", 5 * 365 * DAY // CADENCE),
+)
+
+
+def generate(path: str, num_records: int, seed: int = 0):
+    """write a database of num_records samples of a slow random walk
+
+    Samples are 29-32 s apart. About every 5000 samples (two days) there is an outage of a minute to
+    12 hours; about every 20000 samples the clock jumps, forward by up to a day (the RTC was set after
+    running on its own) or back by up to two minutes (a correction of a fast clock)."""
+    rng = random.Random(seed)
+    t = 800_000_000
+    temperature, pressure, humidity, tvoc, eCO2 = 21.0, 1013.0, 45.0, 100, 400
+    with open(path, "w") as f:
+        f.write(DataPoint.CSV_HEADER)
+        lines = []
+        for _ in range(num_records):
+            t += CADENCE + rng.choice((0, 0, 0, 1, -1, 2))
+            if rng.random() < 1 / 5000:
+                t += rng.randint(60, 12 * 3600)
+            if rng.random() < 1 / 20000:
+                t += rng.choice((rng.randint(60, DAY), -rng.randint(1, 120)))
+            temperature = min(max(temperature + rng.randint(-3, 3) / 100, 5), 35)
+            pressure = min(max(pressure + rng.randint(-5, 5) / 100, 950), 1050)
+            humidity = min(max(humidity + rng.randint(-10, 10) / 100, 10), 90)
+            tvoc = min(max(tvoc + rng.randint(-5, 5), 0), 9999)
+            eCO2 = min(max(eCO2 + rng.randint(-8, 8), 400), 9999)
+            dp = DataPoint(
+                timestamp=Timestamp(t),
+                temperature=temperature,
+                pressure=pressure,
+                relative_humidity=humidity,
+                aqi=1 + tvoc // 2000,
+                tvoc=tvoc,
+                eCO2=eCO2,
+            )
+            lines.append(dp.to_csv())
+            if len(lines) == 4096:
+                f.write("".join(lines))
+                lines = []
+        f.write("".join(lines))
+
+
+def data_file(data_dir: str, name: str, num_records: int, seed: int) -> str:
+    """the path of a generated database, generating it unless a previous run did"""
+    path = os.path.join(data_dir, "%s-%d.csv" % (name, seed))
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        _tmp = path + ".tmp"
+        generate(_tmp, num_records, seed)
+        os.replace(_tmp, path)
+    return path
+
+
+def timestamps_range(path: str) -> tuple:
+    segment = Segment(path, index=False)
+    return segment.first_ts, segment.last_ts
+
+
+def peak_memory(fn) -> int:
+    """the peak number of bytes allocated while fn() runs"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_open(path: str) -> dict:
+    for p in (path + ".idx",):
+        if os.path.exists(p):
+            os.remove(p)
+    start = time.perf_counter()
+    DB(path)
+    elapsed = time.perf_counter() - start
+    os.remove(path + ".idx")
+    return {
+        "seconds": elapsed,
+        "peak_bytes": peak_memory(lambda: DB(path)),
+    }
+
+
+def bench_insert(path: str, num_inserts: int) -> dict:
+    """insert num_inserts samples after the last one of a copy of the database"""
+    _copy = path + ".insert.csv"
+    shutil.copyfile(path, _copy)
+    try:
+        db = DB(_copy, flush_every=10)
+        t = db._open_segment(db._parts[-1]).last_ts
+        dp = DataPoint.from_csv("0,21.50,1013.25,40.00,1,100,400")
+        start = time.perf_counter()
+        for _ in range(num_inserts):
+            t += CADENCE
+            dp.timestamp = Timestamp(t)
+            db.insert(dp)
+        db.flush()
+        elapsed = time.perf_counter() - start
+        return {
+            "records_per_second": num_inserts / elapsed,
+            "us_per_record": elapsed / num_inserts * 1e6,
+        }
+    finally:
+        for p in (_copy, _copy + ".idx"):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def bench_seek(path: str, num_lookups: int, rng: random.Random) -> dict:
+    first_ts, last_ts = timestamps_range(path)
+    lookups = [Timestamp(rng.randint(first_ts, last_ts)) for _ in range(num_lookups)]
+    results = {}
+    for method, segment in (
+        ("bisection", Segment(path, index=False, cadence=0)),
+        ("indexed", Segment(path)),
+    ):
+        seek = segment._find_timestamp_offset if method == "bisection" else segment.seek
+        reads = []
+        start = time.perf_counter()
+        for t in lookups:
+            segment.reads = 0
+            seek(t)
+            reads.append(segment.reads)
+        elapsed = time.perf_counter() - start
+        results[method] = {
+            "us_per_lookup": elapsed / num_lookups * 1e6,
+            "reads_per_lookup": sum(reads) / num_lookups,
+            "max_reads": max(reads),
+        }
+    return results
+
+
+def bench_read(path: str, rng: random.Random) -> dict:
+    db = DB(path)
+    first_ts, last_ts = timestamps_range(path)
+    results = {}
+    for name, seconds in (("day", DAY), ("month", 30 * DAY)):
+        _from = rng.randint(first_ts, max(first_ts, last_ts - seconds))
+        _to = _from + seconds
+        start = time.perf_counter()
+        n = len(db.read(Timestamp(_from), Timestamp(_to)))
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "records": n,
+            "records_per_second": n / elapsed if elapsed else None,
+            "peak_bytes": peak_memory(
+                lambda: db.read(Timestamp(_from), Timestamp(_to))
+            ),
+            "streaming_peak_bytes": peak_memory(
+                lambda: sum(1 for _ in db.iter_range(Timestamp(_from), Timestamp(_to)))
+            ),
+        }
+    return results
+
+
+def run(sizes: list, num_lookups: int, num_inserts: int, seed: int, data_dir: str):
+    results = {}
+    for name, num_records in SIZES:
+        if name not in sizes:
+            continue
+        rng = random.Random(seed)
+        path = data_file(data_dir, name, num_records, seed)
+        print("%s: %d records" % (name, num_records), file=sys.stderr)
+        results[name] = {
+            "records": num_records,
+            "file_bytes": os.path.getsize(path),
+            "open": bench_open(path),
+            "insert": bench_insert(path, num_inserts),
+            "seek": bench_seek(path, num_lookups, rng),
+            "read": bench_read(path, rng),
+        }
+    return results
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(name for name, _ in SIZES))
+    parser.add_argument("--lookups", type=int, default=1_000)
+    parser.add_argument("--inserts", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir", default=os.path.join(tempfile.gettempdir(), "airstation-bench")
+    )
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    for name in sizes:
+        if name not in dict(SIZES):
+            parser.error("unknown size %s" % name)
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "lookups": args.lookups,
+        "inserts": args.inserts,
+        "results": run(sizes, args.lookups, args.inserts, args.seed, args.data_dir),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,101 @@
+"""Compare the seek strategies of segment.Segment on synthetic data files.
+
+Usage: python util/bench_seek.py [--records N] [--lookups N] [--seed N]
+
+Generates a CSV database with a ~30 s cadence, jitter and outages and looks up random timestamps with
+the bisection (_find_timestamp_offset), the interpolation search and the index, reporting the number of
+file reads and the wall time per lookup."""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from measurements import DataPoint, Timestamp  # noqa: E402
+from segment import Segment  # noqa: E402
+
+
+def generate(path: str, num_records: int, seed: int = 0) -> list:
+    """write a database of num_records samples and return its timestamps
+
+    Samples are 29-32 s apart, with an outage every ~5000 samples (about two days of data).
+    """
+    rng = random.Random(seed)
+    outage_at = set(rng.randrange(num_records) for _ in range(num_records // 5000))
+    line = DataPoint.from_csv("0,21.50,1013.25,40.00,1,100,400").to_csv()[10:]
+
+    timestamps = []
+    t = 800_000_000
+    with open(path, "w") as f:
+        f.write(DataPoint.CSV_HEADER)
+        for i in range(num_records):
+            t += 30 + rng.randint(-1, 2)
+            if i in outage_at:
+                # anything from a reset to a night without power
+                t += rng.randint(60, 12 * 3600)
+            timestamps.append(t)
+            f.write("%10d%s" % (t, line))
+    return timestamps
+
+
+def measure(segment: Segment, seek, lookups: list) -> dict:
+    reads = []
+    start = time.perf_counter()
+    for t in lookups:
+        segment.reads = 0
+        seek(Timestamp(t))
+        reads.append(segment.reads)
+    elapsed = time.perf_counter() - start
+    return {
+        "reads_per_lookup": sum(reads) / len(lookups),
+        "max_reads": max(reads),
+        "within_3_reads": sum(1 for r in reads if r <= 3) / len(lookups),
+        "us_per_lookup": elapsed / len(lookups) * 1e6,
+    }
+
+
+def run(num_records: int, num_lookups: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    path = tempfile.mktemp(".csv")
+    try:
+        timestamps = generate(path, num_records, seed)
+        lookups = [
+            rng.randint(timestamps[0], timestamps[-1]) for _ in range(num_lookups)
+        ]
+
+        plain = Segment(path, index=False)
+        indexed = Segment(path)
+        return {
+            "bisection": measure(plain, plain._find_timestamp_offset, lookups),
+            "interpolation": measure(plain, plain._interpolation_offset, lookups),
+            "index": measure(indexed, indexed.seek, lookups),
+        }
+    finally:
+        for p in (path, path + ".idx"):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(args.records, args.lookups, args.seed)
+    print(f"{args.records} records, {args.lookups} lookups")
+    print(
+        f"{'method':<15}{'reads/lookup':>14}{'max':>6}{'<=3 reads':>11}{'us/lookup':>12}"
+    )
+    for method, r in results.items():
+        print(
+            f"{method:<15}{r['reads_per_lookup']:>14.2f}{r['max_reads']:>6}"
+            f"{r['within_3_reads']:>11.0%}{r['us_per_lookup']:>12.1f}"
+        )
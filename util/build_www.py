@@ -0,0 +1,113 @@
+"""Build the dashboard for the station: one script and one stylesheet, minified and gzipped.
+
+Usage: python util/build_www.py [OUT] [--src DIR] [--cache-dir DIR]
+
+The scripts and stylesheets www/index.html links to, from a CDN or from www itself, are concatenated in
+the order of the page into assets/app.<hash>.js and assets/app.<hash>.css, minified (rjsmin, rcssmin)
+and gzipped. The page is rewritten to load the two bundles and gzipped as well, so the station serves
+three requests, all compressed, and the dashboard works on a LAN without internet access.
+
+The bundles are named after a hash of their content, so server.route_static lets browsers cache
+anything under /assets/ for good; index.html is revalidated on every load (see server.static_routes).
+Only the .gz files are written, as every browser accepts gzip. Downloaded files are kept in the cache
+directory, so builds after the first one work offline."""
+
+import argparse
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import urllib.request
+
+import rcssmin
+import rjsmin
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+_SCRIPT = re.compile(r'<script[^>]*\ssrc="([^"]+)"[^>]*>\s*</script>\s*')
+_STYLESHEET = re.compile(r'<link[^>]*\shref="([^"]+\.css)"[^>]*/?>\s*')
+_COMMENT = re.compile(r"<!--.*?-->\s*", re.S)
+
+
+def fetch(src: str, src_dir: str, cache_dir: str) -> str:
+    """the content of a file the page links to: a URL, downloaded once into cache_dir, or a path
+    relative to src_dir"""
+    if not src.startswith(("http://", "https://")):
+        with open(os.path.join(src_dir, src), encoding="utf-8") as f:
+            return f.read()
+
+    name = hashlib.sha256(src.encode()).hexdigest()[:16] + "-" + src.rsplit("/", 1)[-1]
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with urllib.request.urlopen(src) as response:
+            data = response.read()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def write_gzip(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # mtime=0 so that the same content gives the same file
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, 9, mtime=0))
+
+
+def bundle(name: str, ext: str, parts: list, out: str) -> str:
+    """write the parts (already minified) as assets/<name>.<hash>.<ext>.gz and return its URL"""
+    data = "\n".join(parts).encode()
+    url = "assets/%s.%s.%s" % (name, hashlib.sha256(data).hexdigest()[:10], ext)
+    write_gzip(os.path.join(out, url), data)
+    return url
+
+
+def build(src_dir: str, out: str, cache_dir: str) -> list:
+    """build the dashboard in src_dir into out and return the files written"""
+    with open(os.path.join(src_dir, "index.html"), encoding="utf-8") as f:
+        page = _COMMENT.sub("", f.read())
+
+    scripts, stylesheets = [], []
+    for src in _SCRIPT.findall(page):
+        code = fetch(src, src_dir, cache_dir)
+        # the files of a CDN are minified already
+        scripts.append(code if src.endswith(".min.js") else rjsmin.jsmin(code))
+    for href in _STYLESHEET.findall(page):
+        css = fetch(href, src_dir, cache_dir)
+        stylesheets.append(css if href.endswith(".min.css") else rcssmin.cssmin(css))
+
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    js_url = bundle("app", "js", scripts, out)
+    css_url = bundle("app", "css", stylesheets, out)
+
+    # every link but the last is removed and the last one is replaced by the bundle: the stylesheet
+    # goes where the last stylesheet was, and the script where the last script was, after the
+    # elements it draws into
+    page = _STYLESHEET.sub("", page, count=len(stylesheets) - 1)
+    page = _STYLESHEET.sub('<link rel="stylesheet" href="%s" />\n' % css_url, page)
+    page = _SCRIPT.sub("", page, count=len(scripts) - 1)
+    page = _SCRIPT.sub('<script src="%s"></script>\n' % js_url, page)
+    write_gzip(os.path.join(out, "index.html"), page.encode())
+
+    written = []
+    for _dir, _, names in os.walk(out):
+        written.extend(os.path.join(_dir, name) for name in names)
+    return sorted(written)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out", nargs="?", default=os.path.join(_ROOT, "dist", "www"))
+    parser.add_argument("--src", default=os.path.join(_ROOT, "www"))
+    parser.add_argument(
+        "--cache-dir", default=os.path.join(tempfile.gettempdir(), "airstation-www")
+    )
+    args = parser.parse_args()
+
+    for path in build(args.src, args.out, args.cache_dir):
+        print("%8d %s" % (os.path.getsize(path), os.path.relpath(path, args.out)))
@@ -0,0 +1,274 @@
+"""Load database files copied off the SD card into NumPy column arrays, for analysis on the host.
+
+Usage: python util/load_db.py PATH [--from TS] [--to TS] [--fields a,b] [--npy FILE | --parquet FILE]
+
+PATH is a database file (/sd/data.csv, with the partitions next to it) or a directory of them, e.g. the
+archives of several stations. Files are memory-mapped with np.memmap, so nothing is read until a column
+is decoded:
+- CSV records have a fixed width, so a file is a matrix of bytes with one row per record; each column is
+  a fixed range of bytes in the rows and is parsed with vectorised arithmetic on its digits.
+- Binary records (records.BinaryFormat) are mapped as a structured array; the columns are views of the
+  file.
+- Compressed partitions (compressed.CompressedSegment) cannot be mapped and are decompressed in Python.
+
+The timestamps are parsed first and the time range is found with np.searchsorted, so only the records in
+the range have their fields decoded. Timestamps are returned as stored (the embedded epoch of the ESP32
+for data written on the device, seconds since 2000-01-01).
+
+Without an output file, the number of records and the range of each column are printed. Parquet export
+needs pyarrow."""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from compressed import CompressedSegment, is_compressed  # noqa: E402
+from measurements import DataPoint  # noqa: E402
+from records import BinaryFormat, CsvFormat, detect_format  # noqa: E402
+from schema import DATAPOINT_FIELDS  # noqa: E402
+
+# NumPy types of the struct codes used by BinaryFormat
+_NUMPY_TYPES = {"B": "u1", "H": "<u2", "h": "<i2", "I": "<u4", "i": "<i4"}
+_BINARY_COLUMNS = [("timestamp", "<u4")]
+_BINARY_COLUMNS.extend((f.name, _NUMPY_TYPES[f.code]) for f in DATAPOINT_FIELDS)
+_BINARY_DTYPE = np.dtype(_BINARY_COLUMNS)
+
+# decimal places of each CSV column; the other columns are integers
+_CSV_DECIMALS = {f.name: f.decimals for f in DATAPOINT_FIELDS if f.decimals}
+# CSV rows parsed at a time, to bound the temporary arrays of the digits
+_CSV_BLOCK_ROWS = 1 << 20
+
+
+def load(
+    path: str, _from: int = None, _to: int = None, fields: tuple = DataPoint.FIELDS
+) -> dict:
+    """return the timestamps and fields of the records with a timestamp in [_from, _to) as a dict of
+    column arrays, for a database file (with its partitions) or a directory of them
+
+    Records of several files are concatenated in the order of their first timestamps."""
+    for name in fields:
+        if name not in DataPoint.FIELDS:
+            raise ValueError("unknown field %s" % name)
+
+    parts = []
+    for file_path in database_files(path):
+        columns = load_file(file_path, _from, _to, fields)
+        if len(columns["timestamp"]):
+            parts.append(columns)
+    parts.sort(key=lambda columns: columns["timestamp"][0])
+
+    if not parts:
+        return {
+            name: np.empty(0, _column_dtype(name)) for name in ("timestamp",) + fields
+        }
+    if len(parts) == 1:
+        return parts[0]
+    return {
+        name: np.concatenate([columns[name] for columns in parts]) for name in parts[0]
+    }
+
+
+def database_files(path: str) -> list:
+    """the database files at path: the file and its partitions (<path>.<key>, or <path>.<key>.z once
+    compressed), or the files of a directory that start like a database"""
+    if os.path.isdir(path):
+        candidates = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        _dir, _name = os.path.split(path)
+        candidates = [path + ".z" if os.path.exists(path + ".z") else path]
+        names = os.listdir(_dir or ".")
+        for name in sorted(names):
+            key = name.replace(_name + ".", "", 1)
+            if not name.startswith(_name + "."):
+                continue
+            if key.isdigit() and name + ".z" not in names:
+                candidates.append(os.path.join(_dir, name))
+            elif key.endswith(".z") and key[:-2].isdigit():
+                # a compressed partition (see DB.compact_steps); the partition it replaced may
+                # still be there
+                candidates.append(os.path.join(_dir, name))
+
+    files = []
+    for candidate in candidates:
+        if not os.path.isfile(candidate):
+            continue
+        with open(candidate, "rb") as f:
+            header = f.read(CsvFormat.HEADER_LENGTH)
+        if header == CsvFormat.HEADER or header.startswith(BinaryFormat.HEADER):
+            files.append(candidate)
+        elif is_compressed(candidate):
+            files.append(candidate)
+    return files
+
+
+def load_file(
+    path: str, _from: int = None, _to: int = None, fields: tuple = DataPoint.FIELDS
+):
+    """return the columns of the records of a single database file with a timestamp in [_from, _to)"""
+    if is_compressed(path):
+        records = _decompress(path)
+        return _binary_columns(records, _from, _to, fields)
+
+    with open(path, "rb") as f:
+        _format = detect_format(f.read(BinaryFormat.HEADER_LENGTH))
+    count = (os.path.getsize(path) - _format.HEADER_LENGTH) // _format.RECORD_LENGTH
+    if count <= 0:
+        return {
+            name: np.empty(0, _column_dtype(name)) for name in ("timestamp",) + fields
+        }
+
+    if _format is BinaryFormat:
+        records = np.memmap(
+            path, _BINARY_DTYPE, "r", offset=BinaryFormat.HEADER_LENGTH, shape=(count,)
+        )
+        return _binary_columns(records, _from, _to, fields)
+
+    rows = np.memmap(
+        path,
+        np.uint8,
+        "r",
+        offset=CsvFormat.HEADER_LENGTH,
+        shape=(count, CsvFormat.RECORD_LENGTH),
+    )
+    timestamps = _parse_csv_column(rows, 0, 0)
+    _start, _end = _range(timestamps, _from, _to)
+    rows = rows[_start:_end]
+    columns = {"timestamp": timestamps[_start:_end]}
+    for name in fields:
+        j = DataPoint.FIELDS.index(name) + 1
+        columns[name] = _parse_csv_column(rows, j, _CSV_DECIMALS.get(name, 0))
+    return columns
+
+
+def _binary_columns(records, _from: int, _to: int, fields: tuple) -> dict:
+    _start, _end = _range(records["timestamp"], _from, _to)
+    records = records[_start:_end]
+    columns = {"timestamp": records["timestamp"]}
+    for name, _, _, scale in BinaryFormat._FIELDS:
+        if name in fields:
+            columns[name] = records[name] / scale if scale != 1 else records[name]
+    return columns
+
+
+def _range(timestamps, _from: int, _to: int) -> tuple:
+    """the first record at or after _from and the first one at or after _to; timestamps are in
+    ascending order"""
+    _start = 0 if _from is None else int(np.searchsorted(timestamps, _from, "left"))
+    _end = len(timestamps)
+    if _to is not None:
+        _end = int(np.searchsorted(timestamps, _to, "left"))
+    return _start, max(_start, _end)
+
+
+def _parse_csv_column(rows, column: int, decimals: int):
+    """parse a column of right-aligned numbers with the given number of decimal places out of the rows
+    of a CSV file (a uint8 matrix)
+
+    The value is the sum of the digits times the power of ten of their position in the column, which
+    is fixed by the alignment; the position of the decimal point is skipped."""
+    _start, _end = CsvFormat._SPANS[column]
+    width = _end - _start
+    weights = np.zeros(width, np.int64)
+    _power = 1
+    for c in range(width - 1, -1, -1):
+        if decimals and c == width - decimals - 1:
+            # the decimal point
+            continue
+        weights[c] = _power
+        _power *= 10
+
+    values = np.empty(len(rows), np.float64 if decimals else np.int64)
+    for _first in range(0, len(rows), _CSV_BLOCK_ROWS):
+        _last = _first + _CSV_BLOCK_ROWS
+        chars = np.asarray(rows[_first:_last, _start:_end], dtype=np.int64)
+        digits = chars - ord("0")
+        digits[(digits < 0) | (digits > 9)] = 0
+        block = digits @ weights
+        negative = (chars == ord("-")).any(axis=1)
+        block[negative] = -block[negative]
+        values[_first:_last] = block / 10**decimals if decimals else block
+    if not decimals and column != 0:
+        # aqi, tvoc and eCO2 fit the types BinaryFormat stores them as
+        return values.astype(_column_dtype(DataPoint.FIELDS[column - 1]))
+    return values
+
+
+def _column_dtype(name: str):
+    if name == "timestamp":
+        return np.int64
+    if name in _CSV_DECIMALS:
+        return np.float64
+    return _BINARY_DTYPE[name]
+
+
+def _decompress(path: str):
+    """the records of a compressed segment as a structured array (not memory-mapped)"""
+    segment = CompressedSegment(path)
+    buf = bytearray(segment.size - BinaryFormat.HEADER_LENGTH)
+    chunk = bytearray(1024 * BinaryFormat.RECORD_LENGTH)
+    _offset = 0
+    for n in segment.iter_chunks(BinaryFormat.HEADER_LENGTH, segment.size, chunk):
+        _end = _offset + n
+        buf[_offset:_end] = chunk[:n]
+        _offset = _end
+    return np.frombuffer(bytes(buf), _BINARY_DTYPE)
+
+
+def save_npy(columns: dict, path: str):
+    """save the columns as a single structured array"""
+    names = list(columns)
+    records = np.empty(
+        len(columns["timestamp"]), [(name, columns[name].dtype) for name in names]
+    )
+    for name in names:
+        records[name] = columns[name]
+    np.save(path, records)
+
+
+def save_parquet(columns: dict, path: str):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+    table = pyarrow.table(
+        {name: np.asarray(values) for name, values in columns.items()}
+    )
+    pyarrow.parquet.write_table(table, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--from", dest="_from", type=int)
+    parser.add_argument("--to", dest="_to", type=int)
+    parser.add_argument("--fields", default=",".join(DataPoint.FIELDS))
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--npy")
+    output.add_argument("--parquet")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        columns = load(args.path, args._from, args._to, tuple(args.fields.split(",")))
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+
+    if args.npy:
+        save_npy(columns, args.npy)
+    elif args.parquet:
+        save_parquet(columns, args.parquet)
+    else:
+        count = len(columns["timestamp"])
+        print("%d records loaded in %.2f s" % (count, elapsed))
+        if count:
+            for name, values in columns.items():
+                print("%-20s %12s .. %s" % (name, values.min(), values.max()))
@@ -0,0 +1,209 @@
+"""Load-test the web server of the station with many dashboards at once.
+
+Usage: python util/load_webserver.py [--clients N] [--seconds S] [--poll S] [--max-connections N]
+                                     [--data-dir DIR]
+
+Runs server.app (webserver.WebServer) in this process on a database of a month of samples (generated as
+by util/bench_db.py) that a task keeps inserting into, and simulates the dashboards: each one loads the
+page and the last day of data, then polls /data?format=bin&since= with its cursor, opening a connection
+for every poll and waiting Retry-After when the server is full. Prints the requests served, their latency, the
+connections turned away and the memory held by the process (tracemalloc), sampled every second. The
+clients run in the same process, so that is an upper bound of what the server holds; it should stay
+flat over the run and grow little with the number of clients."""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(_ROOT, "src"))
+
+import bench_db  # noqa: E402
+import server  # noqa: E402
+from db import DB  # noqa: E402
+from measurements import DataPoint  # noqa: E402
+
+# seconds a request may take, connecting included
+TIMEOUT = 10
+
+
+async def get(port: int, path: str, headers: dict = None) -> tuple:
+    """request path on a new connection and return the status, headers and the size of the body
+
+    The server closes the connections it turns away without reading the request, which the client may
+    see as a reset; that counts as a 503."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    status, response_headers, size = None, {}, 0
+    try:
+        lines = ["GET %s HTTP/1.1\r\n" % path, "Connection: close\r\n"]
+        for name, value in (headers or {}).items():
+            lines.append("%s: %s\r\n" % (name, value))
+        writer.write(("".join(lines) + "\r\n").encode())
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        while True:
+            line = (await reader.readline()).decode()
+            if line in ("\r\n", ""):
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.lower()] = value.strip()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            size += len(data)
+    except (ConnectionResetError, IndexError):
+        if status is None:
+            status = 503
+    finally:
+        writer.close()
+    return status, response_headers, size
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+
+    def add(self, status, seconds: float, size: int):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status not in (503, "timeout"):
+            self.latencies.append(seconds)
+            self.bytes += size
+
+
+async def dashboard(port: int, start: int, poll: float, stop: float, stats: Stats):
+    """load the page and the last day of data, then follow the new records until stop"""
+
+    async def _get(path, headers=None):
+        while time.monotonic() < stop:
+            _start = time.monotonic()
+            try:
+                status, response_headers, size = await asyncio.wait_for(
+                    get(port, path, headers), TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                # e.g. the connection waited for room in the backlog of the server
+                stats.add("timeout", TIMEOUT, 0)
+                continue
+            stats.add(status, time.monotonic() - _start, size)
+            if status != 503:
+                return status, response_headers
+            await asyncio.sleep(float(response_headers.get("retry-after", 1)))
+        return None, {}
+
+    for path in ("/", "/dygraph.js", "/style.css"):
+        await _get(path)
+    cursor = start
+    etag = None
+    while time.monotonic() < stop:
+        status, headers = await _get(
+            "/data?format=bin&since=%d" % cursor,
+            {"If-None-Match": etag} if etag else None,
+        )
+        if status == 200:
+            cursor = int(headers.get("x-cursor") or cursor)
+            etag = None
+        await asyncio.sleep(poll)
+
+
+async def insert(db: DB, last_ts: int, stop: float):
+    dp = DataPoint.from_csv("0,21.50,1013.25,40.00,1,100,400")
+    while time.monotonic() < stop:
+        last_ts += bench_db.CADENCE
+        dp.timestamp = last_ts
+        db.insert(dp)
+        await asyncio.sleep(0.1)
+
+
+async def sample_memory(stop: float, samples: list):
+    while time.monotonic() < stop:
+        samples.append(tracemalloc.get_traced_memory()[0])
+        await asyncio.sleep(1)
+
+
+async def run(args, path: str) -> dict:
+    db = DB(path, flush_every=10)
+    server.database = db
+    app = server.app
+    app.max_connections = args.max_connections
+    server.static_routes(os.path.join(_ROOT, "www"))
+
+    srv = await app.start("127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+    last_ts = bench_db.timestamps_range(path)[1]
+
+    stats = Stats()
+    memory = []
+    stop = time.monotonic() + args.seconds
+    tracemalloc.start()
+    try:
+        await asyncio.gather(
+            insert(db, last_ts, stop),
+            sample_memory(stop, memory),
+            *(
+                dashboard(port, last_ts - bench_db.DAY, args.poll, stop, stats)
+                for _ in range(args.clients)
+            )
+        )
+    finally:
+        tracemalloc.stop()
+        srv.close()
+
+    latencies = sorted(stats.latencies)
+    n = len(latencies)
+    return {
+        "requests": n,
+        "requests_per_second": n / args.seconds,
+        "bytes": stats.bytes,
+        "statuses": stats.statuses,
+        "latency_ms": {
+            "p50": latencies[n // 2] * 1000 if n else None,
+            "p95": latencies[n * 95 // 100] * 1000 if n else None,
+            "max": latencies[-1] * 1000 if n else None,
+        },
+        "memory_bytes": memory,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--poll", type=float, default=1)
+    parser.add_argument("--max-connections", type=int, default=4)
+    parser.add_argument(
+        "--data-dir", default=os.path.join(tempfile.gettempdir(), "airstation-bench")
+    )
+    args = parser.parse_args()
+
+    _source = bench_db.data_file(
+        args.data_dir, "month", dict(bench_db.SIZES)["month"], 0
+    )
+    _dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(_dir, "data.csv")
+        shutil.copyfile(_source, path)
+        result = asyncio.run(run(args, path))
+    finally:
+        shutil.rmtree(_dir)
+
+    print("%d clients, %d s" % (args.clients, args.seconds))
+    print(
+        "%d requests (%.1f/s), %d bytes"
+        % (result["requests"], result["requests_per_second"], result["bytes"])
+    )
+    print("statuses: %s" % result["statuses"])
+    print("latency (ms): %s" % result["latency_ms"])
+    memory = result["memory_bytes"]
+    print("memory (bytes, every second): %s" % memory)
+    if len(memory) > 1:
+        # the first sample is taken before the clients connect
+        print("memory after warm-up: %d..%d bytes" % (min(memory[1:]), max(memory[1:])))
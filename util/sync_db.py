@@ -0,0 +1,128 @@
+"""Keep a local copy of the database of a station up to date over HTTP.
+
+Usage: python util/sync_db.py HOST [--dir DIR]
+
+The files of the database are listed with /db and each one is brought up to date with /raw, which sends
+only the bytes after the end of the local copy (records are only ever appended). Every block is checked
+against its CRC-32 before it is written, so an interrupted sync leaves a valid prefix that the next one
+continues from. A file that was rewritten on the station since the last sync (a partition that was
+compressed) is detected with the CRC of the end of the local copy and downloaded again. The names of the
+files are kept in MANIFEST in the directory, and the ones the station no longer has (the uncompressed
+copy of a partition that was compressed) are deleted; other files in the directory are left alone.
+
+Records the station has not flushed to the card yet are left for the next sync."""
+
+import argparse
+import os
+import struct
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+# the bytes before the offset the station checks; server.FILE_BLOCK
+BLOCK = 1024
+# the files of the station synced to the directory, one name per line
+MANIFEST = ".manifest"
+
+
+def list_files(host: str) -> list:
+    """the names and sizes of the files of the database on the station"""
+    with urllib.request.urlopen("http://%s/db" % host) as response:
+        lines = response.read().decode().splitlines()
+    files = []
+    for line in lines[1:]:
+        name, size = line.split(",")
+        files.append((name, int(size)))
+    return files
+
+
+def _check(f, offset: int) -> int:
+    """the CRC-32 of the BLOCK bytes of f before offset"""
+    _first = max(0, offset - BLOCK)
+    f.seek(_first)
+    return zlib.crc32(f.read(offset - _first))
+
+
+def sync_file(host: str, name: str, path: str) -> int:
+    """append the bytes of the file name on the station that the local copy at path does not have yet,
+    and return the number of bytes received"""
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    received = 0
+    with open(path, mode) as f:
+        offset = f.seek(0, os.SEEK_END)
+        query = {"file": name, "offset": offset, "check": _check(f, offset)}
+        url = "http://%s/raw?%s" % (host, urllib.parse.urlencode(query))
+        try:
+            response = urllib.request.urlopen(url)
+        except urllib.error.HTTPError as e:
+            if e.code not in (400, 409):
+                raise
+            # the file was rewritten or is shorter than the local copy: start again
+            offset = 0
+            url = "http://%s/raw?%s" % (host, urllib.parse.urlencode({"file": name}))
+            response = urllib.request.urlopen(url)
+
+        with response:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                header = response.read(8)
+                if len(header) < 8:
+                    raise IOError("%s: the stream ended early" % name)
+                n, crc = struct.unpack("<II", header)
+                if not n:
+                    break
+                data = response.read(n)
+                if len(data) < n or zlib.crc32(data) != crc:
+                    raise IOError("%s: corrupt block at %d" % (name, offset))
+                f.write(data)
+                offset += n
+                received += n + 8
+    return received
+
+
+def _reconcile(_dir: str, names: list):
+    """delete the files of the last sync that are not in names, and record names as the files synced"""
+    manifest = os.path.join(_dir, MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            previous = f.read().splitlines()
+        for name in previous:
+            path = os.path.join(_dir, name)
+            if name not in names and os.path.exists(path):
+                os.remove(path)
+                print("%s: deleted" % name, file=sys.stderr)
+    with open(manifest, "w") as f:
+        f.write("".join(name + "\n" for name in names))
+
+
+def sync(host: str, _dir: str) -> int:
+    """bring the copies in _dir of every file of the database up to date, deleting the files the station
+    no longer has; return the bytes received"""
+    os.makedirs(_dir, exist_ok=True)
+    files = list_files(host)
+    _reconcile(_dir, [name for name, _ in files])
+    total = 0
+    for name, size in files:
+        path = os.path.join(_dir, name)
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            continue
+        received = sync_file(host, name, path)
+        print("%s: %d bytes received" % (name, received), file=sys.stderr)
+        total += received
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("host")
+    parser.add_argument("--dir", default="airstation-mirror")
+    args = parser.parse_args()
+
+    try:
+        total = sync(args.host, args.dir)
+    except (OSError, urllib.error.URLError) as e:
+        raise SystemExit("sync failed: %s" % e)
+    print("%d bytes received" % total)
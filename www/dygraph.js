@@ -48,10 +48,14 @@ Dygraph.onDOMready(function onDOMready() {
 
   var dataSeries = ['temperature', 'pressure', 'humidity', 'tvoc', 'eco2', 'aqi'];
 
+  // the graphs, once the first data has arrived, and the cursor of the newest record they have
+  var graphs = [];
+  var cursor = '';
+  const poll_interval = 30 * 1000; // 30 seconds
+
   var plugins =
 
   renderGraphs = function() {
-      var graphs = [];
       for (var i = 0; i < 6; i++) {
         var graphDefinition = graphDefinitions[dataSeries[i]];
         var div = document.getElementById(graphDefinition.div);
@@ -92,34 +96,173 @@ Dygraph.onDOMready(function onDOMready() {
       });
   };
 
+  // redraw the graphs with the rows appended to their data; a graph showing its newest point
+  // scrolls along to keep showing it
+  updateGraphs = function(previous_last_time) {
+      for (var i = 0; i < graphs.length; i++) {
+        var graphDefinition = graphDefinitions[dataSeries[i]];
+        var last_time = graphDefinition.data[graphDefinition.data.length - 1][0];
+        var options = {file: graphDefinition.data};
+        var dateWindow = graphs[i].xAxisRange();
+        if (dateWindow[1] >= previous_last_time) {
+            var shift = last_time - previous_last_time;
+            options.dateWindow = [new Date(dateWindow[0] + shift), last_time];
+        }
+        graphs[i].updateOptions(options);
+      }
+  };
+
   const max_time_between_points = 60 * 1000; // 60 seconds
-  Papa.parse('./example-data.csv', {
-    download: true,
-    header: true,
-    dynamicTyping: true,
-    step: function(row) {
-        for (var i = 0; i < 6; i++) {
-            if (!row.data.timestamp) {
-                continue;
-            }
-            var graph_def = graphDefinitions[dataSeries[i]];
-            var t = new Date((row.data.timestamp + 946684800) * 1000);
-
-            if (graph_def.data.length > 0) {
-                var last_data = graph_def.data[graph_def.data.length - 1];
-                var diff = t - last_data[0];
-                if (diff > max_time_between_points) {
-                    graph_def.data.push([new Date(t - diff), null]);
-                }
+  const epoch_offset = 946684800; // the station counts seconds from 2000-01-01
+  const history_seconds = 24 * 60 * 60; // what the dashboard shows when it opens
+
+  // the fields of the records in the order of their columns, from the X-Fields header of /data:
+  // name, typed array and fixed-point scale of each
+  var fields = [];
+  var typedArrays = {h: Int16Array, H: Uint16Array};
+  var missingValues = {h: -32768, H: 65535};
+
+  var setFields = function(header) {
+      fields = header.split(';').map(function(field) {
+          var parts = field.split(',');
+          return {name: parts[0], code: parts[1], scale: parseInt(parts[2], 10)};
+      });
+      var names = fields.map(function(field) { return field.name; });
+      for (var i = 0; i < 6; i++) {
+          var graph_def = graphDefinitions[dataSeries[i]];
+          graph_def.column = names.indexOf(graph_def.csvKey || dataSeries[i]);
+      }
+  };
+
+  // append a record to the data of every series, after a gap marker when samples are missing; values
+  // are in the order of fields
+  var addPoint = function(t, values) {
+      for (var i = 0; i < 6; i++) {
+          var graph_def = graphDefinitions[dataSeries[i]];
+          if (graph_def.data.length > 0) {
+              var last_data = graph_def.data[graph_def.data.length - 1];
+              var diff = t - last_data[0];
+              if (diff > max_time_between_points) {
+                  graph_def.data.push([new Date(t - diff), null]);
+              }
+          }
+          graph_def.data.push([t, values[graph_def.column]]);
+      }
+  };
+
+  // a CSV line of /live: the timestamp, then the fields
+  var addRow = function(row) {
+      if (!row.data[0]) {
+          return;
+      }
+      addPoint(new Date((row.data[0] + epoch_offset) * 1000), row.data.slice(1));
+  };
+
+  // append the records of a /data?format=bin payload (see src/wire.py). It is made of blocks: the
+  // number of records, their timestamps as differences from the one before, then a column of 16-bit
+  // fixed-point numbers per field, all little-endian. The columns are read as typed arrays over the
+  // payload, with no parsing of the records.
+  var addColumns = function(buffer) {
+      var offset = 0;
+      var timestamp = 0;
+      var values = new Array(fields.length);
+      while (offset < buffer.byteLength) {
+          var n = new Uint32Array(buffer, offset, 1)[0];
+          var deltas = new Int32Array(buffer, offset + 4, n);
+          var times = new Float64Array(n);
+          for (var i = 0; i < n; i++) {
+              timestamp += deltas[i];
+              times[i] = (timestamp + epoch_offset) * 1000;
+          }
+
+          var columns = [];
+          var column_offset = offset + 4 + 4 * n;
+          for (var j = 0; j < fields.length; j++) {
+              columns.push(new typedArrays[fields[j].code](buffer, column_offset, n));
+              column_offset += 2 * n;
+          }
+
+          for (var i = 0; i < n; i++) {
+              for (var j = 0; j < fields.length; j++) {
+                  var value = columns[j][i];
+                  values[j] = value === missingValues[fields[j].code] ? null : value / fields[j].scale;
+              }
+              addPoint(new Date(times[i]), values);
+          }
+          // the blocks are padded to 4 bytes
+          offset = (column_offset + 3) & ~3;
+      }
+  };
+
+  var lastTime = function() {
+      var data = graphDefinitions[dataSeries[0]].data;
+      return data.length ? data[data.length - 1][0] : null;
+  };
+
+  // draw the graphs, or redraw them if records were appended since previous_last_time
+  var redraw = function(previous_last_time) {
+      var last_time = lastTime();
+      if (!last_time || (previous_last_time && last_time <= previous_last_time)) {
+          return;
+      }
+      if (graphs.length) {
+          updateGraphs(previous_last_time);
+      } else {
+          renderGraphs();
+      }
+  };
+
+  // fetch the records newer than the cursor and append them to the data of the graphs; the first
+  // time, the records of the last day only, rather than the whole history of the station
+  var load = function() {
+      var previous_last_time = lastTime();
+      var since = cursor;
+      if (since === '') {
+          since = Math.floor(Date.now() / 1000) - epoch_offset - history_seconds;
+      }
+      return fetch('./data?format=bin&since=' + since)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error('data request failed: ' + response.status);
             }
+            cursor = response.headers.get('X-Cursor') || cursor;
+            setFields(response.headers.get('X-Fields'));
+            return response.arrayBuffer();
+        })
+        .then(function(buffer) {
+            addColumns(buffer);
+            redraw(previous_last_time);
+        })
+        .catch(function(error) {
+            console.error(error);
+        });
+  };
 
-            var key = graph_def.csvKey || dataSeries[i];
-            graph_def.data.push([t , row.data[key]]);
-        }
-    },
-    complete: function(results) {
-        renderGraphs();
-    }
-  });
-});
+  // append every new sample as the station pushes it; the browser reconnects by itself, from the id
+  // of the last event, unless the station turns the stream away (e.g. too many dashboards follow it),
+  // in which case the dashboard polls instead
+  var follow = function() {
+      if (!window.EventSource || !fields.length) {
+          setInterval(load, poll_interval);
+          return;
+      }
+      var source = new EventSource('./live?since=' + cursor);
+      source.onmessage = function(e) {
+          var previous_last_time = lastTime();
+          cursor = e.lastEventId || cursor;
+          Papa.parse(e.data, {
+            dynamicTyping: true,
+            skipEmptyLines: true,
+            step: addRow
+          });
+          redraw(previous_last_time);
+      };
+      source.onerror = function() {
+          if (source.readyState === EventSource.CLOSED) {
+              setInterval(load, poll_interval);
+          }
+      };
+  };
 
+  load().then(follow);
+});